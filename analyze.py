@@ -0,0 +1,225 @@
+import os
+import json
+import math
+import logging
+import argparse
+import itertools
+import collections
+import numpy as np
+from tqdm import tqdm
+
+from seq2seq import bleu, utils
+from seq2seq.cache import TranslationCache
+
+
+# Sentence of the test set together with the hypotheses of all systems and the POS tags of the reference (or None)
+Segment = collections.namedtuple('Segment', ['id', 'source', 'reference', 'hypotheses', 'tags'])
+
+FILTER_REGISTRY = {}
+
+
+def register_filter(name, needs_tags=False):
+    """ Decorator to register a new filter. A filter is a function that takes the argument of a filter specification
+    (--filters name:argument, or None) and returns a predicate on Segments; filters that need the POS tags of the
+    references are registered with needs_tags=True. """
+    def register_filter_fn(fn):
+        if name in FILTER_REGISTRY:
+            raise ValueError('Cannot register duplicate filter {}'.format(name))
+        fn.needs_tags = needs_tags
+        FILTER_REGISTRY[name] = fn
+        return fn
+    return register_filter_fn
+
+
+@register_filter('all')
+def all_filter(argument):
+    return lambda segment: True
+
+
+@register_filter('tag', needs_tags=True)
+def tag_filter(tag):
+    """ Sentences whose reference contains a word with the given POS tag, e.g. tag:VBN. """
+    if tag is None:
+        raise ValueError('The tag filter needs a POS tag, e.g. tag:VBD')
+    return lambda segment: tag in segment.tags.split()
+
+
+@register_filter('vbd', needs_tags=True)
+def vbd_filter(argument):
+    """ Sentences whose reference contains a verb in past tense (as filter_VBD.py). """
+    return tag_filter('VBD')
+
+
+@register_filter('min-length')
+def min_length_filter(length):
+    return lambda segment: len(segment.reference.split()) >= int(length)
+
+
+@register_filter('max-length')
+def max_length_filter(length):
+    return lambda segment: len(segment.reference.split()) <= int(length)
+
+
+def build_filter(spec):
+    """ Returns the predicate of a filter specification (name or name:argument) and whether it needs POS tags. """
+    name, _, argument = spec.partition(':')
+    if name not in FILTER_REGISTRY:
+        raise ValueError('Unknown filter {} (choose from {})'.format(name, ', '.join(FILTER_REGISTRY)))
+    return FILTER_REGISTRY[name](argument or None), FILTER_REGISTRY[name].needs_tags
+
+
+def get_args():
+    """ Defines analysis parameters. """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--source', default='raw_data/test.jp', help='path to the source sentences')
+    parser.add_argument('--reference', default='raw_data/test.en', help='path to the reference translations')
+    parser.add_argument('--systems', nargs='+', required=True,
+                        help='translations of the compared systems as paths or as name=path')
+    parser.add_argument('--filters', nargs='+', default=['all', 'vbd'],
+                        help='subsets to score as filter or filter:argument; available filters: {}'.format(
+                            ', '.join(FILTER_REGISTRY)))
+    parser.add_argument('-lc', '--lowercase', action='store_true', help='lower-case hypotheses and references')
+    parser.add_argument('--output', default=None,
+                        help='path to write the filters and sentence BLEU scores of every sentence to (JSON lines)')
+
+    # Add tagging arguments
+    parser.add_argument('--batch-size', default=2000, type=int,
+                        help='number of sentences read, tagged and scored at a time')
+    parser.add_argument('--num-workers', default=1, type=int, help='number of POS tagging processes')
+    parser.add_argument('--tag-cache', default=None,
+                        help='path to an SQLite database that keeps POS tags across runs')
+    return parser.parse_args()
+
+
+class TagCache(TranslationCache):
+    """ Persistent cache of the POS tags of sentences, keyed by the sentence text (see TranslationCache). """
+
+    @staticmethod
+    def key(sentence):
+        return sentence.encode('utf-8')
+
+
+_tagger = {}
+
+
+def init_tagger():
+    """ Loads the POS tagger once per process. """
+    from nltk.tag.perceptron import PerceptronTagger
+    _tagger['tagger'] = PerceptronTagger()
+
+
+def tag_sentences(sentences):
+    """ Tags a batch of tokenized sentences and returns their POS tags as space-separated strings. """
+    if 'tagger' not in _tagger:
+        init_tagger()
+    tagged = _tagger['tagger'].tag_sents([sentence.split() for sentence in sentences])
+    return [' '.join(tag for _, tag in words) for words in tagged]
+
+
+def read_lockstep(paths):
+    """ Yields the lines of several files of equal length together, one tuple of lines at a time. """
+    files = [open(path) for path in paths]
+    try:
+        for lines in itertools.zip_longest(*files):
+            if any(line is None for line in lines):
+                raise ValueError('{} do not have the same number of lines'.format(', '.join(paths)))
+            yield tuple(line.rstrip('\n') for line in lines)
+    finally:
+        for f in files:
+            f.close()
+
+
+def main(args):
+    """ Compares the translations of several systems on a test set and on subsets of it selected by filters. All files
+    are read in a single pass in batches of sentences; the references of every batch are POS tagged (if a filter needs
+    tags) by a pool of processes, and sentence BLEU and the n-gram statistics of every subset are computed from the
+    same n-gram counts. """
+    utils.init_logging(args)
+    systems = collections.OrderedDict()
+    for system in args.systems:
+        name, _, path = system.rpartition('=')
+        systems[name or os.path.splitext(os.path.basename(path))[0]] = path
+    filters = collections.OrderedDict((spec, build_filter(spec)) for spec in args.filters)
+    needs_tags = any(needs for _, needs in filters.values())
+
+    pool, cache = None, None
+    if needs_tags:
+        import nltk
+        cache = TagCache('pos', {'tagger': 'nltk.PerceptronTagger', 'nltk': nltk.__version__}, path=args.tag_cache)
+        if args.num_workers > 1:
+            import multiprocessing
+            pool = multiprocessing.get_context('spawn').Pool(args.num_workers, initializer=init_tagger)
+
+    def tag_fn(sentences):
+        if pool is None:
+            return tag_sentences(sentences)
+        # Tag the sentences that are not cached in one batch per process
+        chunk_size = int(math.ceil(len(sentences) / args.num_workers))
+        chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+        return [tags for chunk_tags in pool.map(tag_sentences, chunks) for tags in chunk_tags]
+
+    # Per-sentence n-gram statistics of every system, kept for the sentences of every subset
+    statistics = {(spec, name): [] for spec in filters for name in systems}
+    counts = collections.Counter()
+    output = open(args.output, 'w') if args.output is not None else None
+    batches = utils.grouped_iterator(read_lockstep([args.source, args.reference] + list(systems.values())),
+                                     args.batch_size)
+    num_sentences = 0
+    try:
+        for batch in tqdm(batches, desc='| Analyze', unit='batch', leave=False):
+            sources, references, *hypotheses = zip(*batch)
+            tags = cache.translate(list(references), tag_fn) if needs_tags else [None] * len(batch)
+            segments = [Segment(num_sentences + i, source, reference, dict(zip(systems, hypos)), sentence_tags)
+                        for i, (source, reference, sentence_tags, *hypos) in enumerate(
+                            zip(sources, references, tags, *hypotheses))]
+            num_sentences += len(batch)
+
+            masks = collections.OrderedDict()
+            for spec, (predicate, _) in filters.items():
+                masks[spec] = np.array([predicate(segment) for segment in segments], dtype=bool)
+                counts[spec] += int(masks[spec].sum())
+
+            scores = {}
+            for name, system_hypotheses in zip(systems, hypotheses):
+                batch_statistics = bleu.ngram_statistics(*bleu.encode(system_hypotheses, references, args.lowercase))
+                scores[name] = bleu.sentence_bleu_from_statistics(*batch_statistics)
+                for spec, mask in masks.items():
+                    statistics[spec, name].append(tuple(values[mask] for values in batch_statistics))
+
+            if output is not None:
+                for i, segment in enumerate(segments):
+                    output.write(json.dumps({
+                        'id': segment.id,
+                        'source': segment.source,
+                        'reference': segment.reference,
+                        'tags': segment.tags,
+                        'filters': [spec for spec, mask in masks.items() if mask[i]],
+                        'systems': {name: {'hypothesis': segment.hypotheses[name],
+                                           'bleu': round(100 * scores[name][i].score, 2)} for name in systems},
+                    }, ensure_ascii=False) + '\n')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if output is not None:
+            output.close()
+
+    if cache is not None:
+        logging.info('Tag cache: {}'.format(cache.summary()))
+        cache.close()
+    widths = [max(len(name), 8) for name in systems]
+    logging.info(' '.join(['{:<16s} {:>9s}'.format('subset', 'sentences')] +
+                          ['{:>{}s}'.format(name, width) for name, width in zip(systems, widths)]))
+    for spec in filters:
+        row = ['{:<16s} {:>9d}'.format(spec, counts[spec])]
+        for name, width in zip(systems, widths):
+            # Subsets without sentences (e.g. of an empty test set) are reported with a score of 0
+            score = bleu.corpus_bleu_from_statistics(*map(np.concatenate, zip(*statistics[spec, name]))).score \
+                if counts[spec] > 0 else 0.
+            row.append('{:>{}.2f}'.format(100 * score, width))
+        logging.info(' '.join(row))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -0,0 +1,84 @@
+import os
+import sys
+import argparse
+import subprocess
+import collections
+
+
+def get_args():
+    """ Defines start-up benchmark parameters. """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--modules', default=['translate', 'score', 'serve', 'visualize', 'train', 'tune', 'distill'],
+                        nargs='+', help='entry points (or any other modules) whose import time is measured')
+    parser.add_argument('--repeat', default=5, type=int, help='number of runs per module; the fastest run is reported')
+    parser.add_argument('--top', default=10, type=int, help='number of slowest imports listed per module')
+    return parser.parse_args()
+
+
+def parse_importtime(stderr):
+    """ Parses the output of python -X importtime into (module, depth, self time, cumulative time) tuples, with times in
+    microseconds. Modules are listed after the modules they import, which are one level deeper. """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def torch_time(imports):
+    """ Returns the time spent importing torch and everything that is (first) imported by torch. """
+    total, pending = 0, []
+    for name, depth, self_us, _ in imports:
+        # The pending modules deeper than this one were imported by it; pending times are not attributed to torch yet
+        children = 0
+        while len(pending) > 0 and pending[-1][0] > depth:
+            children += pending.pop()[1]
+        if name == 'torch' or name.startswith('torch.'):
+            total += self_us + children
+            children = -self_us
+        pending.append((depth, self_us + children))
+    return total
+
+
+def measure(module, repeat):
+    """ Imports a module in fresh interpreters and returns the imports of the run with the shortest total import time,
+    together with that total. """
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {:s}'.format(module)],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError('Importing {:s} failed:\n{:s}'.format(module, result.stderr))
+        imports = parse_importtime(result.stderr)
+        total = sum(self_us for _, _, self_us, _ in imports)
+        if best is None or total < best[1]:
+            best = (imports, total)
+    return best
+
+
+def main(args):
+    """ Reports the import time of every entry point, split into torch (including its own dependencies) and everything
+    else, and the slowest direct imports of each entry point. Short-lived jobs pay this on every start, so everything
+    that is not torch should be as small as possible. """
+    print('{:<12s} {:>10s} {:>10s} {:>10s} {:>8s}'.format('module', 'total ms', 'torch ms', 'other ms', 'modules'))
+    direct_imports = {}
+    for module in args.modules:
+        imports, total = measure(module, args.repeat)
+        torch_us = torch_time(imports)
+        print('{:<12s} {:>10.1f} {:>10.1f} {:>10.1f} {:>8d}'.format(module, total / 1e3, torch_us / 1e3,
+                                                                    (total - torch_us) / 1e3, len(imports)))
+        direct_imports[module] = sorted(((name, cumulative_us) for name, depth, _, cumulative_us in imports
+                                         if depth == 1), key=lambda item: -item[1])
+
+    for module, imports in direct_imports.items():
+        print('\nSlowest direct imports of {:s} (including what they import first):'.format(module))
+        for name, cumulative_us in imports[:args.top]:
+            print('  {:<30s} {:>8.1f} ms'.format(name, cumulative_us / 1e3))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -0,0 +1,163 @@
+import os
+import sys
+import argparse
+import logging
+import subprocess
+
+import torch
+
+from seq2seq import bleu, models, runtime, utils
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import Seq2SeqDataset
+from distill import load_checkpoint, build_checkpoint_model, translate_dataset
+
+
+def get_args():
+    """ Defines compression-specific parameters. Unknown arguments are passed on to train.py when fine-tuning the
+    compressed models (e.g. --max-tokens, --lr or --train-on-tiny). """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of generation (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
+
+    # Add data arguments
+    parser.add_argument('--data', default='prepared_data', help='path to data directory')
+    parser.add_argument('--test-split', default='test', help='split used to compare the compressed models')
+    parser.add_argument('--checkpoint-path', default='checkpoints/checkpoint_best.pt', help='path to the model')
+    parser.add_argument('--output-dir', default='checkpoints_compressed',
+                        help='path to save the checkpoints of the compressed models (one directory per rank)')
+
+    # Add compression arguments
+    parser.add_argument('--ranks', default=[64, 32, 16], nargs='+', type=int,
+                        help='ranks of the factorized output projections')
+    parser.add_argument('--finetune-epochs', default=1, type=int,
+                        help='number of epochs to fine-tune every compressed model (0 disables fine-tuning)')
+
+    # Add generation arguments
+    parser.add_argument('--generate-max-tokens', default=4096, type=int,
+                        help='maximum number of source and expected output tokens in a generation batch')
+    parser.add_argument('--generate-batch-size', default=None, type=int,
+                        help='maximum number of sentences in a generation batch')
+    parser.add_argument('--max-len', default=25, type=int, help='maximum length of generated sequences')
+    return parser.parse_known_args()
+
+
+def factorize(state_dict, model):
+    """ Returns the state dict of a model with factorized output projections, initialized from the state dict of a full
+    rank model. Every factorized projection W (out x in) is replaced by its truncated singular value decomposition
+    U_r S_r V_r^T, split into the factors S_r^1/2 V_r^T (rank x in) and U_r S_r^1/2 (out x rank); all other parameters
+    are copied. Also returns the fraction of the squared singular values kept by every factorized projection. """
+    compressed, energy = model.state_dict(), {}
+    for key, value in state_dict.items():
+        name = key[:-len('.weight')] if key.endswith('.weight') else None
+        if key in compressed:
+            compressed[key] = value
+        elif name is not None and name + '.0.weight' in compressed:
+            rank = compressed[name + '.0.weight'].size(0)
+            u, s, vh = torch.linalg.svd(value.float(), full_matrices=False)
+            root = s[:rank].sqrt()
+            compressed[name + '.0.weight'] = (root.unsqueeze(1) * vh[:rank]).to(value.dtype)
+            compressed[name + '.1.weight'] = (u[:, :rank] * root).to(value.dtype)
+            compressed[name + '.1.bias'] = state_dict[name + '.bias']
+            energy[name] = (s[:rank].pow(2).sum() / s.pow(2).sum()).item()
+    return compressed, energy
+
+
+def compress(args, state_dict, src_dict, tgt_dict, rank):
+    """ Builds the model of a checkpoint with output projections of the given rank, initializes them by truncated SVD
+    and saves the model as the last checkpoint of a fresh training run in {output_dir}/rank{rank}. """
+    compressed_args = argparse.Namespace(**vars(state_dict['args']))
+    compressed_args.decoder_output_rank = rank
+    model = models.build_model(compressed_args, src_dict, tgt_dict)
+    model_state, energy = factorize(state_dict['model'], model)
+    model.load_state_dict(model_state)
+    for name, kept in energy.items():
+        logging.info('Rank {:d}: {:s} keeps {:.1%} of the squared singular values'.format(rank, name, kept))
+
+    save_dir = os.path.join(args.output_dir, 'rank{:d}'.format(rank))
+    os.makedirs(save_dir, exist_ok=True)
+    checkpoint = {
+        'epoch': -1,
+        'val_loss': float('inf'),
+        'best_loss': float('inf'),
+        'last_epoch': -1,
+        'model': model.state_dict(),
+        'optimizer': None,
+        'args': compressed_args,
+    }
+    torch.save(checkpoint, os.path.join(save_dir, 'checkpoint_last.pt'))
+    return checkpoint, save_dir
+
+
+def finetune(args, train_args, checkpoint, save_dir):
+    """ Fine-tunes a compressed model with train.py, which resumes from the checkpoint saved by compress. The model
+    arguments of the checkpoint are passed on, so that train.py builds the same model. """
+    model_args = []
+    for key, value in sorted(vars(checkpoint['args']).items()):
+        if key.startswith(('encoder_', 'decoder_')) and value is not None:
+            model_args.extend(['--' + key.replace('_', '-'), str(value)])
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py'),
+               '--data', args.data, '--source-lang', args.source_lang, '--target-lang', args.target_lang,
+               '--arch', checkpoint['args'].arch, '--save-dir', save_dir, '--restore-file', 'checkpoint_last.pt',
+               '--max-epoch', str(args.finetune_epochs)] + model_args + train_args
+    logging.info('Fine-tuning: {:s}'.format(' '.join(command)))
+    subprocess.run(command, check=True)
+    return load_checkpoint(os.path.join(save_dir, 'checkpoint_best.pt'))
+
+
+def evaluate(args, state_dict, src_dict, tgt_dict, dataset, references):
+    """ Translates the test split and returns the number of parameters, the number of output projection parameters,
+    the generation speed in sentences per second and the BLEU score of a model. """
+    model = build_checkpoint_model(args, state_dict, src_dict, tgt_dict)
+    with torch.inference_mode():
+        hypos, elapsed = translate_dataset(args, model, tgt_dict, dataset, args.max_len,
+                                           '| Evaluate rank {:d}'.format(state_dict['args'].decoder_output_rank))
+    score = bleu.corpus_bleu([tgt_dict.string(hypo) for hypo in hypos], references)
+    decoder = model.decoder
+    projections = [decoder.final_projection] + ([decoder.W_lexical_output] if decoder.use_lexical_model else [])
+    return (sum(p.numel() for p in model.parameters()), sum(p.numel() for m in projections for p in m.parameters()),
+            len(dataset) / max(elapsed, 1e-9), score.score)
+
+
+def main(args, train_args):
+    """ Compresses the output projections of a trained model to several ranks by truncated SVD, fine-tunes every
+    compressed model briefly and reports the trade-off between size, generation speed and BLEU. """
+    torch.manual_seed(args.seed)
+    utils.init_logging(args)
+    runtime.configure(args)
+
+    state_dict = load_checkpoint(args.checkpoint_path)
+    state_dict['args'].decoder_output_rank = getattr(state_dict['args'], 'decoder_output_rank', 0)
+    args.source_lang, args.target_lang = state_dict['args'].source_lang, state_dict['args'].target_lang
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+
+    dataset = Seq2SeqDataset(
+        src_file=os.path.join(args.data, '{:s}.{:s}'.format(args.test_split, args.source_lang)),
+        tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(args.test_split, args.target_lang)),
+        src_dict=src_dict, tgt_dict=tgt_dict)
+    references = [tgt_dict.string(tokens) for tokens in dataset.tgt_dataset]
+
+    rows = [('original', state_dict['args'].decoder_output_rank) +
+            evaluate(args, state_dict, src_dict, tgt_dict, dataset, references)]
+    for rank in args.ranks:
+        checkpoint, save_dir = compress(args, state_dict, src_dict, tgt_dict, rank)
+        rows.append(('svd', rank) + evaluate(args, checkpoint, src_dict, tgt_dict, dataset, references))
+        if args.finetune_epochs > 0:
+            checkpoint = finetune(args, train_args, checkpoint, save_dir)
+            rows.append(('finetuned', rank) + evaluate(args, checkpoint, src_dict, tgt_dict, dataset, references))
+
+    logging.info('{:<10s} {:>6s} {:>12s} {:>12s} {:>12s} {:>8s} {:>8s}'.format(
+        'model', 'rank', 'parameters', 'output', 'sentences/s', 'speedup', 'BLEU'))
+    for name, rank, num_parameters, num_output_parameters, speed, score in rows:
+        logging.info('{:<10s} {:>6d} {:>12,d} {:>12,d} {:>12.1f} {:>7.2f}x {:>8.2f}'.format(
+            name, rank, num_parameters, num_output_parameters, speed, speed / max(rows[0][4], 1e-9), score))
+
+
+if __name__ == '__main__':
+    args, train_args = get_args()
+    main(args, train_args)
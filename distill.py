@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import pickle
+import shutil
+import logging
+import argparse
+import subprocess
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.serialization import default_restore_location
+
+from seq2seq import bleu, models, runtime, utils
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import MMapTokens, Seq2SeqDataset, GenerationBatchSampler
+from seq2seq.generator import SequenceGenerator
+from seq2seq.models import ARCH_MODEL_REGISTRY
+
+
+# Suffixes of the files of a memory-mapped copy of a split (see MMapTokens)
+MMAP_SUFFIXES = ('.idx.npy', '.bin.npy')
+
+
+def get_args():
+    """ Defines distillation-specific hyper-parameters. Unknown arguments are passed on to train.py when training the
+    student (e.g. --max-tokens, --lr or model arguments of the student architecture). """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of generation (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
+
+    # Add data arguments
+    parser.add_argument('--data', default='prepared_data', help='path to the original data directory')
+    parser.add_argument('--distill-data', default='distilled_data',
+                        help='path to the data directory with teacher translations as training targets')
+    parser.add_argument('--splits', default=['train'], nargs='+', help='training splits translated by the teacher')
+    parser.add_argument('--test-split', default='test', help='split used to compare teacher and student')
+    parser.add_argument('--teacher-checkpoint', default='checkpoints/checkpoint_best.pt', help='path to the teacher')
+    parser.add_argument('--student-dir', default='checkpoints_student', help='path to save student checkpoints')
+
+    # Add generation arguments
+    parser.add_argument('--generate-max-tokens', default=4096, type=int,
+                        help='maximum number of source and expected output tokens in a generation batch')
+    parser.add_argument('--generate-batch-size', default=None, type=int,
+                        help='maximum number of sentences in a generation batch')
+    parser.add_argument('--max-len', default=None, type=int,
+                        help='maximum length of teacher translations (default: the longest target of the split)')
+
+    # Add pipeline arguments
+    parser.add_argument('--student-arch', default='lstm_student', choices=ARCH_MODEL_REGISTRY.keys(),
+                        help='architecture of the student')
+    parser.add_argument('--stages', default=['distill', 'train', 'evaluate'], nargs='+',
+                        choices=['distill', 'train', 'evaluate'], help='stages of the pipeline to run')
+    return parser.parse_known_args()
+
+
+def load_checkpoint(checkpoint_path):
+    return torch.load(checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
+
+
+def build_checkpoint_model(args, state_dict, src_dict, tgt_dict):
+    """ Builds a model with the architecture stored in a checkpoint and loads its weights. """
+    model = models.build_model(state_dict['args'], src_dict, tgt_dict)
+    if args.cuda:
+        model = model.cuda()
+    model.eval()
+    model.load_state_dict(state_dict['model'])
+    return model
+
+
+def translate_dataset(args, model, tgt_dict, dataset, max_len, desc):
+    """ Greedily translates the source side of a dataset in length-sorted batches. Returns the translations as lists
+    of token ids (without the end-of-sentence token) in the original order and the elapsed generation time. """
+    loader = torch.utils.data.DataLoader(dataset, num_workers=1, collate_fn=dataset.collater,
+                                         worker_init_fn=runtime.data_worker_init_fn(),
+                                         batch_sampler=GenerationBatchSampler(
+                                             dataset.src_sizes, args.generate_max_tokens, args.generate_batch_size,
+                                             max_len))
+    generator = SequenceGenerator(model, tgt_dict, max_len=max_len)
+    hypos, elapsed = [None] * len(dataset), 0.
+    for sample in tqdm(loader, desc=desc, leave=False):
+        if args.cuda:
+            sample = utils.move_to_cuda(sample)
+        start = time.perf_counter()
+        with utils.autocast(args.precision, args.cuda):
+            batch_hypos = generator.generate(sample['src_tokens'], sample['src_lengths'])
+        if args.cuda:
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        for sent_id, hypo in zip(sample['id'].tolist(), batch_hypos):
+            hypos[sent_id] = hypo.cpu().tolist()
+    return hypos, elapsed
+
+
+def distill(args, teacher, src_dict, tgt_dict):
+    """ Translates the source side of the training splits with the teacher and writes the translations in the binary
+    format of preprocess.py (and in the memory-mapped format, if the original targets have a memory-mapped copy). The
+    dictionaries and all other splits of the data directory are copied unchanged, so that the student is validated and
+    tested against the original references. """
+    model = build_checkpoint_model(args, teacher, src_dict, tgt_dict)
+    os.makedirs(args.distill_data, exist_ok=True)
+    distilled = set('{:s}.{:s}'.format(split, args.target_lang) for split in args.splits)
+    for file in sorted(os.listdir(args.data)):
+        # Files of dictionaries and splits end with the language, or with that of a memory-mapped copy of a split
+        name = next((file[:-len(suffix)] for suffix in MMAP_SUFFIXES if file.endswith(suffix)), file)
+        if name.rpartition('.')[2] in (args.source_lang, args.target_lang) and name not in distilled:
+            shutil.copy2(os.path.join(args.data, file), os.path.join(args.distill_data, file))
+
+    for split in args.splits:
+        dataset = Seq2SeqDataset(
+            src_file=os.path.join(args.data, '{:s}.{:s}'.format(split, args.source_lang)),
+            tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(split, args.target_lang)),
+            src_dict=src_dict, tgt_dict=tgt_dict)
+        max_len = args.max_len if args.max_len is not None else int(dataset.tgt_sizes.max())
+        hypos, elapsed = translate_dataset(args, model, tgt_dict, dataset, max_len, '| Distill {:s}'.format(split))
+
+        # Like the original targets, teacher translations end with an end-of-sentence token
+        dtype = dataset.tgt_dataset[0].dtype if len(dataset) > 0 else np.int64
+        tokens_list = [np.array(hypo + [tgt_dict.eos_idx], dtype=dtype) for hypo in hypos]
+        output_file = os.path.join(args.distill_data, '{:s}.{:s}'.format(split, args.target_lang))
+        with open(output_file, 'wb') as outf:
+            pickle.dump(tokens_list, outf, protocol=pickle.HIGHEST_PROTOCOL)
+        # A memory-mapped copy is read instead of the pickled targets, so a stale one must not be left behind
+        for suffix in MMAP_SUFFIXES:
+            if os.path.exists(output_file + suffix):
+                os.remove(output_file + suffix)
+        if MMapTokens.exists(os.path.join(args.data, '{:s}.{:s}'.format(split, args.target_lang))):
+            MMapTokens.write(tokens_list, output_file)
+
+        num_tokens = sum(len(tokens) for tokens in tokens_list)
+        logging.info('Distilled {:s}: {:d} sentences, {:d} tokens ({:.3f} of the reference length) in {:.1f}s '
+                     '({:.1f} sentences/s) to {:s}'.format(
+                         split, len(tokens_list), num_tokens, num_tokens / max(dataset.tgt_sizes.sum(), 1),
+                         elapsed, len(tokens_list) / max(elapsed, 1e-9), output_file))
+
+
+def train_student(args, train_args):
+    """ Trains the student on the distilled data with train.py, passing on all unknown command-line arguments. """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py'),
+               '--data', args.distill_data, '--source-lang', args.source_lang, '--target-lang', args.target_lang,
+               '--arch', args.student_arch, '--save-dir', args.student_dir] + train_args
+    logging.info('Training the student: {:s}'.format(' '.join(command)))
+    subprocess.run(command, check=True)
+
+
+def evaluate(args, teacher, src_dict, tgt_dict):
+    """ Translates the test split with the teacher and the best student checkpoint and reports their sizes, generation
+    speeds and BLEU scores against the original references. """
+    dataset = Seq2SeqDataset(
+        src_file=os.path.join(args.data, '{:s}.{:s}'.format(args.test_split, args.source_lang)),
+        tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(args.test_split, args.target_lang)),
+        src_dict=src_dict, tgt_dict=tgt_dict)
+    references = [tgt_dict.string(tokens) for tokens in dataset.tgt_dataset]
+    max_len = args.max_len if args.max_len is not None else 25
+
+    rows = []
+    student_checkpoint = os.path.join(args.student_dir, 'checkpoint_best.pt')
+    for name, state_dict in (('teacher', teacher), ('student', load_checkpoint(student_checkpoint))):
+        model = build_checkpoint_model(args, state_dict, src_dict, tgt_dict)
+        with torch.inference_mode():
+            hypos, elapsed = translate_dataset(args, model, tgt_dict, dataset, max_len, '| Evaluate {:s}'.format(name))
+        score = bleu.corpus_bleu([tgt_dict.string(hypo) for hypo in hypos], references)
+        rows.append((name, state_dict['args'].arch, sum(p.numel() for p in model.parameters()),
+                     len(dataset) / max(elapsed, 1e-9), score.score))
+
+    logging.info('{:<8s} {:<14s} {:>12s} {:>12s} {:>8s}'.format('model', 'arch', 'parameters', 'sentences/s', 'BLEU'))
+    for name, arch, num_parameters, speed, score in rows:
+        logging.info('{:<8s} {:<14s} {:>12,d} {:>12.1f} {:>8.2f}'.format(name, arch, num_parameters, speed, score))
+    (_, _, teacher_parameters, teacher_speed, teacher_score), (_, _, student_parameters, student_speed,
+                                                               student_score) = rows
+    logging.info('Student: {:.2f}x faster with {:.2f}x fewer parameters at {:+.2f} BLEU'.format(
+        student_speed / max(teacher_speed, 1e-9), teacher_parameters / max(student_parameters, 1),
+        student_score - teacher_score))
+
+
+def main(args, train_args):
+    """ Sequence-level knowledge distillation: the teacher translates the training data, a smaller student is trained
+    on the translations, and both are compared on the test split. """
+    torch.manual_seed(args.seed)
+    utils.init_logging(args)
+    runtime.configure(args)
+
+    # The language pair and the dictionaries are those of the teacher
+    teacher = load_checkpoint(args.teacher_checkpoint)
+    args.source_lang, args.target_lang = teacher['args'].source_lang, teacher['args'].target_lang
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+
+    if 'distill' in args.stages:
+        with torch.inference_mode():
+            distill(args, teacher, src_dict, tgt_dict)
+    if 'train' in args.stages:
+        train_student(args, train_args)
+    if 'evaluate' in args.stages:
+        evaluate(args, teacher, src_dict, tgt_dict)
+
+
+if __name__ == '__main__':
+    args, train_args = get_args()
+    main(args, train_args)
@@ -1,5 +1,6 @@
 import argparse
 import collections
+import itertools
 import logging
 import os
 import sys
@@ -35,6 +36,8 @@ def get_args():
     parser.add_argument('--threshold-tgt', default=2, type=int,
                         help='map words appearing less than threshold times to unknown')
     parser.add_argument('--num-words-tgt', default=-1, type=int, help='number of target words to retain')
+    parser.add_argument('--num-shards', default=1, type=int,
+                        help='write the training data into N shards that train.py --streaming reads one at a time')
     return parser.parse_args()
 
 
@@ -52,7 +55,11 @@ def main(args):
     logging.info('Built a target dictionary ({}) with {} words'.format(args.target_lang, len(tgt_dict)))
 
     def make_split_datasets(lang, dictionary):
-        if args.train_prefix is not None:
+        if args.train_prefix is not None and args.num_shards > 1:
+            make_sharded_dataset(args.train_prefix + '.' + lang, [os.path.join(
+                args.dest_dir, 'train.{:03d}.{:s}'.format(shard_id, lang)) for shard_id in range(args.num_shards)],
+                dictionary)
+        elif args.train_prefix is not None:
             make_binary_dataset(args.train_prefix + '.' + lang, os.path.join(args.dest_dir, 'train.' + lang),
                                 dictionary)
         if args.tiny_train_prefix is not None:
@@ -73,7 +80,7 @@ def build_dictionary(filenames, tokenize=word_tokenize):
     for filename in filenames:
         with open(filename, 'r') as file:
             for line in file:
-                for symbol in word_tokenize(line.strip()):
+                for symbol in tokenize(line.strip()):
                     dictionary.add_word(symbol)
                 dictionary.add_word(dictionary.eos_word)
     return dictionary
@@ -90,7 +97,7 @@ def make_binary_dataset(input_file, output_file, dictionary, tokenize=word_token
     tokens_list = []
     with open(input_file, 'r') as inf:
         for line in inf:
-            tokens = dictionary.binarize(line.strip(), word_tokenize, append_eos, consumer=unk_consumer)
+            tokens = dictionary.binarize(line.strip(), tokenize, append_eos, consumer=unk_consumer)
             nsent, ntok = nsent + 1, ntok + len(tokens)
             tokens_list.append(tokens.numpy())
 
@@ -100,6 +107,36 @@ def make_binary_dataset(input_file, output_file, dictionary, tokenize=word_token
             input_file, nsent, ntok, 100.0 * sum(unk_counter.values()) / ntok, dictionary.unk_word))
 
 
+def make_sharded_dataset(input_file, output_files, dictionary, tokenize=word_tokenize, append_eos=True):
+    """ Like make_binary_dataset, but writes consecutive lines into len(output_files) shards of (almost) equal size.
+    Only one shard is held in memory at a time. """
+    with open(input_file, 'r') as inf:
+        num_lines = sum(1 for _ in inf)
+    # Shards of the source and target side hold the same lines, as both sides have the same number of lines
+    shard_sizes = [num_lines // len(output_files) + (1 if i < num_lines % len(output_files) else 0)
+                   for i in range(len(output_files))]
+
+    nsent, ntok = 0, 0
+    unk_counter = collections.Counter()
+
+    def unk_consumer(word, idx):
+        if idx == dictionary.unk_idx and word != dictionary.unk_word:
+            unk_counter.update([word])
+
+    with open(input_file, 'r') as inf:
+        for output_file, shard_size in zip(output_files, shard_sizes):
+            tokens_list = []
+            for line in itertools.islice(inf, shard_size):
+                tokens = dictionary.binarize(line.strip(), tokenize, append_eos, consumer=unk_consumer)
+                nsent, ntok = nsent + 1, ntok + len(tokens)
+                tokens_list.append(tokens.numpy())
+            with open(output_file, 'wb') as outf:
+                pickle.dump(tokens_list, outf, protocol=pickle.HIGHEST_PROTOCOL)
+
+    logging.info('Built a binary dataset for {} in {} shards: {} sentences, {} tokens, {:.3f}% replaced by unknown '
+                 'token'.format(input_file, len(output_files), nsent, ntok, 100.0 * sum(unk_counter.values()) / ntok))
+
+
 if __name__ == '__main__':
     args = get_args()
     utils.init_logging(args)
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+import torch
+from torch.serialization import default_restore_location
+
+from seq2seq import runtime, utils
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import Seq2SeqDataset, BatchSampler
+from seq2seq.scorer import SequenceScorer
+from translate import load_model
+
+
+def get_args():
+    """ Defines scoring-specific hyper-parameters. """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of scoring (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
+
+    # Add data arguments
+    parser.add_argument('--data', default=None,
+                        help='path to data directory (default: the data directory of the checkpoint)')
+    parser.add_argument('--split', default='test', help='preprocessed split of source/target pairs to score')
+    parser.add_argument('--checkpoint-path', default='checkpoints/checkpoint_best.pt', help='path to the model file')
+    parser.add_argument('--max-tokens', default=None, type=int,
+                        help='maximum number of tokens in a batch (default: 4096 if --batch-size is not given)')
+    parser.add_argument('--batch-size', default=None, type=int, help='maximum number of sentences in a batch')
+    parser.add_argument('--output', default=None, type=str, help='path to the output file (default: stdout)')
+    parser.add_argument('--print-attention', action='store_true', help='also output the attention weights')
+
+    # Add parallelization arguments
+    parser.add_argument('--num-workers', default=1, type=int, help='number of scoring processes')
+    parser.add_argument('--num-shards', default=1, type=int, help='split the data into N shards (e.g. one per job)')
+    parser.add_argument('--shard-id', default=0, type=int, help='id of the shard scored by this job')
+
+    return parser.parse_args()
+
+
+def format_result(result, tgt_dict):
+    """ Formats a scored sentence as one line of JSON. """
+    num_tokens = len(result['tokens'])
+    output = {
+        'id': result['id'],
+        'target': tgt_dict.string(result['tokens']),
+        'score': result['score'],
+        'avg_score': result['score'] / max(num_tokens, 1),
+        'positional_scores': [round(score, 4) for score in result['positional_scores'].tolist()],
+    }
+    if 'attention' in result:
+        output['attention'] = [[round(weight, 4) for weight in row] for row in result['attention'].tolist()]
+    return json.dumps(output, ensure_ascii=False)
+
+
+def load_dataset(args, src_dict, tgt_dict):
+    return Seq2SeqDataset(
+        src_file=os.path.join(args.data, '{:s}.{:s}'.format(args.split, args.source_lang)),
+        tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(args.split, args.target_lang)),
+        src_dict=src_dict, tgt_dict=tgt_dict)
+
+
+# Per-process scoring state of worker processes
+_worker = {}
+
+
+def init_worker(args, state_dict, core_slices=None):
+    """ Pins a worker process to its slice of the cores and loads the model and the dataset once. """
+    if core_slices is not None:
+        runtime.pin(core_slices.get(), args.num_threads)
+    src_dict, tgt_dict, model = load_model(args, state_dict)
+    _worker.update(args=args, tgt_dict=tgt_dict, dataset=load_dataset(args, src_dict, tgt_dict),
+                   scorer=SequenceScorer(model, tgt_dict))
+
+
+def score_batch(batch):
+    """ Collates and scores a batch of dataset indices in a worker, returning the formatted output lines. """
+    args, dataset = _worker['args'], _worker['dataset']
+    sample = dataset.collater([dataset[idx] for idx in batch])
+    if args.cuda:
+        sample = utils.move_to_cuda(sample)
+    with utils.autocast(args.precision, args.cuda):
+        results = _worker['scorer'].score(sample, need_attn=args.print_attention)
+    return [format_result(result, _worker['tgt_dict']) for result in results]
+
+
+def main(args):
+    """ Scores the source/target pairs of a preprocessed split and writes one JSON line per pair. """
+    from tqdm import tqdm
+    torch.manual_seed(args.seed)
+    state_dict = torch.load(args.checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
+    args = utils.merge_checkpoint_args(args, state_dict['args'])
+    if args.batch_size is None and args.max_tokens is None:
+        args.max_tokens = 4096
+    utils.init_logging(args)
+    runtime.configure(args)
+
+    # Only the dataset sizes are needed in the main process to build the batches of this shard
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    dataset = load_dataset(args, src_dict, tgt_dict)
+    batches = [batch for batch in BatchSampler(dataset, args.max_tokens, args.batch_size, args.num_shards,
+                                               args.shard_id, shuffle=False, seed=args.seed) if len(batch) > 0]
+    logging.info('Scoring {:d} sentence pairs in {:d} batches'.format(sum(len(b) for b in batches), len(batches)))
+
+    out_file = open(args.output, 'w') if args.output is not None else sys.stdout
+    try:
+        if args.num_workers <= 1:
+            init_worker(args, state_dict)
+            for batch in tqdm(batches, desc='| Scoring', leave=False):
+                out_file.writelines(line + '\n' for line in score_batch(batch))
+        else:
+            import multiprocessing
+            context = multiprocessing.get_context('spawn')
+            core_slices = context.Queue()
+            for cores in runtime.split_cores(runtime.available_cores(), args.num_workers):
+                core_slices.put(cores)
+            with context.Pool(args.num_workers, initializer=init_worker,
+                              initargs=(args, state_dict, core_slices)) as pool:
+                for lines in tqdm(pool.imap(score_batch, batches), total=len(batches), desc='| Scoring', leave=False):
+                    out_file.writelines(line + '\n' for line in lines)
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -0,0 +1,146 @@
+import argparse
+import collections
+import math
+import sys
+
+import numpy as np
+import torch
+
+
+BleuScore = collections.namedtuple('BleuScore', ['score', 'precisions', 'brevity_penalty', 'ratio', 'hyp_len', 'ref_len'])
+
+_ASCII_LOWERCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def format_score(bleu):
+    """ Formats a BleuScore the same way as multi-bleu.perl. """
+    return 'BLEU = {:.2f}, {:.1f}/{:.1f}/{:.1f}/{:.1f} (BP={:.3f}, ratio={:.3f}, hyp_len={:d}, ref_len={:d})'.format(
+        100 * bleu.score, *[100 * p for p in bleu.precisions], bleu.brevity_penalty, bleu.ratio, bleu.hyp_len,
+        bleu.ref_len)
+
+
+def encode(hypotheses, references, lowercase=False):
+    """ Maps hypotheses and references to arrays of token ids. Sentences are either strings, which are split on
+    whitespace (and optionally lower-cased like multi-bleu.perl -lc, which only lower-cases ASCII letters), or
+    sequences/tensors of token ids, which are used as they are. """
+    vocab = collections.defaultdict(lambda: len(vocab))
+
+    def encode_sentence(sentence):
+        if isinstance(sentence, str):
+            if lowercase:
+                sentence = sentence.translate(_ASCII_LOWERCASE)
+            return np.array([vocab[token] for token in sentence.split()], dtype=np.int64)
+        if torch.is_tensor(sentence):
+            sentence = sentence.cpu().numpy()
+        return np.asarray(sentence, dtype=np.int64).reshape(-1)
+
+    return [encode_sentence(s) for s in hypotheses], [encode_sentence(s) for s in references]
+
+
+def ngram_statistics(hypotheses, references, max_order=4):
+    """ Counts clipped n-gram matches and hypothesis n-grams per sentence and order for lists of token id arrays with
+    a single reference each. All sentences are processed at once: n-grams of increasing order are assigned dense ids
+    from the ids of their prefixes, and (sentence, n-gram) pairs are counted with np.unique. Returns arrays of shape
+    [num_sentences, max_order] (matches, totals) and [num_sentences] (hypothesis and reference lengths). """
+    assert len(hypotheses) == len(references), 'Number of hypotheses and references differ'
+    num_sentences = len(hypotheses)
+    hyp_lens = np.array([len(h) for h in hypotheses], dtype=np.int64)
+    ref_lens = np.array([len(r) for r in references], dtype=np.int64)
+    matches = np.zeros((num_sentences, max_order), dtype=np.int64)
+    totals = np.maximum(hyp_lens[:, None] - np.arange(max_order)[None, :], 0)
+
+    # Flatten all sentences (hypotheses first) and remember where each token belongs
+    lengths = np.concatenate([hyp_lens, ref_lens])
+    tokens = np.concatenate(list(hypotheses) + list(references)) if lengths.sum() > 0 else np.zeros(0, np.int64)
+    sentence_ids = np.repeat(np.arange(2 * num_sentences), lengths)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(len(tokens)) - offsets
+    is_hyp = sentence_ids < num_sentences
+    sentence_ids = sentence_ids % max(num_sentences, 1)
+
+    _, gram_ids = np.unique(tokens, return_inverse=True)
+    gram_ids = gram_ids.reshape(-1)
+    for order in range(1, max_order + 1):
+        if order > 1:
+            # Extend the (order - 1)-gram starting at each position by the token that follows it
+            valid = positions + order <= np.repeat(lengths, lengths)
+            next_tokens = np.concatenate([tokens[order - 1:], np.zeros(order - 1, np.int64)])[:len(tokens)]
+            _, next_ids = np.unique(next_tokens, return_inverse=True)
+            keys = gram_ids * (next_ids.max(initial=0) + 1) + next_ids.reshape(-1)
+            _, gram_ids = np.unique(np.where(valid, keys, -1), return_inverse=True)
+            gram_ids = gram_ids.reshape(-1)
+        else:
+            valid = np.ones(len(tokens), dtype=bool)
+
+        num_grams = gram_ids.max(initial=0) + 1
+        keys = sentence_ids * num_grams + gram_ids
+        hyp_keys, hyp_counts = np.unique(keys[valid & is_hyp], return_counts=True)
+        ref_keys, ref_counts = np.unique(keys[valid & ~is_hyp], return_counts=True)
+        common, hyp_idx, ref_idx = np.intersect1d(hyp_keys, ref_keys, assume_unique=True, return_indices=True)
+        clipped = np.minimum(hyp_counts[hyp_idx], ref_counts[ref_idx])
+        matches[:, order - 1] = np.bincount(common // num_grams, weights=clipped, minlength=num_sentences)
+
+    return matches, totals, hyp_lens, ref_lens
+
+
+def _bleu(matches, totals, hyp_len, ref_len):
+    precisions = [m / t if t > 0 else 0. for m, t in zip(matches, totals)]
+    if ref_len == 0:
+        # multi-bleu.perl reports every statistic as 0 if there are no reference words
+        return BleuScore(0., [0.] * len(precisions), 0., 0., 0, 0)
+    if hyp_len == 0:
+        return BleuScore(0., precisions, 0., 0., 0, int(ref_len))
+    brevity_penalty = math.exp(1 - ref_len / hyp_len) if hyp_len < ref_len else 1.
+    if min(precisions) == 0:
+        score = 0.
+    else:
+        score = brevity_penalty * math.exp(sum(math.log(p) for p in precisions) / len(precisions))
+    return BleuScore(score, precisions, brevity_penalty, hyp_len / ref_len, int(hyp_len), int(ref_len))
+
+
+def corpus_bleu(hypotheses, references, lowercase=False, max_order=4):
+    """ Computes corpus BLEU, matching multi-bleu.perl (with -lc if lowercase is set) for a single reference. """
+    return corpus_bleu_from_statistics(*ngram_statistics(*encode(hypotheses, references, lowercase), max_order))
+
+
+def corpus_bleu_from_statistics(matches, totals, hyp_lens, ref_lens):
+    """ Computes corpus BLEU from the per-sentence statistics of ngram_statistics (of any subset of sentences, or
+    concatenated over several calls). """
+    return _bleu(matches.sum(axis=0), totals.sum(axis=0), int(hyp_lens.sum()), int(ref_lens.sum()))
+
+
+def sentence_bleu(hypotheses, references, lowercase=False, smooth=True, max_order=4):
+    """ Computes BLEU for every sentence pair in one pass. With smooth=True, one is added to the matches and totals
+    of orders above one (Lin and Och, 2004), so that short sentences without a 4-gram match still get a score;
+    without smoothing, the scores equal running multi-bleu.perl on each sentence separately. """
+    return sentence_bleu_from_statistics(*ngram_statistics(*encode(hypotheses, references, lowercase), max_order),
+                                         smooth=smooth)
+
+
+def sentence_bleu_from_statistics(matches, totals, hyp_lens, ref_lens, smooth=True):
+    """ Computes sentence BLEU (see sentence_bleu) from the per-sentence statistics of ngram_statistics. """
+    if smooth:
+        matches, totals = matches.copy(), totals.copy()
+        matches[:, 1:] += 1
+        totals[:, 1:] += 1
+    return [_bleu(m, t, int(h), int(r)) for m, t, h, r in zip(matches, totals, hyp_lens, ref_lens)]
+
+
+def get_args():
+    parser = argparse.ArgumentParser('BLEU scorer compatible with multi-bleu.perl')
+    parser.add_argument('-lc', dest='lowercase', action='store_true', help='lower-case hypotheses and references')
+    parser.add_argument('--sentence', action='store_true', help='print smoothed sentence-level BLEU for every line')
+    parser.add_argument('reference', help='path to the reference file; hypotheses are read from stdin')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with open(args.reference) as ref_file:
+        references = [line.rstrip('\n') for line in ref_file]
+    hypotheses = [line.rstrip('\n') for line in sys.stdin]
+    if args.sentence:
+        for bleu in sentence_bleu(hypotheses, references, args.lowercase):
+            print(format_score(bleu))
+    else:
+        print(format_score(corpus_bleu(hypotheses, references, args.lowercase)))
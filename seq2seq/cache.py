@@ -0,0 +1,131 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+
+import numpy as np
+import torch
+
+
+def checkpoint_hash(checkpoint_path, chunk_size=1 << 20):
+    """ Hashes the contents of a checkpoint file, so that cached translations are tied to the model weights. """
+    sha1 = hashlib.sha1()
+    with open(checkpoint_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def format_cache_stats(stats):
+    """ Formats cache statistics (possibly summed over several caches), including the overall hit rate. """
+    hit_rate = 1. - stats['misses'] / max(stats['requests'], 1)
+    return ' | '.join(['{} {:d}'.format(key, value) for key, value in stats.items()] + ['hit_rate {:.3g}'.format(
+        hit_rate)])
+
+
+class TranslationCache(object):
+    """ Translation memory keyed by binarized source sentences. Recently used translations are kept in an in-process
+    LRU; if a path is given, all translations are also stored in an SQLite database that persists across runs and can
+    be shared between processes. Entries are namespaced by the checkpoint hash and the decoding settings, so that a
+    changed model or setting never returns stale translations. """
+
+    def __init__(self, checkpoint_hash, settings, capacity=100000, path=None):
+        self.namespace = checkpoint_hash + json.dumps(settings, sort_keys=True)
+        self.capacity = capacity
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.OrderedDict([
+            ('requests', 0), ('memory_hits', 0), ('disk_hits', 0), ('duplicates', 0), ('misses', 0)])
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS translations '
+                            '(namespace TEXT, source BLOB, translation TEXT, PRIMARY KEY (namespace, source))')
+            self.db.commit()
+
+    @staticmethod
+    def key(src_tokens):
+        if torch.is_tensor(src_tokens):
+            src_tokens = src_tokens.cpu().numpy()
+        return np.asarray(src_tokens, dtype=np.int64).tobytes()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+            if self.db is not None:
+                row = self.db.execute('SELECT translation FROM translations WHERE namespace = ? AND source = ?',
+                                      (self.namespace, key)).fetchone()
+                if row is not None:
+                    self.stats['disk_hits'] += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            return None
+
+    def lookup(self, src_tokens):
+        """ Returns the cached translation of a single sentence, or None (which is not counted as a miss, as the
+        sentence is expected to be passed to translate later on). """
+        translation = self.get(self.key(src_tokens))
+        if translation is not None:
+            with self.lock:
+                self.stats['requests'] += 1
+        return translation
+
+    def put(self, items):
+        """ Stores a list of (key, translation) pairs. """
+        with self.lock:
+            for key, translation in items:
+                self._remember(key, translation)
+            if self.db is not None and len(items) > 0:
+                self.db.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?)',
+                                    [(self.namespace, key, translation) for key, translation in items])
+                self.db.commit()
+
+    def _remember(self, key, translation):
+        if self.capacity <= 0:
+            return
+        self.memory[key] = translation
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def translate(self, src_sentences, translate_fn):
+        """ Returns translations for a list of binarized source sentences. translate_fn is only called (once) on the
+        distinct sentences that are not cached yet, and must return their translations in the same order. """
+        keys = [self.key(src_tokens) for src_tokens in src_sentences]
+        translations, novel, num_duplicates = {}, collections.OrderedDict(), 0
+        for key, src_tokens in zip(keys, src_sentences):
+            if key in translations or key in novel:
+                num_duplicates += 1
+                continue
+            translation = self.get(key)
+            if translation is not None:
+                translations[key] = translation
+            else:
+                novel[key] = src_tokens
+
+        with self.lock:
+            self.stats['requests'] += len(keys)
+            self.stats['duplicates'] += num_duplicates
+            self.stats['misses'] += len(novel)
+        if len(novel) > 0:
+            new_items = list(zip(novel.keys(), translate_fn(list(novel.values()))))
+            self.put(new_items)
+            translations.update(new_items)
+        return [translations[key] for key in keys]
+
+    def hit_rate(self):
+        return 1. - self.stats['misses'] / max(self.stats['requests'], 1)
+
+    def summary(self):
+        with self.lock:
+            return format_cache_stats(self.stats)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,36 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+class ChunkedCrossEntropyCriterion(nn.Module):
+    """ Summed cross-entropy over the non-padding target tokens, computed from the decoder features before the output
+    projection (see LSTMDecoder.forward with features_only=True). The projection and the loss are computed for
+    chunk_size target tokens at a time, and each chunk is recomputed during the backward pass, so that the full
+    [batch_size, tgt_time_steps, vocab_size] logit tensor is never materialized, neither forward nor backward. """
+
+    def __init__(self, output_layer, padding_idx, chunk_size=1024):
+        super().__init__()
+        self.output_layer = output_layer
+        self.padding_idx = padding_idx
+        self.chunk_size = chunk_size
+
+    def forward(self, features, tgt_tokens):
+        # Flatten the features to one row per target token and drop the padding rows
+        tgt_tokens = tgt_tokens.reshape(-1)
+        keep = tgt_tokens.ne(self.padding_idx).nonzero().squeeze(dim=1)
+        tgt_tokens = tgt_tokens.index_select(0, keep)
+        features = [feature.reshape(-1, feature.size(-1)).index_select(0, keep) for feature in features]
+
+        losses = []
+        for start in range(0, tgt_tokens.size(0), self.chunk_size):
+            chunk = [tgt_tokens[start:start + self.chunk_size]] + [f[start:start + self.chunk_size] for f in features]
+            if torch.is_grad_enabled():
+                losses.append(checkpoint(self._chunk_loss, *chunk, use_reentrant=False))
+            else:
+                losses.append(self._chunk_loss(*chunk))
+        return torch.stack(losses).sum() if len(losses) > 0 else features[0].new_zeros(())
+
+    def _chunk_loss(self, tgt_tokens, *features):
+        return F.cross_entropy(self.output_layer(*features), tgt_tokens, reduction='sum')
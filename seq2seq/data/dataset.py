@@ -1,23 +1,69 @@
 import itertools
 import math
+import os
+import re
 import numpy as np
 import pickle
 import torch
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torch.utils.data.sampler import Sampler
 
 
+class MMapTokens(object):
+    """ Token sequences stored as one flat array of tokens ({path}.bin.npy) and the offsets of the sequences in it
+    ({path}.idx.npy). The tokens are memory-mapped, so processes reading the same file share a single copy of it in
+    the page cache, and only the sequences that are accessed are read from disk. """
+
+    def __init__(self, path):
+        self.tokens = np.load(path + '.bin.npy', mmap_mode='r')
+        self.offsets = np.load(path + '.idx.npy')
+        self.sizes = np.diff(self.offsets)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.idx.npy')
+
+    @staticmethod
+    def write(tokens_list, path):
+        """ Writes a list of token arrays (e.g. a split written by preprocess.py) in the memory-mapped format. """
+        offsets = np.zeros(len(tokens_list) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in tokens_list], out=offsets[1:])
+        dtype = tokens_list[0].dtype if len(tokens_list) > 0 else np.int64
+        tokens = np.concatenate(tokens_list) if len(tokens_list) > 0 else np.zeros(0, dtype=dtype)
+        np.save(path + '.bin.npy', tokens.astype(dtype, copy=False))
+        np.save(path + '.idx.npy', offsets)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError('index {} is out of range'.format(index))
+        index = index % len(self)
+        return np.array(self.tokens[self.offsets[index]:self.offsets[index + 1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def load_tokens(path):
+    """ Loads the token sequences of a split, either memory-mapped (see MMapTokens) or pickled by preprocess.py. """
+    if MMapTokens.exists(path):
+        return MMapTokens(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def token_sizes(tokens_list):
+    return tokens_list.sizes if isinstance(tokens_list, MMapTokens) else np.array([len(t) for t in tokens_list])
+
+
 class Seq2SeqDataset(Dataset):
     def __init__(self, src_file, tgt_file, src_dict, tgt_dict):
         self.src_dict, self.src_dict = src_dict, tgt_dict
-        with open(src_file, 'rb') as f:
-            self.src_dataset = pickle.load(f)
-            self.src_sizes = np.array([len(tokens) for tokens in self.src_dataset])
+        self.src_dataset = load_tokens(src_file)
+        self.src_sizes = token_sizes(self.src_dataset)
 
-        with open(tgt_file, 'rb') as f:
-            self.tgt_dataset = pickle.load(f)
-            self.tgt_sizes = np.array([len(tokens) for tokens in self.tgt_dataset])
+        self.tgt_dataset = load_tokens(tgt_file)
+        self.tgt_sizes = token_sizes(self.tgt_dataset)
 
     def __getitem__(self, index):
         return {
@@ -68,6 +114,41 @@ class Seq2SeqDataset(Dataset):
         }
 
 
+def split_sample(sample, pad_idx, num_parts=2):
+    """ Splits a collated batch into num_parts batches of consecutive rows, removing the padding that is no longer
+    needed. As rows are sorted by descending source length, every part is sorted as well. """
+    parts = []
+    for rows in torch.arange(len(sample['src_lengths'])).chunk(num_parts):
+        src_len = int(sample['src_lengths'][rows].max())
+        tgt_tokens = sample['tgt_tokens'][rows]
+        tgt_len = int(tgt_tokens.ne(pad_idx).sum(dim=1).max())
+        parts.append({
+            'id': sample['id'][rows],
+            'src_tokens': sample['src_tokens'][rows, :src_len].contiguous(),
+            'src_lengths': sample['src_lengths'][rows],
+            'tgt_tokens': tgt_tokens[:, :tgt_len].contiguous(),
+            'tgt_inputs': sample['tgt_inputs'][rows, :tgt_len].contiguous(),
+            'num_tokens': int(tgt_tokens.ne(pad_idx).sum()),
+        })
+    return parts
+
+
+def batch_by_size(indices, tgt_sizes, max_tokens=float('Inf'), batch_size=float('Inf')):
+    """ Groups length-sorted indices into consecutive batches. A batch is closed once it holds batch_size sentences or
+    its padded target tokens exceed max_tokens. """
+    batches, batch, sample_len = [], [], 0
+    for idx in indices:
+        batch.append(idx)
+        sample_len = max(sample_len, tgt_sizes[idx])
+        num_tokens = len(batch) * sample_len
+        if len(batch) == batch_size or num_tokens > max_tokens:
+            batches.append(batch)
+            batch, sample_len = [], 0
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
 class BatchSampler(Sampler):
     def __init__(self, dataset, max_tokens=None, batch_size=None, num_shards=1, shard_id=0, shuffle=True, seed=42):
         self.dataset, self.shuffle, self.seed = dataset, shuffle, seed
@@ -95,18 +176,126 @@ class BatchSampler(Sampler):
         indices = np.random.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
         indices = indices[np.argsort(self.dataset.tgt_sizes[indices], kind='mergesort')]
         indices = indices[np.argsort(self.dataset.src_sizes[indices], kind='mergesort')]
+        batches = batch_by_size(indices, self.dataset.tgt_sizes, self.max_tokens, self.batch_size)
 
-        batches, batch, sample_len = [], [], 0
-        for idx in indices:
-            batch.append(idx)
-            sample_len = max(sample_len, self.dataset.tgt_sizes[idx])
-            num_tokens = len(batch) * sample_len
-            if len(batch) == self.batch_size or num_tokens > self.max_tokens:
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return batches
+
+
+class GenerationBatchSampler(Sampler):
+    """ Batches sentences for generation. Sentences are sorted by descending source length, and a batch is limited to
+    batch_size sentences and to max_tokens tokens, counting both the padded source length and the expected output
+    length (as long as the source, but at most max_len) of every sentence. """
+
+    def __init__(self, src_sizes, max_tokens=None, batch_size=None, max_len=25):
+        self.batch_size = batch_size if batch_size is not None else float('Inf')
+        self.max_tokens = max_tokens if max_tokens is not None else float('Inf')
+        self.max_len = max_len
+        self.batches = self._batch_generator(np.asarray(src_sizes))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def _batch_generator(self, src_sizes):
+        indices = np.argsort(-src_sizes, kind='mergesort')
+        batches, batch = [], []
+        for idx in indices.tolist():
+            # The first sentence of a batch is the longest one
+            longest = src_sizes[batch[0]] if len(batch) > 0 else src_sizes[idx]
+            num_tokens = (len(batch) + 1) * (longest + min(longest, self.max_len))
+            if len(batch) > 0 and (len(batch) == self.batch_size or num_tokens > self.max_tokens):
                 batches.append(batch)
-                batch, sample_len = [], 0
+                batch = []
+            batch.append(idx)
         if len(batch) > 0:
             batches.append(batch)
+        return batches
+
+
+def find_shards(data_dir, split, source_lang, target_lang):
+    """ Returns the (source, target) file pairs of the shards of a split written by preprocess.py --num-shards, i.e.
+    {split}.{shard}.{lang}, ordered by shard number. An unsharded split is a single shard. """
+    pattern = re.compile(r'^{:s}\.(\d+)\.{:s}(\.idx\.npy)?$'.format(re.escape(split), re.escape(source_lang)))
+    shard_ids = sorted(set(int(match.group(1)) for match in map(pattern.match, os.listdir(data_dir))
+                           if match is not None))
+    if len(shard_ids) == 0:
+        return [(os.path.join(data_dir, '{:s}.{:s}'.format(split, source_lang)),
+                 os.path.join(data_dir, '{:s}.{:s}'.format(split, target_lang)))]
+    return [(os.path.join(data_dir, '{:s}.{:03d}.{:s}'.format(split, shard_id, source_lang)),
+             os.path.join(data_dir, '{:s}.{:03d}.{:s}'.format(split, shard_id, target_lang))) for shard_id in shard_ids]
+
+
+class StreamingSeq2SeqDataset(IterableDataset):
+    """ Streams collated batches from the shards of a split without loading the whole split into memory. Only one shard
+    and a buffer of buffer_size sentences are held by every data loader worker at a time.
 
+    Every epoch, shards are read in a new order (the same on all ranks), and the shards are divided among the
+    num_replicas distributed ranks and then among the data loader workers of every rank. Sentences of a shard are read
+    in random order into the buffer; a full buffer is sorted by length, batched like BatchSampler and its batches are
+    yielded in random order. Ranks and workers yield as many batches as their shards make up, so shards should be of
+    similar size and at least as many as num_replicas times the number of workers. Sentence ids are positions within
+    their shard. """
+
+    def __init__(self, shards, src_dict, tgt_dict, max_tokens=None, batch_size=None, buffer_size=100000,
+                 shuffle=True, seed=42, num_replicas=None, rank=None):
+        self.shards = shards
+        self.src_dict, self.tgt_dict = src_dict, tgt_dict
+        self.batch_size = batch_size if batch_size is not None else float('Inf')
+        self.max_tokens = max_tokens if max_tokens is not None else float('Inf')
+        self.buffer_size, self.shuffle, self.seed = buffer_size, shuffle, seed
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        self.num_replicas, self.rank = num_replicas, rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """ Sets the epoch, which determines the order of shards, sentences and batches. """
+        self.epoch = epoch
+
+    # Batches are collated like those of a Seq2SeqDataset
+    collater = Seq2SeqDataset.collater
+
+    def __iter__(self):
+        shards = list(self.shards)
         if self.shuffle:
-            np.random.shuffle(batches)
-        return batches
+            np.random.RandomState([self.seed, self.epoch]).shuffle(shards)
+        worker = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        shards = shards[self.rank::self.num_replicas][worker_id::num_workers]
+
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+        buffer = []
+        for src_file, tgt_file in shards:
+            src_dataset, tgt_dataset = load_tokens(src_file), load_tokens(tgt_file)
+            assert len(src_dataset) == len(tgt_dataset), 'Shards {} and {} differ in length'.format(src_file, tgt_file)
+            order = rng.permutation(len(src_dataset)) if self.shuffle else range(len(src_dataset))
+            for index in order:
+                buffer.append({
+                    'id': int(index),
+                    'source': torch.LongTensor(src_dataset[index]),
+                    'target': torch.LongTensor(tgt_dataset[index]),
+                })
+                if len(buffer) == self.buffer_size:
+                    yield from self._batches(buffer, rng)
+                    buffer = []
+            del src_dataset, tgt_dataset
+        if len(buffer) > 0:
+            yield from self._batches(buffer, rng)
+
+    def _batches(self, buffer, rng):
+        src_sizes = np.array([sample['source'].numel() for sample in buffer])
+        tgt_sizes = np.array([sample['target'].numel() for sample in buffer])
+        indices = np.argsort(tgt_sizes, kind='mergesort')
+        indices = indices[np.argsort(src_sizes[indices], kind='mergesort')]
+        batches = batch_by_size(indices, tgt_sizes, self.max_tokens, self.batch_size)
+        if self.shuffle:
+            rng.shuffle(batches)
+        for batch in batches:
+            yield self.collater([buffer[idx] for idx in batch])
@@ -0,0 +1,69 @@
+import torch
+
+
+class SequenceGenerator(object):
+    """ Greedy auto-regressive decoder. The decoder state is carried over between time steps, either through the
+    model's incremental state or through a single-step inference module (see LSTMModel.build_step_module, possibly
+    loaded back with torch.jit.load), and sentences are dropped from the batch once they produce an end-of-sentence
+    token. """
+
+    def __init__(self, model, tgt_dict, max_len=25, step_module=None):
+        self.model = model
+        self.tgt_dict = tgt_dict
+        self.max_len = max_len
+        self.step_module = step_module
+
+    @torch.no_grad()
+    def generate(self, src_tokens, src_lengths):
+        """ Translates a batch of source sentences. Returns one tensor of target token ids per input row, without the
+        end-of-sentence token and truncated to max_len tokens. """
+        batch_size = src_tokens.size(0)
+        state = self._init_state(src_tokens, src_lengths)
+
+        tokens = src_tokens.new_full((batch_size, self.max_len), self.tgt_dict.pad_idx)
+        lengths = [self.max_len] * batch_size
+        active = torch.arange(batch_size, device=src_tokens.device)
+        prev_words = src_tokens.new_full((batch_size,), self.tgt_dict.eos_idx)
+
+        for step in range(self.max_len):
+            logits, state = self._step(prev_words, state)
+
+            # Suppress <UNK>s
+            _, next_candidates = torch.topk(logits, 2, dim=-1)
+            best_candidates = next_candidates[:, 0]
+            backoff_candidates = next_candidates[:, 1]
+            next_words = torch.where(best_candidates == self.tgt_dict.unk_idx, backoff_candidates, best_candidates)
+            tokens[active, step] = next_words
+
+            # Drop sentences that have just been completed from the batch
+            finished = next_words.eq(self.tgt_dict.eos_idx)
+            if finished.any():
+                for row in active[finished].tolist():
+                    lengths[row] = step
+                unfinished = (~finished).nonzero().squeeze(dim=1)
+                if unfinished.numel() == 0:
+                    break
+                active, next_words = active[unfinished], next_words[unfinished]
+                state = self._reorder_state(state, unfinished)
+            prev_words = next_words
+
+        return [tokens[row, :lengths[row]] for row in range(batch_size)]
+
+    def _init_state(self, src_tokens, src_lengths):
+        if self.step_module is not None:
+            return self.step_module.encode(src_tokens, src_lengths)
+        return self.model.encoder(src_tokens, src_lengths), {}
+
+    def _step(self, prev_words, state):
+        if self.step_module is not None:
+            return self.step_module.step(prev_words, state)
+        encoder_out, incremental_state = state
+        decoder_out, _ = self.model.decoder(prev_words.unsqueeze(dim=1), encoder_out, incremental_state)
+        return decoder_out[:, -1, :], state
+
+    def _reorder_state(self, state, new_order):
+        if self.step_module is not None:
+            return tuple(value.index_select(0, new_order) for value in state)
+        encoder_out, incremental_state = state
+        self.model.decoder.reorder_incremental_state(incremental_state, new_order)
+        return self.model.encoder.reorder_encoder_out(encoder_out, new_order), incremental_state
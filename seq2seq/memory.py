@@ -0,0 +1,177 @@
+import contextlib
+import ctypes
+import heapq
+import logging
+import os
+import threading
+
+import torch
+
+from seq2seq.data.dataset import split_sample
+
+
+def add_memory_args(parser):
+    """ Adds the memory telemetry options shared by training and generation. """
+    parser.add_argument('--log-memory', action='store_true',
+                        help='record the peak memory of every batch and log the batches with the largest peaks')
+    parser.add_argument('--max-memory', default=None, type=float,
+                        help='memory budget in MB; batches that are expected to exceed it are split into smaller '
+                             'batches (implies --log-memory)')
+
+
+def _load_malloc_trim():
+    try:
+        return ctypes.CDLL('libc.so.6').malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+
+_malloc_trim = _load_malloc_trim()
+
+
+def release_memory():
+    """ Returns the free memory of the heap to the operating system (glibc only), so that the resident set size is not
+    inflated by memory that earlier batches have freed. This walks the whole heap and is not free either. """
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+def current_memory(cuda=False):
+    """ Returns the resident memory of the process in MB (or the allocated CUDA memory). """
+    if cuda:
+        return torch.cuda.memory_allocated() / 2 ** 20
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def default_memory_limit(cuda=False):
+    """ Returns 80% of the memory that is available to the process, in MB. """
+    if cuda:
+        return 0.8 * torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory / 2 ** 20
+    with open('/proc/meminfo') as f:
+        meminfo = dict(line.split(':', 1) for line in f)
+    return 0.8 * (int(meminfo['MemAvailable'].split()[0]) / 2 ** 10 + current_memory())
+
+
+def training_cost(sample):
+    """ Number of padded source and target tokens of a batch, which training activations grow with. """
+    return sample['src_tokens'].numel() + sample['tgt_tokens'].numel()
+
+
+def generation_cost(sample, max_len):
+    """ Number of padded source tokens and expected output tokens of a batch (see GenerationBatchSampler). """
+    batch_size, src_len = sample['src_tokens'].size()
+    return batch_size * (src_len + min(src_len, max_len))
+
+
+class MemoryMonitor(object):
+    """ Records the peak memory of every step as its growth over the memory at the start of the step, together with the
+    shape of its batch (sentences, longest source, longest target). On the GPU, the peak allocated memory of the CUDA
+    caching allocator is used. On the CPU, where PyTorch keeps no allocator statistics, the resident set size is
+    sampled by a background thread while a step runs.
+
+    The peak of upcoming batches is predicted from the memory at the start of the leanest step and the memory per unit
+    of cost_fn(sample) of the step with the largest growth so far. With max_memory, batches that are expected to exceed
+    it are split into halves until they fit (or consist of a single sentence); before the first step, there is nothing
+    to predict from. On the CPU, free heap memory is released before steps that are expected to use more than
+    trim_fraction of max_memory, where memory freed by earlier steps would otherwise be counted in the base of the step
+    but not in its growth, and make the prediction of the batches that matter too low. """
+
+    def __init__(self, cost_fn, cuda=False, max_memory=None, num_worst=5, interval=0.005, trim_fraction=0.8):
+        self.cost_fn = cost_fn
+        self.cuda = cuda
+        self.max_memory = max_memory
+        self.num_worst = num_worst
+        self.interval = interval
+        self.trim_fraction = trim_fraction
+        self.memory_per_cost, self.max_growth, self.min_base = None, 0., float('inf')
+        self.reset()
+
+        self._peak = 0.
+        self._active = threading.Event()
+        self._closed = threading.Event()
+        if not cuda:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def reset(self):
+        """ Resets the statistics reported by summary (but not the calibration of the predictions). """
+        self.num_steps, self.num_splits, self.peak, self.peak_growth, self.worst = 0, 0, 0., 0., []
+
+    def _sample(self):
+        while not self._closed.is_set():
+            self._active.wait()
+            while self._active.is_set() and not self._closed.is_set():
+                self._peak = max(self._peak, current_memory())
+                self._closed.wait(self.interval)
+
+    @contextlib.contextmanager
+    def step(self, sample):
+        """ Measures the peak memory of the code run within the context on a batch. """
+        if not self.cuda and self.near_limit(sample):
+            release_memory()
+        base = current_memory(self.cuda)
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self._peak = base
+            self._active.set()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                peak = torch.cuda.max_memory_allocated() / 2 ** 20
+            else:
+                self._active.clear()
+                peak = max(self._peak, current_memory())
+            self._record(sample, base, peak)
+
+    def _record(self, sample, base, peak):
+        growth = peak - base
+        cost = self.cost_fn(sample)
+        self.min_base = min(self.min_base, base)
+        if growth > self.max_growth and cost > 0:
+            self.max_growth, self.memory_per_cost = growth, growth / cost
+        shape = (len(sample['src_tokens']), sample['src_tokens'].size(1), sample['tgt_tokens'].size(1))
+        self.num_steps += 1
+        self.peak = max(self.peak, peak)
+        self.peak_growth = max(self.peak_growth, growth)
+        # Keep the batches with the largest growth in a min-heap; the step number breaks ties
+        item = (growth, self.num_steps, peak, shape)
+        if len(self.worst) < self.num_worst:
+            heapq.heappush(self.worst, item)
+        else:
+            heapq.heappushpop(self.worst, item)
+
+    def predict(self, sample):
+        """ Returns the expected peak memory of a batch in MB, or None if no step has been measured yet. """
+        if self.memory_per_cost is None:
+            return None
+        return self.min_base + self.memory_per_cost * self.cost_fn(sample)
+
+    def near_limit(self, sample):
+        """ Returns whether a batch is expected to use more than trim_fraction of max_memory. """
+        expected = self.predict(sample) if self.max_memory is not None else None
+        return expected is not None and expected > self.trim_fraction * self.max_memory
+
+    def split(self, sample, pad_idx):
+        """ Splits a batch into a list of batches that are expected to fit into max_memory. """
+        expected = self.predict(sample) if self.max_memory is not None else None
+        if expected is None or expected <= self.max_memory or len(sample['src_tokens']) == 1:
+            return [sample]
+        if self.num_splits == 0:
+            logging.warning('Splitting a batch of shape {} that is expected to use {:.0f} MB (--max-memory {:.0f})'
+                            .format(tuple(sample['tgt_tokens'].size()), expected, self.max_memory))
+        self.num_splits += 1
+        return [part for half in split_sample(sample, pad_idx) for part in self.split(half, pad_idx)]
+
+    def summary(self):
+        """ Formats the peak memory, the number of split batches and the batches with the largest growth. """
+        worst = ', '.join('B={:d} src={:d} tgt={:d}: {:.0f} MB (+{:.0f})'.format(*shape, peak, growth)
+                          for growth, _, peak, shape in sorted(self.worst, reverse=True))
+        return 'peak {:.0f} MB (+{:.0f} in a step) | current {:.0f} MB | steps {:d} | splits {:d} | worst batches: {}' \
+            .format(self.peak, self.peak_growth, current_memory(self.cuda), self.num_steps, self.num_splits, worst)
+
+    def close(self):
+        self._closed.set()
+        self._active.set()
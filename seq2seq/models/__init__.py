@@ -1,12 +1,47 @@
 import importlib
 import os
+import re
 
 from .model import Seq2SeqModel, Seq2SeqEncoder, Seq2SeqDecoder
 
 
+class _LazyRegistry(dict):
+    """ Registry of architectures. Architectures registered by the modules of the models/ directory are listed (e.g. as
+    choices of --arch) before their module is imported, and the module is only imported when one of them is looked up.
+    """
+
+    def __missing__(self, arch_name):
+        # Import the module that registers the architecture, or all modules that are not imported yet if it was not
+        # found by scanning them
+        for module in [ARCH_MODULES[arch_name]] if arch_name in ARCH_MODULES else sorted(_LAZY_MODULES):
+            _import_module(module)
+        if not self.registered(arch_name):
+            raise KeyError(arch_name)
+        return dict.__getitem__(self, arch_name)
+
+    def __contains__(self, arch_name):
+        return self.registered(arch_name) or arch_name in ARCH_MODULES
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(dict.fromkeys(list(ARCH_MODULES) + list(dict.keys(self))))
+
+    def registered(self, arch_name):
+        return dict.__contains__(self, arch_name)
+
+
 MODEL_REGISTRY = {}
-ARCH_MODEL_REGISTRY = {}
-ARCH_CONFIG_REGISTRY = {}
+ARCH_MODEL_REGISTRY = _LazyRegistry()
+ARCH_CONFIG_REGISTRY = _LazyRegistry()
+
+# Modules of the models/ directory by the names of the models and architectures they register, found by scanning their
+# source (see _scan_module) when this package is imported. These modules are only imported when one of their models or
+# architectures is looked up
+MODEL_MODULES = {}
+ARCH_MODULES = {}
+_LAZY_MODULES = set()
 
 
 def build_model(args, src_dict, tgt_dict):
@@ -28,9 +63,11 @@ def register_model(name):
 def register_model_architecture(model_name, arch_name):
     """Decorator to register a new model architecture."""
     def register_model_arch_fn(fn):
+        if model_name not in MODEL_REGISTRY and model_name in MODEL_MODULES:
+            _import_module(MODEL_MODULES[model_name])
         if model_name not in MODEL_REGISTRY:
             raise ValueError('Cannot register model architecture for unknown model type {}'.format(model_name))
-        if arch_name in ARCH_MODEL_REGISTRY:
+        if ARCH_MODEL_REGISTRY.registered(arch_name):
             raise ValueError('Cannot register duplicate model architecture {}'.format(arch_name))
         if not callable(fn):
             raise ValueError('Model architecture must be callable {}'.format(arch_name))
@@ -40,8 +77,42 @@ def register_model_architecture(model_name, arch_name):
     return register_model_arch_fn
 
 
-# Automatically import any Python files in the models/ directory
-for file in os.listdir(os.path.dirname(__file__)):
+# Calls of the functions above in the source of a module, and the string literals they are expected to be called with
+_REGISTER_CALL = re.compile(r'\bregister_model(_architecture)?\s*\(([^()]*)\)')
+_STRING_LITERAL = re.compile(r'''\s*(['"])(\w+)\1\s*$''')
+
+
+def _scan_module(path):
+    """ Returns the names of the models and of the architectures that a module registers, or None if it registers any
+    under names that are not string literals (and which are thus only known once the module is imported). """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    model_names, arch_names = [], []
+    for match in _REGISTER_CALL.finditer(source):
+        names = [_STRING_LITERAL.match(argument) for argument in match.group(2).split(',')]
+        if len(names) != (2 if match.group(1) else 1) or not all(names):
+            return None
+        (arch_names if match.group(1) else model_names).append(names[-1].group(2))
+    return model_names, arch_names
+
+
+def _import_module(module):
+    _LAZY_MODULES.discard(module)
+    importlib.import_module('seq2seq.models.' + module)
+
+
+# Import the modules of the models/ directory that do not register any models or architectures, or that register some
+# which cannot be found by scanning their source, right away, and all other modules when they are first needed
+_eager_modules = []
+for file in sorted(os.listdir(os.path.dirname(__file__))):
     if file.endswith('.py') and not file.startswith('_'):
-        module = file[:file.find('.py')]
-        importlib.import_module('seq2seq.models.' + module)
+        module = file[:-len('.py')]
+        names = _scan_module(os.path.join(os.path.dirname(__file__), file))
+        if names is None or not any(names):
+            _eager_modules.append(module)
+            continue
+        MODEL_MODULES.update(dict.fromkeys(names[0], module))
+        ARCH_MODULES.update(dict.fromkeys(names[1], module))
+        _LAZY_MODULES.add(module)
+for module in _eager_modules:
+    importlib.import_module('seq2seq.models.' + module)
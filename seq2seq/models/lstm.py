@@ -2,11 +2,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch import Tensor
+from torch.utils.checkpoint import checkpoint
+from typing import Tuple
+
 from seq2seq import utils
 from seq2seq.models import Seq2SeqModel, Seq2SeqEncoder, Seq2SeqDecoder
 from seq2seq.models import register_model, register_model_architecture
 
 import logging
+
+# Flat decoder state used by LSTMStep: (hidden, cell, input_feed, src_out, projected_src_out, src_mask, src_embeddings)
+StepState = Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]
+
+
 @register_model('lstm')
 class LSTMModel(Seq2SeqModel):
     """ Defines the sequence-to-sequence model class. """
@@ -25,8 +34,8 @@ class LSTMModel(Seq2SeqModel):
         parser.add_argument('--encoder-hidden-size', type=int, help='encoder hidden size')
         parser.add_argument('--encoder-num-layers', type=int, help='number of encoder layers')
         parser.add_argument('--encoder-bidirectional', help='bidirectional encoder')
-        parser.add_argument('--encoder-dropout-in', help='dropout probability for encoder input embedding')
-        parser.add_argument('--encoder-dropout-out', help='dropout probability for encoder output')
+        parser.add_argument('--encoder-dropout-in', type=float, help='dropout probability for encoder input embedding')
+        parser.add_argument('--encoder-dropout-out', type=float, help='dropout probability for encoder output')
 
         parser.add_argument('--decoder-embed-dim', type=int, help='decoder embedding dimension')
         parser.add_argument('--decoder-embed-path', help='path to pre-trained decoder embedding')
@@ -36,6 +45,14 @@ class LSTMModel(Seq2SeqModel):
         parser.add_argument('--decoder-dropout-out', type=float, help='dropout probability for decoder output')
         parser.add_argument('--decoder-use-attention', help='decoder attention')
         parser.add_argument('--decoder-use-lexical-model', help='toggle for the lexical model')
+        parser.add_argument('--decoder-input-feeding', help='feed attention outputs back into the decoder LSTM')
+        parser.add_argument('--decoder-shrink-batch',
+                            help='skip padded target positions by shrinking the active batch as targets finish')
+        parser.add_argument('--decoder-checkpoint-steps', type=int,
+                            help='recompute the decoder recurrence in chunks of N time steps during the backward pass '
+                                 'to save activation memory (0 disables checkpointing)')
+        parser.add_argument('--decoder-output-rank', type=int,
+                            help='factorize the output projections into a rank-r bottleneck (0 uses full rank)')
 
     @classmethod
     def build_model(cls, args, src_dict, tgt_dict):
@@ -55,7 +72,7 @@ class LSTMModel(Seq2SeqModel):
                               embed_dim=args.encoder_embed_dim,
                               hidden_size=args.encoder_hidden_size,
                               num_layers=args.encoder_num_layers,
-                              bidirectional=args.encoder_bidirectional,
+                              bidirectional=bool(eval(args.encoder_bidirectional)),
                               dropout_in=args.encoder_dropout_in,
                               dropout_out=args.encoder_dropout_out,
                               pretrained_embedding=encoder_pretrained_embedding)
@@ -69,9 +86,19 @@ class LSTMModel(Seq2SeqModel):
                               dropout_out=args.decoder_dropout_out,
                               pretrained_embedding=decoder_pretrained_embedding,
                               use_attention=bool(eval(args.decoder_use_attention)),
-                              use_lexical_model=bool(eval(args.decoder_use_lexical_model)))
+                              use_lexical_model=bool(eval(args.decoder_use_lexical_model)),
+                              shrink_batch=bool(eval(args.decoder_shrink_batch)),
+                              input_feeding=bool(eval(args.decoder_input_feeding)),
+                              checkpoint_steps=args.decoder_checkpoint_steps,
+                              output_rank=args.decoder_output_rank)
         return cls(encoder, decoder)
 
+    def build_step_module(self, script=True):
+        """ Builds a single-step inference module sharing this model's parameters, optionally compiled with
+        TorchScript so that it can be saved with torch.jit.save and served without the Python model code. """
+        step_module = LSTMStep(self).eval()
+        return torch.jit.script(step_module) if script else step_module
+
 
 class LSTMEncoder(Seq2SeqEncoder):
     """ Defines the encoder class. """
@@ -155,6 +182,13 @@ class LSTMEncoder(Seq2SeqEncoder):
                 'src_out': (lstm_output, final_hidden_states, final_cell_states),
                 'src_mask': src_mask if src_mask.any() else None}
 
+    def reorder_encoder_out(self, encoder_out, new_order):
+        """ Selects the rows given by new_order from the encoder output (e.g. to drop finished sentences). """
+        return {'src_embeddings': encoder_out['src_embeddings'].index_select(1, new_order),
+                'src_out': tuple(out.index_select(1, new_order) for out in encoder_out['src_out']),
+                'src_mask': encoder_out['src_mask'].index_select(0, new_order)
+                if encoder_out['src_mask'] is not None else None}
+
 
 class AttentionLayer(nn.Module):
     """ Defines the attention layer class. Uses Luong's global attention with the general scoring function. """
@@ -165,14 +199,18 @@ class AttentionLayer(nn.Module):
         self.context_plus_hidden_projection = nn.Linear(input_dims + output_dims, output_dims, bias=False)
 
     def forward(self, tgt_input, encoder_out, src_mask):
-        # tgt_input has shape = [batch_size, input_dims]
+        # tgt_input has shape = [batch_size, input_dims] for a single decoder step, or
+        # [batch_size, tgt_time_steps, input_dims] when attending from all target positions at once
         # encoder_out has shape = [src_time_steps, batch_size, output_dims]
         # src_mask has shape = [src_time_steps, batch_size]
+        single_step = tgt_input.dim() == 2
+        if single_step:
+            tgt_input = tgt_input.unsqueeze(dim=1)
 
         # Get attention scores
         encoder_out = encoder_out.transpose(1, 0)
         attn_scores = self.score(tgt_input, encoder_out)
-        # (batch, 1, time)
+        # (batch, tgt_time, src_time)
         '''
         ___QUESTION-1-DESCRIBE-B-START___
         Describe how the attention context vector is calculated. 
@@ -193,17 +231,19 @@ class AttentionLayer(nn.Module):
             src_mask = src_mask.unsqueeze(dim=1)
             attn_scores.masked_fill_(src_mask, float('-inf'))
         attn_weights = F.softmax(attn_scores, dim=-1)
-        attn_context = torch.bmm(attn_weights, encoder_out).squeeze(dim=1)
+        attn_context = torch.bmm(attn_weights, encoder_out)
 
-        # (batch, 1, time), (batch, time, output_dim) -> (batch, 1, output_dim)
+        # (batch, tgt_time, src_time), (batch, src_time, output_dim) -> (batch, tgt_time, output_dim)
 
-        context_plus_hidden = torch.cat([tgt_input, attn_context], dim=1)
+        context_plus_hidden = torch.cat([tgt_input, attn_context], dim=2)
         attn_out = torch.tanh(self.context_plus_hidden_projection(context_plus_hidden))
 
         '''___QUESTION-1-DESCRIBE-B-END___'''
         # first: next input_feed, transformation of [target hidden vector, context vector]
         # second: softmax-normalized attention weights
-        return attn_out, attn_weights.squeeze(dim=1)
+        if single_step:
+            return attn_out.squeeze(dim=1), attn_weights.squeeze(dim=1)
+        return attn_out, attn_weights
 
     def score(self, tgt_input, encoder_out):
         """ Computes attention scores. """
@@ -223,13 +263,22 @@ class AttentionLayer(nn.Module):
         # encoder_out: (batch, time, output_dim)
         projected_encoder_out = self.src_projection(encoder_out).transpose(2, 1)
         # (batch, time, input_dims) -> (batch, input_dims, time)
-        attn_scores = torch.bmm(tgt_input.unsqueeze(dim=1), projected_encoder_out)
-        # (batch, 1, input_dims), (batch, input_dims, time) -> (batch, 1, time)
+        attn_scores = torch.bmm(tgt_input, projected_encoder_out)
+        # (batch, tgt_time, input_dims), (batch, input_dims, src_time) -> (batch, tgt_time, src_time)
         '''___QUESTION-1-DESCRIBE-C-END___'''
 
         return attn_scores
 
 
+def OutputProjection(in_features, out_features, rank=0):
+    """ Linear projection to the vocabulary. With 0 < rank < in_features, the projection is factorized into a
+    projection to rank features (without bias) followed by a projection to the vocabulary, which reduces the
+    parameters and multiply-adds per token from in_features * out_features to rank * (in_features + out_features). """
+    if 0 < rank < in_features:
+        return nn.Sequential(nn.Linear(in_features, rank, bias=False), nn.Linear(rank, out_features))
+    return nn.Linear(in_features, out_features)
+
+
 class LSTMDecoder(Seq2SeqDecoder):
     """ Defines the decoder class. """
 
@@ -242,7 +291,11 @@ class LSTMDecoder(Seq2SeqDecoder):
                  dropout_out=0.25,
                  pretrained_embedding=None,
                  use_attention=True,
-                 use_lexical_model=False):
+                 use_lexical_model=False,
+                 shrink_batch=False,
+                 input_feeding=True,
+                 checkpoint_steps=0,
+                 output_rank=0):
 
         super().__init__(dictionary)
 
@@ -250,6 +303,8 @@ class LSTMDecoder(Seq2SeqDecoder):
         self.dropout_out = dropout_out
         self.embed_dim = embed_dim
         self.hidden_size = hidden_size
+        self.shrink_batch = shrink_batch
+        self.checkpoint_steps = checkpoint_steps
 
         if pretrained_embedding is not None:
             self.embedding = pretrained_embedding
@@ -259,22 +314,32 @@ class LSTMDecoder(Seq2SeqDecoder):
         # Define decoder layers and modules
         self.attention = AttentionLayer(hidden_size, hidden_size) if use_attention else None
 
-        self.layers = nn.ModuleList([nn.LSTMCell(
-            input_size=hidden_size + embed_dim if layer == 0 else hidden_size,
-            hidden_size=hidden_size)
-            for layer in range(num_layers)])
+        self.input_feeding = input_feeding
+        if self.input_feeding:
+            self.layers = nn.ModuleList([nn.LSTMCell(
+                input_size=hidden_size + embed_dim if layer == 0 else hidden_size,
+                hidden_size=hidden_size)
+                for layer in range(num_layers)])
+        else:
+            # Without input feeding, the whole recurrent stack can run as a single cuDNN / MKL-DNN LSTM call
+            self.lstm = nn.LSTM(input_size=embed_dim,
+                                hidden_size=hidden_size,
+                                num_layers=num_layers,
+                                dropout=dropout_out if num_layers > 1 else 0.)
 
-        self.final_projection = nn.Linear(hidden_size, len(dictionary))
+        self.final_projection = OutputProjection(hidden_size, len(dictionary), output_rank)
 
         self.use_lexical_model = use_lexical_model
         if self.use_lexical_model:
             # __QUESTION: Add parts of decoder architecture corresponding to the LEXICAL MODEL here
             self.W_lexical_embed = nn.Linear(embed_dim, embed_dim, bias=False)
-            self.W_lexical_output = nn.Linear(embed_dim, len(dictionary))
+            self.W_lexical_output = OutputProjection(embed_dim, len(dictionary), output_rank)
             # TODO: --------------------------------------------------------------------- /CUT
 
-    def forward(self, tgt_inputs, encoder_out, incremental_state=None):
-        """ Performs the forward pass through the instantiated model. """
+    def forward(self, tgt_inputs, encoder_out, incremental_state=None, need_attn=True, features_only=False):
+        """ Performs the forward pass through the instantiated model. With need_attn=False, no attention weights
+        are collected across time steps and None is returned in their place. With features_only=True, the inputs of
+        output_layer are returned as a tuple instead of the vocabulary logits. """
         # Optionally, feed decoder input token-by-token
         if incremental_state is not None:
             tgt_inputs = tgt_inputs[:, -1:]
@@ -286,7 +351,17 @@ class LSTMDecoder(Seq2SeqDecoder):
 
         src_out, src_hidden_states, src_cell_states = encoder_out['src_out']
         src_mask = encoder_out['src_mask']
-        src_time_steps = src_out.size(0)
+
+        # Optionally order rows by descending target length, so that finished targets can be dropped from the batch
+        tgt_lengths, step_sizes, sort_order = None, None, None
+        if self.shrink_batch and incremental_state is None:
+            tgt_lengths, sort_order = tgt_inputs.ne(self.dictionary.pad_idx).long().sum(dim=1).sort(descending=True)
+            step_sizes = (torch.arange(tgt_inputs.size(1), device=tgt_lengths.device).unsqueeze(1) <
+                          tgt_lengths.unsqueeze(0)).sum(dim=1).tolist()
+            tgt_inputs = tgt_inputs.index_select(0, sort_order)
+            src_embeddings = src_embeddings.index_select(1, sort_order)
+            src_out = src_out.index_select(1, sort_order)
+            src_mask = src_mask.index_select(0, sort_order) if src_mask is not None else None
 
         # Embed target tokens and apply dropout
         batch_size, tgt_time_steps = tgt_inputs.size()
@@ -296,6 +371,68 @@ class LSTMDecoder(Seq2SeqDecoder):
         # Transpose batch: [batch_size, tgt_time_steps, num_features] -> [tgt_time_steps, batch_size, num_features]
         tgt_embeddings = tgt_embeddings.transpose(0, 1)
 
+        if self.input_feeding:
+            decoder_output, attn_weights, weighted_embeddings = self._input_feeding_forward(
+                tgt_embeddings, src_embeddings, src_out, src_mask, step_sizes, incremental_state, need_attn)
+        else:
+            decoder_output, attn_weights, weighted_embeddings = self._fused_forward(
+                tgt_embeddings, src_embeddings, src_out, src_mask, tgt_lengths, incremental_state, need_attn)
+
+        # Restore the original row order if it was changed above
+        if sort_order is not None:
+            inverse_order = sort_order.argsort()
+            decoder_output = decoder_output.index_select(0, inverse_order)
+            attn_weights = attn_weights.index_select(0, inverse_order) if attn_weights is not None else None
+
+        # Optionally return the features before the output projection (e.g. for a chunked loss, see output_layer)
+        if self.use_lexical_model and sort_order is not None:
+            weighted_embeddings = weighted_embeddings.index_select(0, inverse_order)
+        features = (decoder_output, weighted_embeddings) if self.use_lexical_model else (decoder_output,)
+        if features_only:
+            return features, attn_weights
+
+        decoder_output = self.output_layer(*features)
+        return decoder_output, attn_weights
+
+    def output_layer(self, decoder_output, weighted_embeddings=None):
+        """ Projects decoder features of any leading shape to vocabulary logits. """
+        # Final projection
+        decoder_output = self.final_projection(decoder_output)
+
+        if self.use_lexical_model:
+            # __QUESTION: Incorporate the LEXICAL MODEL into the prediction of target tokens here
+            # (batch, timesteps, hidden)
+            activated_weighted_embeddings = F.tanh(weighted_embeddings)
+
+            # logging.info(weighted_embeddings.size())
+            # (batch, timesteps, embed)
+            lexical_hidden = F.tanh(self.W_lexical_embed(activated_weighted_embeddings))+activated_weighted_embeddings
+            decoder_output += self.W_lexical_output(lexical_hidden)
+            # TODO: --------------------------------------------------------------------- /CUT
+
+        return decoder_output
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        """ Selects the rows given by new_order from the cached decoder state. """
+        super().reorder_incremental_state(incremental_state, new_order)
+        cached_state = utils.get_incremental_state(self, incremental_state, 'cached_state')
+        if cached_state is None:
+            return
+        if self.input_feeding:
+            tgt_hidden_states, tgt_cell_states, input_feed = cached_state
+            cached_state = ([state.index_select(0, new_order) for state in tgt_hidden_states],
+                            [state.index_select(0, new_order) for state in tgt_cell_states],
+                            input_feed.index_select(0, new_order))
+        else:
+            cached_state = tuple(state.index_select(1, new_order) for state in cached_state)
+        utils.set_incremental_state(self, incremental_state, 'cached_state', cached_state)
+
+    def _input_feeding_forward(self, tgt_embeddings, src_embeddings, src_out, src_mask, step_sizes,
+                               incremental_state, need_attn):
+        """ Runs the decoder one time step at a time, feeding the attention output back into the recurrence. """
+        tgt_time_steps, batch_size, _ = tgt_embeddings.size()
+        src_time_steps = src_out.size(0)
+
         # Initialize previous states (or retrieve from cache during incremental generation)
         '''
         ___QUESTION-1-DESCRIBE-D-START___
@@ -315,28 +452,78 @@ class LSTMDecoder(Seq2SeqDecoder):
             tgt_hidden_states, tgt_cell_states, input_feed = cached_state
         else:
             # tgt_hidden_states = [torch.zeros(tgt_inputs.size()[0], self.hidden_size) for i in range(len(self.layers))]
-            tgt_hidden_states = [src_embeddings.new_full((tgt_inputs.size()[0], self.hidden_size),0)
+            tgt_hidden_states = [src_embeddings.new_full((batch_size, self.hidden_size),0)
                                  for _ in range(len(self.layers))]
             # tgt_inputs: (batch_size, time_steps)
             # tgt_cell_states = [torch.zeros(tgt_inputs.size()[0], self.hidden_size) for i in range(len(self.layers))]
-            tgt_cell_states = [src_embeddings.new_full((tgt_inputs.size()[0], self.hidden_size),fill_value=0)
+            tgt_cell_states = [src_embeddings.new_full((batch_size, self.hidden_size),fill_value=0)
                                for _ in range(len(self.layers))]
             # print(tgt_hidden_states[0].device, tgt_cell_states[0].device)
             input_feed = tgt_embeddings.data.new(batch_size, self.hidden_size).zero_()
             # tgt_embedding: (time_steps, batch_size, num_features)
         '''___QUESTION-1-DESCRIBE-D-END___'''
 
-        # Initialize attention output node
-        attn_weights = tgt_embeddings.data.new(batch_size, tgt_time_steps, src_time_steps).zero_()
-        rnn_outputs = []
+        # Optionally recompute the recurrence in chunks of checkpoint_steps time steps during the backward pass
+        # instead of keeping the activations of every step (dropout masks are replayed, so gradients are unchanged)
+        if self.checkpoint_steps > 0 and self.training and torch.is_grad_enabled() and incremental_state is None:
+            rnn_outputs, step_attn_weights, lexical_contexts = [], [], []
+            for start in range(0, tgt_time_steps, self.checkpoint_steps):
+                steps = range(start, min(start + self.checkpoint_steps, tgt_time_steps))
+                chunk_outputs, chunk_attn_weights, chunk_lexical_contexts, tgt_hidden_states, tgt_cell_states, \
+                    input_feed = checkpoint(self._decode_steps, steps, tgt_embeddings, src_embeddings, src_out,
+                                            src_mask, step_sizes, tgt_hidden_states, tgt_cell_states, input_feed,
+                                            need_attn, use_reentrant=False, preserve_rng_state=True)
+                rnn_outputs.extend(chunk_outputs)
+                step_attn_weights.extend(chunk_attn_weights)
+                lexical_contexts.extend(chunk_lexical_contexts)
+        else:
+            rnn_outputs, step_attn_weights, lexical_contexts, tgt_hidden_states, tgt_cell_states, input_feed = \
+                self._decode_steps(range(tgt_time_steps), tgt_embeddings, src_embeddings, src_out, src_mask,
+                                   step_sizes, tgt_hidden_states, tgt_cell_states, input_feed, need_attn)
+
+        # Cache previous states (only used during incremental, auto-regressive generation)
+        utils.set_incremental_state(
+            self, incremental_state, 'cached_state', (tgt_hidden_states, tgt_cell_states, input_feed))
+
+        # Collect outputs across time steps
+        decoder_output = torch.cat(rnn_outputs, dim=0).view(tgt_time_steps, batch_size, self.hidden_size)
+
+        # Transpose batch back: [tgt_time_steps, batch_size, num_features] -> [batch_size, tgt_time_steps, num_features]
+        decoder_output = decoder_output.transpose(0, 1)
+
+        # Collect attention weights across time steps: (batch, timesteps, src_timesteps)
+        attn_weights = None
+        if need_attn:
+            attn_weights = torch.stack(step_attn_weights, dim=1) if len(step_attn_weights) > 0 else \
+                tgt_embeddings.new_zeros(batch_size, tgt_time_steps, src_time_steps)
+
+        # Collect lexical context vectors across time steps: (batch, timesteps, embed)
+        weighted_embeddings = torch.cat(lexical_contexts, 1) if self.use_lexical_model else None
+        return decoder_output, attn_weights, weighted_embeddings
+
+    def _decode_steps(self, steps, tgt_embeddings, src_embeddings, src_out, src_mask, step_sizes, tgt_hidden_states,
+                      tgt_cell_states, input_feed, need_attn):
+        """ Runs the input-feeding recurrence over the given time steps. Returns the per-step outputs, attention
+        weights and lexical contexts (zero-padded to the full batch), and the recurrent states after the last step. """
+        batch_size = tgt_embeddings.size(1)
+        # The input lists must stay untouched, as they are reused when the steps are recomputed under checkpointing
+        tgt_hidden_states, tgt_cell_states = list(tgt_hidden_states), list(tgt_cell_states)
+        rnn_outputs, step_attn_weights = [], []
 
         # __QUESTION : Following code is to assist with the LEXICAL MODEL implementation
         # Cache lexical context vectors per translation time-step
         lexical_contexts = []
 
-        for j in range(tgt_time_steps):
+        for j in steps:
+            # Only rows whose target has not finished yet take part in this time step (similar to a PackedSequence)
+            step_size = step_sizes[j] if step_sizes is not None else batch_size
+            if step_size < input_feed.size(0):
+                tgt_hidden_states = [state[:step_size] for state in tgt_hidden_states]
+                tgt_cell_states = [state[:step_size] for state in tgt_cell_states]
+                input_feed = input_feed[:step_size]
+
             # Concatenate the current token embedding with output from previous time step (i.e. 'input feeding')
-            lstm_input = torch.cat([tgt_embeddings[j, :, :], input_feed], dim=1)
+            lstm_input = torch.cat([tgt_embeddings[j, :step_size, :], input_feed], dim=1)
 
             for layer_id, rnn_layer in enumerate(self.layers):
                 # Pass target input through the recurrent layer(s)
@@ -367,52 +554,159 @@ class LSTMDecoder(Seq2SeqDecoder):
             if self.attention is None:
                 input_feed = tgt_hidden_states[-1]
             else:
-                input_feed, step_attn_weights = self.attention(tgt_hidden_states[-1], src_out, src_mask)
-                attn_weights[:, j, :] = step_attn_weights
+                input_feed, attn_step = self.attention(
+                    tgt_hidden_states[-1], src_out[:, :step_size],
+                    src_mask[:step_size] if src_mask is not None else None)
+                if need_attn:
+                    step_attn_weights.append(F.pad(attn_step, [0, 0, 0, batch_size - step_size]))
                 # attn_weight: (batch_size, tgt_time_step, src_time_step)
                 if self.use_lexical_model:
                     # __QUESTION: Compute and collect LEXICAL MODEL context vectors here
                     # TODO: --------------------------------------------------------------------- CUT
                     # unsqueeze: (batch, timesteps) -> (batch, 1 ,timesteps)
                     # transpose: (timesteps, batch, hidden) -> (batch, timesteps, hidden)
-                    lexical_contexts.append(
-                            torch.matmul(torch.unsqueeze(step_attn_weights,1),
-                                         src_embeddings.transpose(0,1)))
+                    lexical_contexts.append(F.pad(
+                            torch.matmul(torch.unsqueeze(attn_step,1),
+                                         src_embeddings[:, :step_size].transpose(0,1)),
+                            [0, 0, 0, 0, 0, batch_size - step_size]))
                     # logging.info(lexical_contexts[0].size())
 
                     # TODO: --------------------------------------------------------------------- /CUT
 
             input_feed = F.dropout(input_feed, p=self.dropout_out, training=self.training)
-            rnn_outputs.append(input_feed)
+            # Outputs of finished rows are zero-padded; the loss ignores these positions through ignore_index
+            rnn_outputs.append(F.pad(input_feed, [0, 0, 0, batch_size - step_size]))
             '''___QUESTION-1-DESCRIBE-E-END___'''
 
+        return rnn_outputs, step_attn_weights, lexical_contexts, tgt_hidden_states, tgt_cell_states, input_feed
+
+    def _fused_forward(self, tgt_embeddings, src_embeddings, src_out, src_mask, tgt_lengths, incremental_state,
+                       need_attn):
+        """ Runs the recurrent stack and attention over all target time steps at once (no input feeding). """
+        tgt_time_steps = tgt_embeddings.size(0)
+        cached_state = utils.get_incremental_state(self, incremental_state, 'cached_state')
+
+        # Skip padded target positions inside the LSTM kernel when rows are sorted by target length
+        lstm_input = tgt_embeddings
+        if tgt_lengths is not None:
+            lstm_input = nn.utils.rnn.pack_padded_sequence(tgt_embeddings, tgt_lengths.cpu())
+        lstm_output, (tgt_hidden_states, tgt_cell_states) = self.lstm(lstm_input, cached_state)
+        if tgt_lengths is not None:
+            lstm_output, _ = nn.utils.rnn.pad_packed_sequence(lstm_output, padding_value=0.,
+                                                              total_length=tgt_time_steps)
+
         # Cache previous states (only used during incremental, auto-regressive generation)
-        utils.set_incremental_state(
-            self, incremental_state, 'cached_state', (tgt_hidden_states, tgt_cell_states, input_feed))
+        utils.set_incremental_state(self, incremental_state, 'cached_state', (tgt_hidden_states, tgt_cell_states))
+
+        # [tgt_time_steps, batch_size, hidden_size] -> [batch_size, tgt_time_steps, hidden_size]
+        lstm_output = lstm_output.transpose(0, 1)
+        weighted_embeddings = None
+        if self.attention is None:
+            decoder_output = lstm_output
+            attn_weights = lstm_output.new_zeros(lstm_output.size(0), tgt_time_steps, src_out.size(0)) \
+                if need_attn else None
+        else:
+            # A single batched attention call over all target positions
+            decoder_output, attn_weights = self.attention(lstm_output, src_out, src_mask)
+            if self.use_lexical_model:
+                weighted_embeddings = torch.bmm(attn_weights, src_embeddings.transpose(0, 1))
+            attn_weights = attn_weights if need_attn else None
 
-        # Collect outputs across time steps
-        decoder_output = torch.cat(rnn_outputs, dim=0).view(tgt_time_steps, batch_size, self.hidden_size)
+        decoder_output = F.dropout(decoder_output, p=self.dropout_out, training=self.training)
+        return decoder_output, attn_weights, weighted_embeddings
 
-        # Transpose batch back: [tgt_time_steps, batch_size, num_features] -> [batch_size, tgt_time_steps, num_features]
-        decoder_output = decoder_output.transpose(0, 1)
 
-        # Final projection
-        decoder_output = self.final_projection(decoder_output)
+class LSTMStep(nn.Module):
+    """ Single-step inference module for a trained LSTMModel, written to be compiled with torch.jit.script.
+    encode() builds the initial decoder state and step() advances it by one target token. The state is a flat tuple of
+    batch-first tensors (hidden, cell, input_feed, src_out, projected_src_out, src_mask, src_embeddings), so rows can be
+    selected or reordered with index_select(0, ...) on every element. Dropout and attention weight buffers are left
+    out, as they are not needed at inference time. """
+    __constants__ = ['bidirectional', 'input_feeding', 'pad_idx', 'num_layers', 'hidden_size']
 
-        if self.use_lexical_model:
-            # __QUESTION: Incorporate the LEXICAL MODEL into the prediction of target tokens here
-            # (batch, timesteps, hidden)
-            # logging.info(len(lexical_contexts))
-            weighted_embeddings = torch.cat(lexical_contexts,1)
-            activated_weighted_embeddings = F.tanh(weighted_embeddings)
+    def __init__(self, model):
+        super().__init__()
+        encoder, decoder = model.encoder, model.decoder
+        self.bidirectional = bool(encoder.bidirectional)
+        self.input_feeding = decoder.input_feeding
+        self.pad_idx = encoder.dictionary.pad_idx
+        self.num_layers = len(decoder.layers) if decoder.input_feeding else decoder.lstm.num_layers
+        self.hidden_size = decoder.hidden_size
+
+        self.src_embedding = encoder.embedding
+        self.encoder_lstm = encoder.lstm
+        self.embedding = decoder.embedding
+        self.layers = decoder.layers if decoder.input_feeding else None
+        self.lstm = decoder.lstm if not decoder.input_feeding else None
+        self.attention = decoder.attention
+        self.final_projection = decoder.final_projection
+        self.W_lexical_embed = decoder.W_lexical_embed if decoder.use_lexical_model else None
+        self.W_lexical_output = decoder.W_lexical_output if decoder.use_lexical_model else None
+
+    @torch.jit.export
+    def encode(self, src_tokens: Tensor, src_lengths: Tensor) -> StepState:
+        """ Runs the encoder and returns the initial decoder state. Rows do not need to be sorted by length. """
+        batch_size, src_time_steps = src_tokens.size()
+        src_embeddings = self.src_embedding(src_tokens)
+        packed_source_embeddings = nn.utils.rnn.pack_padded_sequence(
+            src_embeddings.transpose(0, 1), src_lengths.cpu(), enforce_sorted=False)
+        packed_outputs, _ = self.encoder_lstm(packed_source_embeddings)
+        src_out, _ = nn.utils.rnn.pad_packed_sequence(packed_outputs, padding_value=0., total_length=src_time_steps)
+        src_out = src_out.transpose(0, 1)
+
+        # Source projections of the attention layer do not change across decoder steps
+        if self.attention is not None:
+            projected_src_out = self.attention.src_projection(src_out).transpose(2, 1)
+        else:
+            projected_src_out = src_out.new_zeros(batch_size, 0, src_time_steps)
+
+        hidden = src_out.new_zeros(batch_size, self.num_layers, self.hidden_size)
+        cell = src_out.new_zeros(batch_size, self.num_layers, self.hidden_size)
+        input_feed = src_out.new_zeros(batch_size, self.hidden_size)
+        src_mask = src_tokens.eq(self.pad_idx).unsqueeze(dim=1)
+        return hidden, cell, input_feed, src_out, projected_src_out, src_mask, src_embeddings
+
+    @torch.jit.export
+    def step(self, prev_tokens: Tensor, state: StepState) -> Tuple[Tensor, StepState]:
+        """ Feeds the previous target tokens of shape [batch_size] and returns next-token logits and the new state. """
+        hidden, cell, input_feed, src_out, projected_src_out, src_mask, src_embeddings = state
+        tgt_embeddings = self.embedding(prev_tokens)
+
+        if self.layers is not None:
+            lstm_input = torch.cat([tgt_embeddings, input_feed], dim=1)
+            next_hidden, next_cell = [], []
+            for layer_id, rnn_layer in enumerate(self.layers):
+                layer_hidden, layer_cell = rnn_layer(lstm_input, (hidden[:, layer_id], cell[:, layer_id]))
+                next_hidden.append(layer_hidden)
+                next_cell.append(layer_cell)
+                lstm_input = layer_hidden
+            hidden, cell = torch.stack(next_hidden, dim=1), torch.stack(next_cell, dim=1)
+        elif self.lstm is not None:
+            _, (next_hidden, next_cell) = self.lstm(
+                tgt_embeddings.unsqueeze(dim=0),
+                (hidden.transpose(0, 1).contiguous(), cell.transpose(0, 1).contiguous()))
+            hidden, cell = next_hidden.transpose(0, 1), next_cell.transpose(0, 1)
+        tgt_hidden = hidden[:, -1]
+
+        if self.attention is not None:
+            attn_scores = torch.bmm(tgt_hidden.unsqueeze(dim=1), projected_src_out)
+            attn_weights = F.softmax(attn_scores.masked_fill(src_mask, float('-inf')), dim=-1)
+            attn_context = torch.bmm(attn_weights, src_out).squeeze(dim=1)
+            output = torch.tanh(self.attention.context_plus_hidden_projection(
+                torch.cat([tgt_hidden, attn_context], dim=1)))
+            logits = self.final_projection(output)
+            if self.W_lexical_embed is not None and self.W_lexical_output is not None:
+                weighted_embeddings = torch.tanh(torch.bmm(attn_weights, src_embeddings).squeeze(dim=1))
+                lexical_hidden = torch.tanh(self.W_lexical_embed(weighted_embeddings)) + weighted_embeddings
+                logits = logits + self.W_lexical_output(lexical_hidden)
+        else:
+            output = tgt_hidden
+            logits = self.final_projection(output)
 
-            # logging.info(weighted_embeddings.size())
-            # (batch, timesteps, embed)
-            lexical_hidden = F.tanh(self.W_lexical_embed(activated_weighted_embeddings))+activated_weighted_embeddings
-            decoder_output += self.W_lexical_output(lexical_hidden)
-            # TODO: --------------------------------------------------------------------- /CUT
+        return logits, (hidden, cell, output, src_out, projected_src_out, src_mask, src_embeddings)
 
-        return decoder_output, attn_weights
+    def forward(self, prev_tokens: Tensor, state: StepState) -> Tuple[Tensor, StepState]:
+        return self.step(prev_tokens, state)
 
 
 @register_model_architecture('lstm', 'lstm')
@@ -433,3 +727,20 @@ def base_architecture(args):
     args.decoder_dropout_out = getattr(args, 'decoder_dropout_out', 0.25)
     args.decoder_use_attention = getattr(args, 'decoder_use_attention', 'True')
     args.decoder_use_lexical_model = getattr(args, 'decoder_use_lexical_model', 'False')
+    args.decoder_input_feeding = getattr(args, 'decoder_input_feeding', 'True')
+    args.decoder_shrink_batch = getattr(args, 'decoder_shrink_batch', 'False')
+    args.decoder_checkpoint_steps = getattr(args, 'decoder_checkpoint_steps', 0)
+    args.decoder_output_rank = getattr(args, 'decoder_output_rank', 0)
+
+
+@register_model_architecture('lstm', 'lstm_student')
+def lstm_student(args):
+    """ Smaller and faster model for sequence-level knowledge distillation from an lstm teacher (see distill.py): a
+    unidirectional encoder and half the decoder hidden size. """
+    args.encoder_bidirectional = getattr(args, 'encoder_bidirectional', 'False')
+    args.decoder_hidden_size = getattr(args, 'decoder_hidden_size', 64)
+    args.encoder_dropout_in = getattr(args, 'encoder_dropout_in', 0.1)
+    args.encoder_dropout_out = getattr(args, 'encoder_dropout_out', 0.1)
+    args.decoder_dropout_in = getattr(args, 'decoder_dropout_in', 0.1)
+    args.decoder_dropout_out = getattr(args, 'decoder_dropout_out', 0.1)
+    base_architecture(args)
@@ -19,9 +19,9 @@ class Seq2SeqModel(nn.Module):
         """Build a new model instance."""
         raise NotImplementedError
 
-    def forward(self, src_tokens, src_lengths, tgt_inputs):
+    def forward(self, src_tokens, src_lengths, tgt_inputs, **kwargs):
         encoder_out = self.encoder(src_tokens, src_lengths)
-        decoder_out = self.decoder(tgt_inputs, encoder_out)
+        decoder_out = self.decoder(tgt_inputs, encoder_out, **kwargs)
         return decoder_out
 
 
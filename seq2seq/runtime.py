@@ -0,0 +1,88 @@
+import functools
+import logging
+import os
+
+import torch
+
+
+def add_runtime_args(parser):
+    """ Adds the CPU execution options shared by all entry points. """
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='number of intra-op threads (default: torch default, or the size of the core slice)')
+    parser.add_argument('--interop-threads', default=None, type=int, help='number of inter-op threads')
+    parser.add_argument('--cpu-affinity', default=None, type=str,
+                        help='restrict the process to a list of cores, e.g. "0-7" or "0-3,8-11"')
+
+
+def parse_cpu_list(cpu_list):
+    """ Parses a list of cores in the format of taskset/numactl, e.g. "0-3,8,10-11". """
+    cores = []
+    for part in cpu_list.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cores.extend(range(int(start), int(end) + 1))
+        elif part.strip() != '':
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+def format_cpu_list(cores):
+    """ Formats a list of cores compactly, e.g. [0, 1, 2, 3, 8] as "0-3,8". """
+    ranges, cores = [], sorted(cores)
+    for core in cores:
+        if len(ranges) > 0 and ranges[-1][1] == core - 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(start) if start == end else '{:d}-{:d}'.format(start, end) for start, end in ranges)
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0))
+
+
+def split_cores(cores, num_slices):
+    """ Splits cores into num_slices disjoint contiguous slices; with fewer cores than slices, cores are shared. """
+    return [cores[i * len(cores) // num_slices:(i + 1) * len(cores) // num_slices] or [cores[i % len(cores)]]
+            for i in range(num_slices)]
+
+
+def pin(cores, num_threads=None):
+    """ Restricts the current process to the given cores and sizes the intra-op thread pool to match. """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads if num_threads is not None else len(cores))
+
+
+def configure(args):
+    """ Applies --cpu-affinity, --num-threads and --interop-threads to the current process and logs the effective
+    configuration. Should be called before any parallel work is done. """
+    if getattr(args, 'cpu_affinity', None) is not None:
+        os.sched_setaffinity(0, parse_cpu_list(args.cpu_affinity))
+    if getattr(args, 'num_threads', None) is not None:
+        torch.set_num_threads(args.num_threads)
+    elif getattr(args, 'cpu_affinity', None) is not None:
+        torch.set_num_threads(len(available_cores()))
+    if getattr(args, 'interop_threads', None) is not None:
+        try:
+            torch.set_num_interop_threads(args.interop_threads)
+        except RuntimeError as e:
+            # The inter-op pool can only be sized once per process, before it is first used
+            logging.warning('Could not set the number of inter-op threads: {}'.format(e))
+    logging.info('Runtime: {}'.format(describe()))
+
+
+def describe():
+    return 'num_threads {:d} | interop_threads {:d} | cpu_affinity {:s} | OMP_NUM_THREADS {}'.format(
+        torch.get_num_threads(), torch.get_num_interop_threads(), format_cpu_list(available_cores()),
+        os.environ.get('OMP_NUM_THREADS', 'unset'))
+
+
+def _init_data_worker(cores, worker_id):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(1)
+
+
+def data_worker_init_fn():
+    """ Returns a DataLoader worker_init_fn that keeps data workers on the cores of the main process and gives them a
+    single thread, so that they do not compete with the model for cores. """
+    return functools.partial(_init_data_worker, available_cores())
@@ -0,0 +1,41 @@
+import torch
+import torch.nn.functional as F
+
+
+class SequenceScorer(object):
+    """ Scores given target sentences with a single teacher-forced forward pass per batch (e.g. for corpus filtering
+    or n-best reranking). """
+
+    def __init__(self, model, tgt_dict):
+        self.model = model
+        self.tgt_dict = tgt_dict
+
+    @torch.no_grad()
+    def score(self, sample, need_attn=False):
+        """ Scores a collated batch. Returns one dict per sentence with the sentence id, the target token ids (including
+        the end-of-sentence token), their log-probabilities ('positional_scores'), the summed log-probability ('score')
+        and, if need_attn is set, the attention weights over the source tokens as a [tgt_len, src_len] tensor. """
+        output, attn_weights = self.model(
+            sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'], need_attn=need_attn)
+        lprobs = F.log_softmax(output.float(), dim=-1)
+        tgt_tokens = sample['tgt_tokens']
+        token_scores = lprobs.gather(dim=2, index=tgt_tokens.unsqueeze(dim=2)).squeeze(dim=2)
+
+        # Move everything to the CPU at once before splitting the batch into sentences
+        tgt_lengths = tgt_tokens.ne(self.tgt_dict.pad_idx).sum(dim=1).tolist()
+        src_lengths = sample['src_lengths'].tolist()
+        ids, tgt_tokens, token_scores = sample['id'].tolist(), tgt_tokens.cpu(), token_scores.cpu()
+        attn_weights = attn_weights.float().cpu() if need_attn and attn_weights is not None else None
+
+        results = []
+        for i, (tgt_len, src_len) in enumerate(zip(tgt_lengths, src_lengths)):
+            result = {
+                'id': ids[i],
+                'tokens': tgt_tokens[i, :tgt_len],
+                'score': token_scores[i, :tgt_len].sum().item(),
+                'positional_scores': token_scores[i, :tgt_len],
+            }
+            if attn_weights is not None:
+                result['attention'] = attn_weights[i, :tgt_len, :src_len]
+            results.append(result)
+        return results
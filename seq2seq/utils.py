@@ -1,10 +1,10 @@
 import os
+import argparse
 import logging
 import pickle
 import torch
 import torch.nn as nn
 import sys
-import preprocess
 
 from collections import defaultdict
 from torch.serialization import default_restore_location
@@ -28,6 +28,29 @@ def load_embedding(embed_path, dictionary):
     return embedding
 
 
+def grouped_iterator(iterable, group_size):
+    """ Yields lists of group_size consecutive items (the last list may be shorter). """
+    group = []
+    for item in iterable:
+        group.append(item)
+        if len(group) == group_size:
+            yield group
+            group = []
+    if len(group) > 0:
+        yield group
+
+
+def str2bool(value):
+    """ Parses the value of a boolean option such as --cuda (True/False, yes/no or 1/0, in any case). """
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError('Expected a boolean value, got {!r}'.format(value))
+
+
 def move_to_cuda(sample):
     if torch.is_tensor(sample):
         return sample.cuda()
@@ -39,6 +62,13 @@ def move_to_cuda(sample):
         return sample
 
 
+def autocast(precision, cuda=False):
+    """ Returns an autocast context for the given --precision. Under bf16, matmul-heavy operations run in bfloat16
+    while parameters, gradients and the optimizer state stay in fp32; as bfloat16 has the same exponent range as fp32,
+    no loss scaling is required and gradient clipping can be applied to the fp32 gradients as usual. """
+    return torch.autocast(device_type='cuda' if cuda else 'cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
 def save_checkpoint(args, model, optimizer, epoch, valid_loss):
     os.makedirs(args.save_dir, exist_ok=True)
     last_epoch = getattr(save_checkpoint, 'last_epoch', -1)
@@ -69,13 +99,31 @@ def load_checkpoint(args, model, optimizer):
     if os.path.isfile(checkpoint_path):
         state_dict = torch.load(checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
         model.load_state_dict(state_dict['model'])
-        optimizer.load_state_dict(state_dict['optimizer'])
+        # Checkpoints without optimizer state (e.g. written by compress.py) start with a fresh optimizer
+        if state_dict.get('optimizer') is not None:
+            optimizer.load_state_dict(state_dict['optimizer'])
         save_checkpoint.best_loss = state_dict['best_loss']
         save_checkpoint.last_epoch = state_dict['last_epoch']
         logging.info('Loaded checkpoint {}'.format(checkpoint_path))
         return state_dict
 
 
+# Arguments of a training run that describe its data, which generation takes from the checkpoint unless they are given
+DATA_ARGS = ('data', 'source_lang', 'target_lang')
+
+
+def merge_checkpoint_args(args, checkpoint_args):
+    """ Combines the command line arguments of a generation entry point with the arguments saved in a checkpoint. Every
+    option that the entry point defines itself (e.g. --num-workers, --batch-size or --cuda) is kept, even if training
+    had an option of the same name, and the checkpoint provides the model arguments and all other options. The data
+    arguments (see DATA_ARGS) are taken from the checkpoint only where they were left unset (None). """
+    merged = {**vars(checkpoint_args), **vars(args)}
+    for key in DATA_ARGS:
+        if merged.get(key) is None and hasattr(checkpoint_args, key):
+            merged[key] = getattr(checkpoint_args, key)
+    return argparse.Namespace(**merged)
+
+
 def init_logging(args):
     handlers = [logging.StreamHandler()]
     if hasattr(args, 'log_file') and args.log_file is not None:
@@ -115,6 +163,8 @@ def set_incremental_state(module, incremental_state, key, value):
 
 
 def post_process_prediction(hypo_tokens, src_str, alignment, tgt_dict, remove_bpe):
+    # preprocess imports this module, and is not needed by most of its users
+    import preprocess
     hypo_str = tgt_dict.string(hypo_tokens, remove_bpe)
     # hypo_str = replace_unk(hypo_str, src_str, alignment, tgt_dict.unk_word)
     # Convert back to tokens for evaluating with unk replacement or without BPE
@@ -124,6 +174,7 @@ def post_process_prediction(hypo_tokens, src_str, alignment, tgt_dict, remove_bp
 
 
 def replace_unk(hypo_str, src_str, alignment, unk):
+    import preprocess
     hypo_tokens = preprocess.word_tokenize(hypo_str)
     src_tokens = preprocess.word_tokenize(src_str) + ['<eos>']
     for i, ht in enumerate(hypo_tokens):
@@ -0,0 +1,291 @@
+import os
+import json
+import queue
+import logging
+import argparse
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from torch.serialization import default_restore_location
+
+from preprocess import word_tokenize
+from seq2seq import models, runtime, utils
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.generator import SequenceGenerator
+
+
+def get_args():
+    """ Defines server-specific hyper-parameters. """
+    parser = argparse.ArgumentParser('Sequence to Sequence Translation Server')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of generation (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
+
+    # Add data and model arguments
+    parser.add_argument('--data', default=None,
+                        help='path to data directory (default: the data directory of the checkpoint)')
+    parser.add_argument('--checkpoint-path', default='checkpoints/checkpoint_best.pt', help='path to the model file')
+    parser.add_argument('--max-len', default=25, type=int, help='maximum length of generated sequence')
+    parser.add_argument('--script-step', action='store_true',
+                        help='decode with a TorchScript-compiled single-step inference module')
+
+    # Add server arguments
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', default=8080, type=int, help='port to listen on')
+    parser.add_argument('--max-batch-size', default=32, type=int, help='maximum number of sentences in a micro-batch')
+    parser.add_argument('--max-wait-ms', default=10., type=float,
+                        help='maximum time a sentence waits for its micro-batch to fill up')
+    parser.add_argument('--bucket-width', default=5, type=int,
+                        help='sentences are only batched with sentences of similar length (in tokens)')
+    parser.add_argument('--cache-size', default=0, type=int,
+                        help='keep up to N translations of repeated source sentences in memory')
+    parser.add_argument('--cache-path', default=None, type=str,
+                        help='SQLite file that persists cached translations across server restarts')
+
+    return parser.parse_args()
+
+
+class ServerMetrics(object):
+    """ Tracks request latencies and micro-batch statistics over a sliding window. """
+
+    def __init__(self, max_batch_size, cache=None, window=10000):
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.padding_ratios = deque(maxlen=window)
+        self.num_sentences = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, src_lengths):
+        with self.lock:
+            self.num_batches += 1
+            self.num_sentences += len(src_lengths)
+            self.batch_sizes.append(len(src_lengths))
+            self.padding_ratios.append(sum(src_lengths) / (len(src_lengths) * max(src_lengths)))
+
+    def add_latencies(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+            batch_sizes = np.array(self.batch_sizes) if len(self.batch_sizes) > 0 else np.zeros(1)
+            cache_stats = {} if self.cache is None else {**self.cache.stats, 'cache_hit_rate': self.cache.hit_rate()}
+            return {
+                **cache_stats,
+                'num_sentences': self.num_sentences,
+                'num_batches': self.num_batches,
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'mean_batch_size': float(batch_sizes.mean()),
+                'batch_fill': float(batch_sizes.mean() / self.max_batch_size),
+                'non_padding_ratio': float(np.mean(self.padding_ratios)) if len(self.padding_ratios) > 0 else 1.,
+            }
+
+
+class PendingSentence(object):
+    """ A binarized source sentence waiting for its translation. """
+
+    def __init__(self, src_tokens, translation=None):
+        self.src_tokens = src_tokens
+        self.arrival_time = time.perf_counter()
+        self.translation = translation
+        self.done = threading.Event()
+        if translation is not None:
+            self.done.set()
+
+
+class MicroBatcher(threading.Thread):
+    """ Groups queued sentences of similar length into micro-batches and translates them on a single thread. A bucket
+    is translated as soon as it is full, or once its oldest sentence has waited for max_wait seconds. With a cache,
+    cached sentences are answered right away and duplicates within a micro-batch are only translated once. """
+
+    def __init__(self, generator, src_dict, tgt_dict, args, metrics, cache=None):
+        super().__init__(daemon=True)
+        self.generator = generator
+        self.src_dict = src_dict
+        self.tgt_dict = tgt_dict
+        self.args = args
+        self.metrics = metrics
+        self.cache = cache
+        self.max_wait = args.max_wait_ms / 1000
+        self.queue = queue.Queue()
+
+    def submit(self, src_tokens):
+        if self.cache is not None:
+            translation = self.cache.lookup(src_tokens)
+            if translation is not None:
+                self.metrics.add_latencies([0.])
+                return PendingSentence(src_tokens, translation)
+        sentence = PendingSentence(src_tokens)
+        self.queue.put(sentence)
+        return sentence
+
+    def run(self):
+        buckets = {}
+        while True:
+            # Wait for new sentences until the earliest bucket deadline, then take everything that arrived while the
+            # previous micro-batch was being translated
+            deadlines = [bucket[0].arrival_time + self.max_wait for bucket in buckets.values()]
+            timeout = max(min(deadlines) - time.perf_counter(), 0.) if len(deadlines) > 0 else None
+            try:
+                self.add(buckets, self.queue.get(timeout=timeout))
+                while True:
+                    self.add(buckets, self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            # Flush buckets whose oldest sentence has waited long enough, oldest first
+            now = time.perf_counter()
+            expired = [k for k, bucket in buckets.items() if bucket[0].arrival_time + self.max_wait <= now]
+            for bucket_id in sorted(expired, key=lambda k: buckets[k][0].arrival_time):
+                self.translate(buckets.pop(bucket_id))
+
+    def add(self, buckets, sentence):
+        bucket_id = len(sentence.src_tokens) // self.args.bucket_width
+        bucket = buckets.setdefault(bucket_id, [])
+        bucket.append(sentence)
+        if len(bucket) >= self.args.max_batch_size:
+            self.translate(buckets.pop(bucket_id))
+
+    def translate(self, sentences):
+        src_sentences = [sentence.src_tokens for sentence in sentences]
+        try:
+            if self.cache is not None:
+                translations = self.cache.translate(src_sentences, self.generate)
+            else:
+                translations = self.generate(src_sentences)
+        except Exception:
+            logging.exception('Failed to translate a batch of {:d} sentences'.format(len(sentences)))
+            translations = [None] * len(sentences)
+
+        now = time.perf_counter()
+        for sentence, translation in zip(sentences, translations):
+            sentence.translation = translation
+            sentence.done.set()
+        self.metrics.add_latencies([now - sentence.arrival_time for sentence in sentences])
+
+    def generate(self, src_sentences):
+        # The encoder expects sentences sorted by descending length
+        order = sorted(range(len(src_sentences)), key=lambda i: len(src_sentences[i]), reverse=True)
+        src_lengths = torch.LongTensor([len(src_sentences[i]) for i in order])
+        src_tokens = torch.full((len(order), int(src_lengths[0])), self.src_dict.pad_idx, dtype=torch.long)
+        for row, i in enumerate(order):
+            src_tokens[row, :src_lengths[row]] = src_sentences[i]
+        if self.args.cuda:
+            src_tokens, src_lengths = utils.move_to_cuda(src_tokens), utils.move_to_cuda(src_lengths)
+
+        with utils.autocast(self.args.precision, self.args.cuda):
+            hypos = self.generator.generate(src_tokens, src_lengths)
+        self.metrics.add_batch(src_lengths.tolist())
+
+        translations = [None] * len(src_sentences)
+        for i, hypo in zip(order, hypos):
+            translations[i] = self.tgt_dict.string(hypo)
+        return translations
+
+
+class TranslationServer(ThreadingHTTPServer):
+    """ Threaded HTTP server with a listen backlog large enough for bursts of concurrent clients. """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher, src_dict, metrics):
+    class TranslationHandler(BaseHTTPRequestHandler):
+        """ POST /translate with {"text": "..."} or {"texts": ["...", ...]}; GET /stats returns server metrics. """
+
+        def do_POST(self):
+            if self.path != '/translate':
+                return self.reply(404, {'error': 'unknown path {:s}'.format(self.path)})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                texts = request['texts'] if 'texts' in request else [request['text']]
+            except (ValueError, KeyError, TypeError):
+                return self.reply(400, {'error': 'expected a JSON object with a "text" or "texts" field'})
+
+            pending = [batcher.submit(src_dict.binarize(text, word_tokenize).long()) for text in texts]
+            for sentence in pending:
+                sentence.done.wait()
+            translations = [sentence.translation for sentence in pending]
+            if any(translation is None for translation in translations):
+                return self.reply(500, {'error': 'translation failed'})
+            if 'texts' in request:
+                return self.reply(200, {'translations': translations})
+            return self.reply(200, {'translation': translations[0]})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self.reply(404, {'error': 'unknown path {:s}'.format(self.path)})
+            self.reply(200, metrics.summary())
+
+        def reply(self, status, body):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return TranslationHandler
+
+
+def main(args):
+    """ Loads the model once and serves translations over HTTP. """
+    torch.manual_seed(args.seed)
+    state_dict = torch.load(args.checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
+    args = utils.merge_checkpoint_args(args, state_dict['args'])
+    utils.init_logging(args)
+    runtime.configure(args)
+
+    # Load dictionaries
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+
+    # Build model
+    model = models.build_model(args, src_dict, tgt_dict)
+    if args.cuda:
+        model = model.cuda()
+    model.eval()
+    model.load_state_dict(state_dict['model'])
+    logging.info('Loaded a model from checkpoint {:s}'.format(args.checkpoint_path))
+
+    step_module = model.build_step_module(script=True) if args.script_step else None
+    generator = SequenceGenerator(model, tgt_dict, max_len=args.max_len, step_module=step_module)
+    cache = None
+    if args.cache_size > 0 or args.cache_path is not None:
+        from seq2seq.cache import TranslationCache, checkpoint_hash
+        cache = TranslationCache(checkpoint_hash(args.checkpoint_path), {'max_len': args.max_len,
+                                 'precision': args.precision}, args.cache_size, args.cache_path)
+    metrics = ServerMetrics(args.max_batch_size, cache)
+    batcher = MicroBatcher(generator, src_dict, tgt_dict, args, metrics, cache)
+    batcher.start()
+
+    server = TranslationServer((args.host, args.port), make_handler(batcher, src_dict, metrics))
+    logging.info('Serving translations on http://{:s}:{:d}'.format(args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('Server statistics: {}'.format(metrics.summary()))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import math
+import time
+import queue
+import pickle
+import shutil
+import logging
+import argparse
+import itertools
+import contextlib
+import multiprocessing
+import numpy as np
+
+from seq2seq import runtime, utils
+from seq2seq.data.dataset import MMapTokens
+
+
+def get_args():
+    """ Defines sweep parameters. Unknown arguments are passed on to train.py by every trial (e.g. --max-epoch,
+    --batch-size or --train-on-tiny). """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--data', default='prepared_data', help='path to data directory')
+    parser.add_argument('--output-dir', default='sweep', help='path to save the shared data and the trials')
+    parser.add_argument('--params', nargs='+', required=True,
+                        help='searched train.py arguments as name=value,value,... or, for random search, as '
+                             'name=low:high (log-uniform for floats, uniform for integers), e.g. lr=1e-4:1e-2 '
+                             'decoder_hidden_size=64,128,256')
+    parser.add_argument('--search', default='grid', choices=['grid', 'random'], help='search strategy')
+    parser.add_argument('--num-trials', default=8, type=int, help='number of trials of a random search')
+    parser.add_argument('--seed', default=42, type=int, help='seed of the random search')
+
+    # Add execution arguments
+    parser.add_argument('--parallel', default=2, type=int, help='number of trials run at the same time')
+    parser.add_argument('--threads-per-trial', default=None, type=int,
+                        help='number of threads of every trial (default: the available cores divided among the '
+                             'parallel trials)')
+
+    # Add early stopping arguments
+    parser.add_argument('--grace-epochs', default=1, type=int,
+                        help='number of epochs every trial runs before it can be stopped early')
+    parser.add_argument('--min-trials', default=2, type=int,
+                        help='number of other trials that must have reached an epoch before a trial is compared with '
+                             'them (0 disables early stopping)')
+    return parser.parse_known_args()
+
+
+def parse_params(params):
+    """ Parses name=value,value,... and name=low:high specifications into a dict of value lists and (low, high) pairs;
+    names may be given with dashes or underscores. """
+    space = {}
+    for param in params:
+        name, values = param.split('=', 1)
+        name = name.lstrip('-').replace('-', '_')
+        space[name] = tuple(values.split(':', 1)) if ':' in values else values.split(',')
+    return space
+
+
+def sample_trials(space, search, num_trials, seed):
+    """ Returns the trials of a search as a list of dicts from argument names to values (as strings). """
+    if search == 'grid':
+        if any(isinstance(values, tuple) for values in space.values()):
+            raise ValueError('Ranges (low:high) can only be used with --search random')
+        return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+    def is_int(value):
+        return value.lstrip('-').isdigit()
+
+    rng, trials = np.random.RandomState(seed), []
+    for _ in range(num_trials):
+        trial = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                trial[name] = values[rng.randint(len(values))]
+            elif is_int(values[0]) and is_int(values[1]):
+                trial[name] = str(rng.randint(int(values[0]), int(values[1]) + 1))
+            else:
+                low, high = float(values[0]), float(values[1])
+                value = math.exp(rng.uniform(math.log(low), math.log(high))) if low > 0 else rng.uniform(low, high)
+                trial[name] = '{:.3g}'.format(value)
+        trials.append(trial)
+    return trials
+
+
+def share_data(data_dir, shared_dir):
+    """ Converts the splits of a data directory into memory-mapped token arrays (see MMapTokens), so that all trials
+    read the same copy of the data instead of unpickling one each. Dictionaries are copied, and all other files are
+    left out. """
+    os.makedirs(shared_dir, exist_ok=True)
+    # Splits are written by preprocess.py as {split}.{lang} (or {split}.{shard}.{lang}) for the languages of the
+    # dictionaries (dict.{lang})
+    langs = set(file[len('dict.'):] for file in os.listdir(data_dir) if file.startswith('dict.'))
+    for file in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, file)
+        split, _, lang = file.rpartition('.')
+        if not os.path.isfile(path) or not split or lang not in langs:
+            continue
+        if split == 'dict':
+            shutil.copy2(path, os.path.join(shared_dir, file))
+        elif not MMapTokens.exists(os.path.join(shared_dir, file)) or \
+                os.path.getmtime(path) > os.path.getmtime(os.path.join(shared_dir, file) + '.idx.npy'):
+            with open(path, 'rb') as f:
+                MMapTokens.write(pickle.load(f), os.path.join(shared_dir, file))
+            logging.info('Shared {:s} as memory-mapped tokens'.format(file))
+
+
+def median_stop(perplexities, others, grace_epochs, min_trials):
+    """ Median stopping rule: a trial is stopped after an epoch if its best validation perplexity so far is worse than
+    the median of the best perplexities of the other trials after the same number of epochs. """
+    epochs = len(perplexities)
+    if min_trials <= 0 or epochs < grace_epochs:
+        return False
+    best = [min(other[:epochs]) for other in others if len(other) >= epochs]
+    return len(best) >= min_trials and min(perplexities) > float(np.median(best))
+
+
+def run_trial(trial_id, trial, train_args, history, args):
+    """ Runs train.py in the current process with the arguments of a trial. Log messages, progress bars and other output
+    go to the log file of the trial, and the validation perplexity of every epoch is published in history, which is
+    shared by all trials. """
+    import train
+
+    trial_dir = os.path.join(args.output_dir, 'trial{:03d}'.format(trial_id))
+    os.makedirs(trial_dir, exist_ok=True)
+    argv = ['--data', os.path.join(args.output_dir, 'data'), '--save-dir', trial_dir, '--num-threads',
+            str(args.threads_per_trial)] + train_args
+    for name, value in trial.items():
+        argv.extend(['--' + name.replace('_', '-'), value])
+    perplexities, stopped = [], []
+
+    def epoch_callback(epoch, valid_perplexity):
+        perplexities.append(valid_perplexity)
+        history[trial_id] = tuple(perplexities)
+        others = [other for other_id, other in history.items() if other_id != trial_id]
+        if median_stop(perplexities, others, args.grace_epochs, args.min_trials):
+            stopped.append(epoch)
+        return len(stopped) > 0
+
+    # Output is redirected for the duration of the trial only. The logging setup of train.py does nothing once the root
+    # logger has a handler, and train.py logs its command line from sys.argv
+    root_logger, saved_argv = logging.getLogger(), sys.argv
+    with open(os.path.join(trial_dir, 'train.log'), 'w', buffering=1) as log_file, \
+            contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+        handler, level = logging.StreamHandler(log_file), root_logger.level
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.INFO)
+        sys.argv = ['train.py'] + argv
+        try:
+            start = time.perf_counter()
+            train.main(train.get_args(argv), epoch_callback=epoch_callback)
+        except Exception:
+            logging.exception('Trial {:d} failed'.format(trial_id))
+            raise
+        finally:
+            sys.argv = saved_argv
+            root_logger.removeHandler(handler)
+            root_logger.setLevel(level)
+    return {'trial': trial_id, 'params': trial, 'epochs': len(perplexities),
+            'best_perplexity': min(perplexities) if len(perplexities) > 0 else float('inf'),
+            'stopped_early': len(stopped) > 0, 'seconds': time.perf_counter() - start}
+
+
+def run_trial_process(task, finished):
+    """ Runs a trial in its own process and puts its id together with its result, or the error it failed with, into the
+    finished queue. """
+    try:
+        finished.put((task[0], run_trial(*task), None))
+    except Exception as e:
+        finished.put((task[0], None, '{}: {}'.format(type(e).__name__, e)))
+
+
+def main(args, train_args):
+    """ Runs the trials of a grid or random search over train.py arguments in a pool of processes. All trials share
+    one memory-mapped copy of the data, are limited to an equal share of the cores and are stopped early by the median
+    stopping rule. Results are logged as a table sorted by validation perplexity and saved to results.json. """
+    utils.init_logging(args)
+    if args.threads_per_trial is None:
+        args.threads_per_trial = max(1, len(runtime.available_cores()) // args.parallel)
+
+    trials = sample_trials(parse_params(args.params), args.search, args.num_trials, args.seed)
+    share_data(args.data, os.path.join(args.output_dir, 'data'))
+    logging.info('Running {:d} trials, {:d} at a time with {:d} threads each'.format(
+        len(trials), args.parallel, args.threads_per_trial))
+
+    # Every trial runs in a new process, as train.py keeps state in the process (e.g. the best checkpoint and the
+    # threading configuration). The processes are not daemonic, so that trials can start data loader workers
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with context.Manager() as manager:
+        history, finished = manager.dict(), manager.Queue()
+        pending = [(trial_id, trial, train_args, history, args) for trial_id, trial in enumerate(trials)]
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < args.parallel:
+                task = pending.pop(0)
+                running[task[0]] = context.Process(target=run_trial_process, args=(task, finished))
+                running[task[0]].start()
+            try:
+                trial_id, result, error = finished.get(timeout=1)
+            except queue.Empty:
+                # Processes that were killed (e.g. for running out of memory) cannot report their failure
+                crashed = [trial_id for trial_id, process in running.items() if process.exitcode not in (None, 0)]
+                for trial_id in crashed:
+                    logging.error('Trial {:d} failed: exit code {:d}'.format(trial_id, running.pop(trial_id).exitcode))
+                continue
+            running.pop(trial_id).join()
+            if error is not None:
+                logging.error('Trial {:d} failed: {}'.format(trial_id, error))
+                continue
+            results.append(result)
+            logging.info('Trial {:d} finished after {:d} epochs{:s}: valid_perplexity {:.3g} ({:.0f}s)'.format(
+                result['trial'], result['epochs'], ' (stopped early)' if result['stopped_early'] else '',
+                result['best_perplexity'], result['seconds']))
+
+    results.sort(key=lambda result: result['best_perplexity'])
+    with open(os.path.join(args.output_dir, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    names = list(trials[0].keys()) if len(trials) > 0 else []
+    widths = [max(len(name), 10) for name in names]
+    logging.info(' '.join(['{:>5s}'.format('trial')] + ['{:>{}s}'.format(name, width) for name, width in
+                                                       zip(names, widths)] +
+                          ['{:>6s} {:>8s} {:>12s} {:>8s}'.format('epochs', 'stopped', 'perplexity', 'seconds')]))
+    for result in results:
+        logging.info(' '.join(['{:>5d}'.format(result['trial'])] +
+                              ['{:>{}s}'.format(result['params'][name], width) for name, width in zip(names, widths)] +
+                              ['{:>6d} {:>8s} {:>12.3f} {:>8.0f}'.format(
+                                  result['epochs'], 'yes' if result['stopped_early'] else 'no',
+                                  result['best_perplexity'], result['seconds'])]))
+
+
+if __name__ == '__main__':
+    args, train_args = get_args()
+    main(args, train_args)
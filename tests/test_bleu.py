@@ -0,0 +1,130 @@
+import os
+import re
+import random
+import shutil
+import tempfile
+import unittest
+import collections
+import subprocess
+
+import numpy as np
+
+from seq2seq import bleu
+
+
+MULTI_BLEU = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'multi-bleu.perl')
+
+
+def random_corpus(rng, num_sentences, vocab_size=8, max_len=12, empty_prob=0.):
+    """ Returns sentences of random words of a small vocabulary (in upper and lower case), so that there are many
+    n-gram matches of every order, and some empty sentences with probability empty_prob. """
+    vocab = ['w{:d}'.format(i) for i in range(vocab_size)] + ['W{:d}'.format(i) for i in range(vocab_size // 2)]
+    return [' '.join(rng.choice(vocab) for _ in range(0 if rng.random() < empty_prob else rng.randint(1, max_len)))
+            for _ in range(num_sentences)]
+
+
+def numbers(line):
+    """ Returns the numbers of a line printed by multi-bleu.perl or bleu.format_score. """
+    return [float(number) for number in re.findall(r'\d+(?:\.\d+)?', line.replace('/', ' '))]
+
+
+def naive_statistics(hypothesis, reference, max_order=4):
+    """ Clipped n-gram matches and n-gram totals of a single sentence, counted with Counters. """
+    matches, totals = [], []
+    for order in range(1, max_order + 1):
+        hyp_grams = collections.Counter(tuple(hypothesis[i:i + order]) for i in range(len(hypothesis) - order + 1))
+        ref_grams = collections.Counter(tuple(reference[i:i + order]) for i in range(len(reference) - order + 1))
+        matches.append(sum((hyp_grams & ref_grams).values()))
+        totals.append(sum(hyp_grams.values()))
+    return matches, totals
+
+
+class TestNgramStatistics(unittest.TestCase):
+
+    def test_matches_naive_counts(self):
+        rng = random.Random(0)
+        for trial in range(20):
+            hypotheses = random_corpus(rng, 30, vocab_size=rng.randint(2, 10), empty_prob=0.1)
+            references = random_corpus(rng, 30, vocab_size=rng.randint(2, 10), empty_prob=0.1)
+            matches, totals, hyp_lens, ref_lens = bleu.ngram_statistics(*bleu.encode(hypotheses, references))
+            for i, (hypothesis, reference) in enumerate(zip(hypotheses, references)):
+                with self.subTest(trial=trial, sentence=i):
+                    expected_matches, expected_totals = naive_statistics(hypothesis.split(), reference.split())
+                    self.assertEqual(matches[i].tolist(), expected_matches)
+                    self.assertEqual(totals[i].tolist(), expected_totals)
+                    self.assertEqual((hyp_lens[i], ref_lens[i]), (len(hypothesis.split()), len(reference.split())))
+
+    def test_token_ids(self):
+        # Tensors or arrays of token ids are scored like the strings of the same tokens
+        rng = random.Random(1)
+        hypotheses, references = random_corpus(rng, 20), random_corpus(rng, 20)
+        encoded = bleu.encode(hypotheses, references)
+        for expected, actual in zip(bleu.ngram_statistics(*bleu.encode(hypotheses, references)),
+                                    bleu.ngram_statistics(*bleu.encode(*encoded))):
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_subsets(self):
+        # The corpus BLEU of a subset is the same when computed from the statistics of the whole corpus
+        rng = random.Random(2)
+        hypotheses, references = random_corpus(rng, 40), random_corpus(rng, 40)
+        statistics = bleu.ngram_statistics(*bleu.encode(hypotheses, references))
+        mask = np.array([rng.random() < 0.5 for _ in hypotheses])
+        subset = [i for i in range(len(hypotheses)) if mask[i]]
+        self.assertEqual(bleu.corpus_bleu_from_statistics(*(values[mask] for values in statistics)),
+                         bleu.corpus_bleu([hypotheses[i] for i in subset], [references[i] for i in subset]))
+
+
+@unittest.skipIf(shutil.which('perl') is None, 'perl is not available')
+class TestMultiBleuParity(unittest.TestCase):
+    """ The scores must be the same as those printed by multi-bleu.perl. """
+
+    def multi_bleu(self, hypotheses, references, lowercase=False):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as reference_file:
+            reference_file.write(''.join(reference + '\n' for reference in references))
+            reference_file.flush()
+            result = subprocess.run(['perl', MULTI_BLEU] + (['-lc'] if lowercase else []) + [reference_file.name],
+                                    input=''.join(hypothesis + '\n' for hypothesis in hypotheses),
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return result.stdout.strip()
+
+    def assertParity(self, hypotheses, references, lowercase=False):
+        expected = self.multi_bleu(hypotheses, references, lowercase)
+        actual = bleu.format_score(bleu.corpus_bleu(hypotheses, references, lowercase))
+        self.assertEqual(numbers(actual), numbers(expected), msg='{} != {}'.format(actual, expected))
+
+    def test_random_corpora(self):
+        rng = random.Random(3)
+        for trial in range(30):
+            num_sentences = rng.randint(1, 50)
+            vocab_size = rng.randint(2, 30)
+            hypotheses = random_corpus(rng, num_sentences, vocab_size, max_len=rng.randint(1, 20), empty_prob=0.05)
+            references = random_corpus(rng, num_sentences, vocab_size, max_len=rng.randint(1, 20), empty_prob=0.05)
+            # multi-bleu.perl divides by the number of hypothesis words if they are fewer than the reference words
+            if all(len(hypothesis) == 0 for hypothesis in hypotheses):
+                continue
+            for lowercase in (False, True):
+                with self.subTest(trial=trial, lowercase=lowercase):
+                    self.assertParity(hypotheses, references, lowercase)
+
+    def test_identical(self):
+        corpus = random_corpus(random.Random(4), 20)
+        self.assertParity(corpus, corpus)
+        self.assertEqual(bleu.corpus_bleu(corpus, corpus).score, 1.)
+
+    def test_empty_references(self):
+        self.assertParity(['a b c', 'd'], ['', ''])
+        self.assertParity(['', ''], ['', ''])
+
+    def test_unsmoothed_sentence_bleu(self):
+        # Unsmoothed sentence BLEU is the score of multi-bleu.perl run on each sentence on its own
+        rng = random.Random(5)
+        hypotheses, references = random_corpus(rng, 10, vocab_size=4), random_corpus(rng, 10, vocab_size=4)
+        for hypothesis, reference, score in zip(hypotheses, references,
+                                                bleu.sentence_bleu(hypotheses, references, smooth=False)):
+            with self.subTest(hypothesis=hypothesis, reference=reference):
+                self.assertEqual(numbers(bleu.format_score(score)),
+                                 numbers(self.multi_bleu([hypothesis], [reference])))
+
+
+if __name__ == '__main__':
+    unittest.main()
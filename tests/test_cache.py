@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from seq2seq.cache import TranslationCache
+
+
+class CountingTranslator(object):
+    """ Translates sentences of token ids into strings and records the sentences of every call. """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, src_sentences):
+        self.calls.append([list(map(int, src_tokens)) for src_tokens in src_sentences])
+        return [' '.join('w{:d}'.format(int(token)) for token in src_tokens) for src_tokens in src_sentences]
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def test_memory_hits_and_duplicates(self):
+        cache, translator = TranslationCache('hash', {'beam': 1}), CountingTranslator()
+        sentences = [[4, 5], [6], [4, 5], [7, 8, 9]]
+        self.assertEqual(cache.translate(sentences, translator), ['w4 w5', 'w6', 'w4 w5', 'w7 w8 w9'])
+        # Duplicates within a call are translated once
+        self.assertEqual(translator.calls, [[[4, 5], [6], [7, 8, 9]]])
+
+        # Tensors and lists of the same tokens share a key
+        self.assertEqual(cache.translate([torch.tensor([6]), [10]], translator), ['w6', 'w10'])
+        self.assertEqual(translator.calls[-1], [[10]])
+        self.assertEqual(dict(cache.stats), {'requests': 6, 'memory_hits': 1, 'disk_hits': 0, 'duplicates': 1,
+                                             'misses': 4})
+        self.assertEqual(cache.lookup([7, 8, 9]), 'w7 w8 w9')
+        self.assertIsNone(cache.lookup([11]))
+
+    def test_lru_eviction(self):
+        cache, translator = TranslationCache('hash', {}, capacity=2), CountingTranslator()
+        cache.translate([[1], [2]], translator)
+        cache.translate([[1]], translator)  # [1] is now more recently used than [2]
+        cache.translate([[3]], translator)  # evicts [2]
+        self.assertEqual(list(cache.memory), [TranslationCache.key([1]), TranslationCache.key([3])])
+        cache.translate([[2], [1]], translator)
+        self.assertEqual(translator.calls, [[[1], [2]], [[3]], [[2]]])
+
+    def test_no_memory(self):
+        cache, translator = TranslationCache('hash', {}, capacity=0), CountingTranslator()
+        cache.translate([[1], [1]], translator)
+        cache.translate([[1]], translator)
+        self.assertEqual(translator.calls, [[[1]], [[1]]])
+        self.assertEqual(len(cache.memory), 0)
+
+    def test_sqlite_hits(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.sqlite')
+            translator = CountingTranslator()
+            cache = TranslationCache('hash', {'max_len': 25}, path=path)
+            cache.translate([[1, 2], [3]], translator)
+            cache.close()
+
+            # A new process finds the translations in the database and keeps them in memory afterwards
+            cache = TranslationCache('hash', {'max_len': 25}, path=path)
+            self.assertEqual(cache.translate([[3], [1, 2], [4]], translator), ['w3', 'w1 w2', 'w4'])
+            self.assertEqual(translator.calls[-1], [[4]])
+            self.assertEqual(cache.translate([[3]], translator), ['w3'])
+            self.assertEqual((cache.stats['disk_hits'], cache.stats['memory_hits'], cache.stats['misses']), (2, 1, 1))
+            cache.close()
+
+            # Another checkpoint or other decoding settings do not share translations
+            for checkpoint_hash, settings in (('other', {'max_len': 25}), ('hash', {'max_len': 10})):
+                with self.subTest(checkpoint_hash=checkpoint_hash, settings=settings):
+                    cache = TranslationCache(checkpoint_hash, settings, path=path)
+                    self.assertIsNone(cache.lookup([3]))
+                    cache.translate([[3]], translator)
+                    self.assertEqual(translator.calls[-1], [[3]])
+                    cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
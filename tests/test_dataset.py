@@ -0,0 +1,145 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import Seq2SeqDataset, StreamingSeq2SeqDataset, find_shards, split_sample
+
+
+def random_sentences(rng, num_sentences, dictionary, max_len=12):
+    """ Returns arrays of random token ids that end with an end-of-sentence token, as written by preprocess.py. """
+    return [np.array(rng.randint(dictionary.num_special, len(dictionary), size=rng.randint(0, max_len)).tolist() +
+                     [dictionary.eos_idx], dtype=np.int32) for _ in range(num_sentences)]
+
+
+def write_tokens(path, tokens_list):
+    with open(path, 'wb') as f:
+        pickle.dump(tokens_list, f)
+
+
+def unpadded_rows(tokens, pad_idx):
+    return [row[row.ne(pad_idx)].tolist() for row in tokens]
+
+
+class TestSplitSample(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dictionary = Dictionary()
+        for i in range(30):
+            cls.dictionary.add_word('w{:d}'.format(i))
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as data_dir:
+            src_file, tgt_file = os.path.join(data_dir, 'test.src'), os.path.join(data_dir, 'test.tgt')
+            write_tokens(src_file, random_sentences(rng, 16, cls.dictionary))
+            write_tokens(tgt_file, random_sentences(rng, 16, cls.dictionary))
+            cls.dataset = Seq2SeqDataset(src_file, tgt_file, cls.dictionary, cls.dictionary)
+
+    def test_parts(self):
+        pad_idx = self.dictionary.pad_idx
+        for num_samples in (1, 2, 7, 16):
+            sample = self.dataset.collater([self.dataset[i] for i in range(num_samples)])
+            for num_parts in (2, 3):
+                with self.subTest(num_samples=num_samples, num_parts=num_parts):
+                    parts = split_sample(sample, pad_idx, num_parts)
+                    self.assertEqual(len(parts), min(num_parts, num_samples))
+                    # The parts hold the rows of the batch in the same order
+                    self.assertEqual(torch.cat([part['id'] for part in parts]).tolist(), sample['id'].tolist())
+                    self.assertEqual(torch.cat([part['src_lengths'] for part in parts]).tolist(),
+                                     sample['src_lengths'].tolist())
+                    for key in ('src_tokens', 'tgt_tokens', 'tgt_inputs'):
+                        self.assertEqual(sum((unpadded_rows(part[key], pad_idx) for part in parts), []),
+                                         unpadded_rows(sample[key], pad_idx))
+                    self.assertEqual(sum(part['num_tokens'] for part in parts), sample['num_tokens'])
+
+                    # Padding that is no longer needed is removed
+                    for part in parts:
+                        self.assertEqual(part['src_tokens'].size(1), int(part['src_lengths'].max()))
+                        self.assertEqual(part['tgt_tokens'].size(1), int(part['tgt_tokens'].ne(pad_idx).sum(1).max()))
+                        self.assertEqual(part['tgt_inputs'].size(), part['tgt_tokens'].size())
+                        self.assertEqual(part['num_tokens'], int(part['tgt_tokens'].ne(pad_idx).sum()))
+                        self.assertTrue(part['src_tokens'].is_contiguous())
+
+
+class TestStreamingSeq2SeqDataset(unittest.TestCase):
+    """ Every epoch, the shards of a split must be read exactly once across all ranks and data loader workers. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dictionary = Dictionary()
+        for i in range(30):
+            cls.dictionary.add_word('w{:d}'.format(i))
+        cls.data_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        cls.targets = {}
+        for shard_id, num_sentences in enumerate([13, 7, 20, 1, 9]):
+            # The first source token tells the shard of a sentence, as sentence ids are positions within their shard
+            sources = random_sentences(rng, num_sentences, cls.dictionary)
+            sources = [np.concatenate([[cls.shard_token(shard_id)], tokens]).astype(np.int32) for tokens in sources]
+            targets = random_sentences(rng, num_sentences, cls.dictionary)
+            write_tokens(os.path.join(cls.data_dir.name, 'train.{:03d}.jp'.format(shard_id)), sources)
+            write_tokens(os.path.join(cls.data_dir.name, 'train.{:03d}.en'.format(shard_id)), targets)
+            cls.targets.update({(shard_id, i): tokens.tolist() for i, tokens in enumerate(targets)})
+        cls.shards = find_shards(cls.data_dir.name, 'train', 'jp', 'en')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.data_dir.cleanup()
+
+    @classmethod
+    def shard_token(cls, shard_id):
+        return cls.dictionary.num_special + shard_id
+
+    def build_dataset(self, **kwargs):
+        return StreamingSeq2SeqDataset(self.shards, self.dictionary, self.dictionary, max_tokens=40, batch_size=5,
+                                       buffer_size=6, **kwargs)
+
+    def sentences(self, batches):
+        """ Returns the (shard, sentence id) pairs of batches and checks that their targets are those of the shard. """
+        sentences = []
+        for batch in batches:
+            self.assertLessEqual(len(batch['id']), 5)
+            for sent_id, src_tokens, tgt_tokens in zip(batch['id'].tolist(), batch['src_tokens'], batch['tgt_tokens']):
+                sentence = (int(src_tokens[0]) - self.dictionary.num_special, sent_id)
+                self.assertEqual(unpadded_rows(tgt_tokens[None], self.dictionary.pad_idx)[0], self.targets[sentence])
+                sentences.append(sentence)
+        return sentences
+
+    def test_find_shards(self):
+        self.assertEqual(self.shards, [(os.path.join(self.data_dir.name, 'train.{:03d}.jp'.format(shard_id)),
+                                        os.path.join(self.data_dir.name, 'train.{:03d}.en'.format(shard_id)))
+                                       for shard_id in range(5)])
+
+    def test_epochs(self):
+        dataset = self.build_dataset()
+        orders = []
+        for epoch in range(3):
+            with self.subTest(epoch=epoch):
+                dataset.set_epoch(epoch)
+                sentences = self.sentences(dataset)
+                self.assertEqual(sorted(sentences), sorted(self.targets))
+                orders.append(sentences)
+        self.assertNotEqual(orders[0], orders[1])
+
+        # The order of an epoch is reproducible
+        dataset.set_epoch(1)
+        self.assertEqual(self.sentences(dataset), orders[1])
+
+    def test_replicas_and_workers(self):
+        for num_replicas, num_workers in ((1, 2), (2, 1), (2, 2)):
+            with self.subTest(num_replicas=num_replicas, num_workers=num_workers):
+                sentences = []
+                for rank in range(num_replicas):
+                    dataset = self.build_dataset(num_replicas=num_replicas, rank=rank)
+                    dataset.set_epoch(3)
+                    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+                    sentences.extend(self.sentences(loader))
+                self.assertEqual(sorted(sentences), sorted(self.targets))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import pickle
+import argparse
+import tempfile
+import unittest
+
+import torch
+
+from seq2seq import models
+from seq2seq.criterion import ChunkedCrossEntropyCriterion
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import Seq2SeqDataset
+from seq2seq.generator import SequenceGenerator
+from train import compute_loss
+
+
+class TinyModelTestCase(unittest.TestCase):
+    """ Builds small dictionaries, a batch of random sentences of different lengths and tiny models (without dropout by
+    default), so that optimized code paths can be compared with their reference implementations exactly. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.src_dict, cls.tgt_dict = Dictionary(), Dictionary()
+        for i in range(40):
+            cls.src_dict.add_word('s{:d}'.format(i))
+            cls.tgt_dict.add_word('t{:d}'.format(i))
+
+        generator = torch.Generator().manual_seed(0)
+
+        def sentences(dictionary, lengths):
+            return [torch.cat([torch.randint(dictionary.num_special, len(dictionary), (length,), generator=generator),
+                               torch.tensor([dictionary.eos_idx])]).int().numpy() for length in lengths]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            src_file, tgt_file = os.path.join(data_dir, 'test.src'), os.path.join(data_dir, 'test.tgt')
+            with open(src_file, 'wb') as f:
+                pickle.dump(sentences(cls.src_dict, [9, 3, 12, 6, 1, 7]), f)
+            with open(tgt_file, 'wb') as f:
+                pickle.dump(sentences(cls.tgt_dict, [5, 11, 2, 8, 4, 1]), f)
+            cls.dataset = Seq2SeqDataset(src_file, tgt_file, cls.src_dict, cls.tgt_dict)
+            cls.sample = cls.dataset.collater([cls.dataset[i] for i in range(len(cls.dataset))])
+
+    def build_model(self, **model_args):
+        """ Builds a tiny lstm model; models built with the same arguments have the same parameters. """
+        args = argparse.Namespace(arch='lstm', encoder_embed_dim=16, encoder_hidden_size=16, decoder_embed_dim=16,
+                                  decoder_hidden_size=32, encoder_dropout_in=0., encoder_dropout_out=0.,
+                                  decoder_dropout_in=0., decoder_dropout_out=0.)
+        for key, value in model_args.items():
+            setattr(args, key, value)
+        torch.manual_seed(1)
+        return models.build_model(args, self.src_dict, self.tgt_dict)
+
+    def build_trained_model(self, num_updates=60, **model_args):
+        """ Builds a tiny model that has overfitted the batch, so that greedy decoding finishes its sentences after
+        different numbers of steps (or not at all) instead of producing the same output for every sentence. """
+        model = self.build_model(**model_args)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.03)
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=self.tgt_dict.pad_idx, reduction='sum')
+        model.train()
+        for _ in range(num_updates):
+            optimizer.zero_grad()
+            compute_loss(model, criterion, self.sample).backward()
+            optimizer.step()
+        return model.eval()
+
+    def loss_and_gradients(self, model, criterion):
+        """ Returns the loss of the batch and the gradients of the parameters in training mode; the random number
+        generator is reset first, so that models with dropout draw the same dropout masks. """
+        model.train()
+        model.zero_grad()
+        torch.manual_seed(2)
+        loss = compute_loss(model, criterion, self.sample)
+        loss.backward()
+        return loss.detach(), {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+    def assertLossAndGradientsEqual(self, expected, actual):
+        torch.testing.assert_close(actual[0], expected[0])
+        self.assertEqual(actual[1].keys(), expected[1].keys())
+        for name in expected[1]:
+            torch.testing.assert_close(actual[1][name], expected[1][name], msg='gradient of {}'.format(name))
+
+
+class TestLossEquivalence(TinyModelTestCase):
+    """ Optimized training computations must give the same loss and gradients as the plain forward pass. """
+
+    def full_criterion(self):
+        return torch.nn.CrossEntropyLoss(ignore_index=self.tgt_dict.pad_idx, reduction='sum')
+
+    def test_chunked_cross_entropy(self):
+        for model_args in ({}, {'decoder_use_lexical_model': 'True'}, {'decoder_output_rank': 8}):
+            model = self.build_model(**model_args)
+            expected = self.loss_and_gradients(model, self.full_criterion())
+            for chunk_size in (1, 7, 1024):
+                with self.subTest(chunk_size=chunk_size, **model_args):
+                    criterion = ChunkedCrossEntropyCriterion(model.decoder.output_layer, self.tgt_dict.pad_idx,
+                                                             chunk_size)
+                    self.assertLossAndGradientsEqual(expected, self.loss_and_gradients(model, criterion))
+
+    def test_checkpointed_decoder(self):
+        # Dropout masks of the recomputed steps are replayed, so dropout does not change the gradients either
+        for model_args in ({}, {'decoder_use_lexical_model': 'True'},
+                           {'decoder_dropout_in': 0.25, 'decoder_dropout_out': 0.25}):
+            expected = self.loss_and_gradients(self.build_model(**model_args), self.full_criterion())
+            for checkpoint_steps in (1, 3):
+                with self.subTest(checkpoint_steps=checkpoint_steps, **model_args):
+                    model = self.build_model(decoder_checkpoint_steps=checkpoint_steps, **model_args)
+                    self.assertLossAndGradientsEqual(expected, self.loss_and_gradients(model, self.full_criterion()))
+
+
+class TestDecodingEquivalence(TinyModelTestCase):
+    """ Optimized decoding must give the same results as decoding the whole batch, and the same translations as the
+    original greedy search, which decodes the whole prefix of every sentence again at every step. """
+
+    def reference_generate(self, model, max_len):
+        src_tokens, src_lengths = self.sample['src_tokens'], self.sample['src_lengths']
+        with torch.no_grad():
+            encoder_out = model.encoder(src_tokens, src_lengths)
+            prev_words = src_tokens.new_full((src_tokens.size(0), 1), self.tgt_dict.eos_idx)
+            for _ in range(max_len):
+                decoder_out, _ = model.decoder(prev_words, encoder_out)
+                _, next_candidates = torch.topk(decoder_out[:, -1, :], 2, dim=-1)
+                next_words = torch.where(next_candidates[:, 0] == self.tgt_dict.unk_idx, next_candidates[:, 1],
+                                         next_candidates[:, 0])
+                prev_words = torch.cat([prev_words, next_words.unsqueeze(1)], dim=1)
+
+        hypos = []
+        for tokens in prev_words[:, 1:]:
+            eos = tokens.eq(self.tgt_dict.eos_idx).nonzero()
+            hypos.append(tokens[:eos[0, 0]] if len(eos) > 0 else tokens)
+        return hypos
+
+    def test_shrink_batch(self):
+        for model_args in ({}, {'decoder_input_feeding': 'False'}, {'decoder_use_lexical_model': 'True'}):
+            with self.subTest(**model_args):
+                criterion = torch.nn.CrossEntropyLoss(ignore_index=self.tgt_dict.pad_idx, reduction='sum')
+                expected = self.loss_and_gradients(self.build_model(**model_args), criterion)
+                model = self.build_model(decoder_shrink_batch='True', **model_args)
+                self.assertLossAndGradientsEqual(expected, self.loss_and_gradients(model, criterion))
+
+    def test_greedy_generation(self):
+        max_len = 10
+        for model_args in ({}, {'decoder_input_feeding': 'False'}, {'decoder_use_lexical_model': 'True'}):
+            model = self.build_trained_model(**model_args)
+            expected = self.reference_generate(model, max_len)
+            # Sentences must finish at different steps, so that finished sentences are dropped from the batch
+            self.assertGreater(len(set(len(hypo) for hypo in expected)), 2)
+            self.assertIn(max_len, [len(hypo) for hypo in expected])
+
+            for name, step_module in (('incremental', None), ('step', model.build_step_module(script=False)),
+                                      ('scripted', model.build_step_module(script=True))):
+                with self.subTest(generator=name, **model_args):
+                    generator = SequenceGenerator(model, self.tgt_dict, max_len=max_len, step_module=step_module)
+                    hypos = generator.generate(self.sample['src_tokens'], self.sample['src_lengths'])
+                    self.assertEqual([hypo.tolist() for hypo in hypos], [hypo.tolist() for hypo in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from seq2seq.data.dataset import MMapTokens, load_tokens
+from sweep import median_stop, share_data
+
+
+class TestShareData(unittest.TestCase):
+
+    def test_converts_only_splits(self):
+        rng = np.random.RandomState(0)
+        splits = {file: [rng.randint(4, 20, size=rng.randint(1, 10)).astype(np.int32) for _ in range(15)]
+                  for file in ('train.jp', 'train.en', 'valid.en', 'train.001.en')}
+        with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as shared_dir:
+            for file, tokens_list in splits.items():
+                with open(os.path.join(data_dir, file), 'wb') as f:
+                    pickle.dump(tokens_list, f)
+            for file in ('dict.jp', 'dict.en'):
+                with open(os.path.join(data_dir, file), 'w') as f:
+                    f.write('word 1\n')
+            # Files that are neither dictionaries nor splits of the languages are not unpickled
+            for file in ('notes.txt', 'train.en.orig', 'train.de'):
+                with open(os.path.join(data_dir, file), 'w') as f:
+                    f.write('not a pickle\n')
+
+            share_data(data_dir, shared_dir)
+            self.assertEqual(sorted(os.listdir(shared_dir)), sorted(
+                ['dict.jp', 'dict.en'] + [file + suffix for file in splits for suffix in ('.bin.npy', '.idx.npy')]))
+            for file, tokens_list in splits.items():
+                with self.subTest(file=file):
+                    tokens = load_tokens(os.path.join(shared_dir, file))
+                    self.assertIsInstance(tokens, MMapTokens)
+                    self.assertEqual([t.tolist() for t in tokens], [t.tolist() for t in tokens_list])
+
+
+class TestMedianStop(unittest.TestCase):
+
+    def test_grace_epochs(self):
+        self.assertFalse(median_stop([100.], [[10.], [10.], [10.]], grace_epochs=2, min_trials=3))
+        self.assertTrue(median_stop([100., 100.], [[10., 9.], [10., 9.], [10., 9.]], grace_epochs=2, min_trials=3))
+
+    def test_min_trials(self):
+        others = [[10., 9.], [10., 9.], [10.]]
+        # Only the other trials that have reached the same epoch are compared with
+        self.assertFalse(median_stop([100., 100.], others, grace_epochs=1, min_trials=3))
+        self.assertTrue(median_stop([100., 100.], others, grace_epochs=1, min_trials=2))
+        self.assertFalse(median_stop([100., 100.], others, grace_epochs=1, min_trials=0))
+
+    def test_median_of_best_perplexities(self):
+        # The best perplexities of the other trials after two epochs are 5, 8 and 20, whose median is 8
+        others = [[9., 5., 1.], [8., 12., 1.], [30., 20.]]
+        self.assertFalse(median_stop([12., 8.], others, grace_epochs=1, min_trials=1))
+        self.assertTrue(median_stop([12., 8.5], others, grace_epochs=1, min_trials=1))
+        # The best perplexity of the trial itself counts, not its latest one
+        self.assertFalse(median_stop([7., 50.], others, grace_epochs=1, min_trials=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
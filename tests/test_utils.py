@@ -0,0 +1,67 @@
+import argparse
+import unittest
+
+from seq2seq import utils
+
+
+class TestMergeCheckpointArgs(unittest.TestCase):
+
+    def setUp(self):
+        self.checkpoint_args = argparse.Namespace(arch='lstm', encoder_embed_dim=64, data='prepared_data',
+                                                  source_lang='jp', target_lang='en', num_workers=4, batch_size=10,
+                                                  cuda=False)
+
+    def test_options_of_the_entry_point_are_kept(self):
+        args = argparse.Namespace(num_workers=1, batch_size=None, max_tokens=2000, cuda=True)
+        merged = utils.merge_checkpoint_args(args, self.checkpoint_args)
+        self.assertEqual(merged.num_workers, 1)
+        self.assertIsNone(merged.batch_size)
+        self.assertEqual(merged.max_tokens, 2000)
+        self.assertIs(merged.cuda, True)
+
+    def test_model_args_come_from_the_checkpoint(self):
+        merged = utils.merge_checkpoint_args(argparse.Namespace(num_workers=1), self.checkpoint_args)
+        self.assertEqual(merged.arch, 'lstm')
+        self.assertEqual(merged.encoder_embed_dim, 64)
+
+    def test_data_args_fall_back_to_the_checkpoint(self):
+        args = argparse.Namespace(data=None, source_lang=None, target_lang=None)
+        merged = utils.merge_checkpoint_args(args, self.checkpoint_args)
+        self.assertEqual((merged.data, merged.source_lang, merged.target_lang), ('prepared_data', 'jp', 'en'))
+
+        # Undefined data options are taken from the checkpoint as well
+        merged = utils.merge_checkpoint_args(argparse.Namespace(), self.checkpoint_args)
+        self.assertEqual((merged.data, merged.source_lang, merged.target_lang), ('prepared_data', 'jp', 'en'))
+
+    def test_given_data_args_win(self):
+        args = argparse.Namespace(data='other_data', source_lang=None, target_lang='de')
+        merged = utils.merge_checkpoint_args(args, self.checkpoint_args)
+        self.assertEqual((merged.data, merged.source_lang, merged.target_lang), ('other_data', 'jp', 'de'))
+
+    def test_arguments_are_not_modified(self):
+        args = argparse.Namespace(data=None, num_workers=1)
+        utils.merge_checkpoint_args(args, self.checkpoint_args)
+        self.assertIsNone(args.data)
+        self.assertEqual(self.checkpoint_args.num_workers, 4)
+
+
+class TestStr2Bool(unittest.TestCase):
+
+    def test_values(self):
+        for value in ('True', 'true', 'yes', '1', True):
+            self.assertIs(utils.str2bool(value), True)
+        for value in ('False', 'FALSE', 'no', '0', False):
+            self.assertIs(utils.str2bool(value), False)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            utils.str2bool('maybe')
+
+    def test_option(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--cuda', default=False, type=utils.str2bool)
+        self.assertIs(parser.parse_args([]).cuda, False)
+        self.assertIs(parser.parse_args(['--cuda', 'False']).cuda, False)
+        self.assertIs(parser.parse_args(['--cuda', 'True']).cuda, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
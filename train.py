@@ -1,7 +1,9 @@
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = "2"
+import contextlib
 import logging
 import argparse
+import math
+import time
 import numpy as np
 from tqdm import tqdm
 from collections import OrderedDict
@@ -9,17 +11,23 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 
-from seq2seq import models, utils
+from seq2seq import bleu, memory, models, runtime, utils
+from seq2seq.criterion import ChunkedCrossEntropyCriterion
+from seq2seq.generator import SequenceGenerator
 from seq2seq.data.dictionary import Dictionary
-from seq2seq.data.dataset import Seq2SeqDataset, BatchSampler
+from seq2seq.data.dataset import Seq2SeqDataset, StreamingSeq2SeqDataset, BatchSampler, find_shards
 from seq2seq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
 
 
-def get_args():
-    """ Defines training-specific hyper-parameters. """
+def get_args(argv=None):
+    """ Defines training-specific hyper-parameters. Arguments are parsed from argv (default: the command line). """
     parser = argparse.ArgumentParser('Sequence to Sequence Model')
-    parser.add_argument('--cuda', default=False, help='Use a GPU')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
     parser.add_argument('--cuda_id',default=0,type=int)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of the forward pass (bf16 uses autocast with fp32 master weights)')
+    runtime.add_runtime_args(parser)
+    memory.add_memory_args(parser)
 
     # Add data arguments
     parser.add_argument('--data', default='prepared_data', help='path to data directory')
@@ -28,6 +36,22 @@ def get_args():
     parser.add_argument('--max-tokens', default=None, type=int, help='maximum number of tokens in a batch')
     parser.add_argument('--batch-size', default=1, type=int, help='maximum number of sentences in a batch')
     parser.add_argument('--train-on-tiny', action='store_true', help='train model on a tiny dataset')
+    parser.add_argument('--streaming', action='store_true',
+                        help='stream the training data from its shards (see preprocess.py --num-shards) instead of '
+                             'loading it into memory')
+    parser.add_argument('--buffer-size', default=100000, type=int,
+                        help='number of sentences that are sorted by length and batched together when streaming')
+    parser.add_argument('--num-workers', default=1, type=int, help='number of data loader worker processes')
+    parser.add_argument('--valid-max-tokens', default=None, type=int,
+                        help='maximum number of tokens in a validation batch (overrides --max-tokens/--batch-size)')
+    parser.add_argument('--valid-subset-size', default=None, type=int,
+                        help='validate on a fixed random subset of this many sentences')
+    parser.add_argument('--validate-bleu-every', default=None, type=int,
+                        help='compute greedy-decoding BLEU on the validation set every N epochs')
+    parser.add_argument('--validate-bleu-max-len', default=25, type=int,
+                        help='maximum length of sequences generated for BLEU validation')
+    parser.add_argument('--validate-bleu-time-budget', default=None, type=float,
+                        help='stop generating for BLEU validation after this many seconds and score what was decoded')
 
     # Add model arguments
     parser.add_argument('--arch', default='lstm', choices=ARCH_MODEL_REGISTRY.keys(), help='model architecture')
@@ -35,9 +59,16 @@ def get_args():
     # Add optimization arguments
     parser.add_argument('--max-epoch', default=10000, type=int, help='force stop training at specified epoch')
     parser.add_argument('--clip-norm', default=4.0, type=float, help='clip threshold of gradients')
+    parser.add_argument('--update-freq', default=1, type=int,
+                        help='accumulate gradients over N batches before each parameter update')
+    parser.add_argument('--loss-chunk-size', default=None, type=int,
+                        help='compute the output projection and loss over N target tokens at a time, without '
+                             'materializing the logits of the whole batch')
     parser.add_argument('--lr', default=0.0003, type=float, help='learning rate')
     parser.add_argument('--patience', default=5, type=int,
                         help='number of epochs without improvement on validation set before early stopping')
+    parser.add_argument('--best-checkpoint-metric', default='loss', choices=['loss', 'bleu'],
+                        help='validation metric used to select the best checkpoint and for early stopping')
 
     # Add checkpoint arguments
     parser.add_argument('--log-file', default=None, help='path to save logs')
@@ -49,22 +80,26 @@ def get_args():
 
 
     # Parse twice as model arguments are not known the first time
-    args, _ = parser.parse_known_args()
+    args, _ = parser.parse_known_args(argv)
     model_parser = parser.add_argument_group(argument_default=argparse.SUPPRESS)
     ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     ARCH_CONFIG_REGISTRY[args.arch](args)
+    if args.best_checkpoint_metric == 'bleu' and args.validate_bleu_every is None:
+        args.validate_bleu_every = 1
     return args
 
 
-def main(args):
+def main(args, epoch_callback=None):
     """ Main training function. Trains the translation model over the course of several epochs, including dynamic
-    learning rate adjustment and gradient clipping. """
+    learning rate adjustment and gradient clipping. If given, epoch_callback is called with the epoch and the
+    validation perplexity after every epoch, and training stops when it returns True. """
 
     logging.info('Commencing training!')
     torch.manual_seed(42)
 
     utils.init_logging(args)
+    runtime.configure(args)
 
     # set up cuda device
     cuda_device = torch.device(f'cuda:{args.cuda_id}')
@@ -82,13 +117,24 @@ def main(args):
             tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(split, args.target_lang)),
             src_dict=src_dict, tgt_dict=tgt_dict)
 
-    train_dataset = load_data(split='train') if not args.train_on_tiny else load_data(split='tiny_train')
+    train_split = 'train' if not args.train_on_tiny else 'tiny_train'
+    if args.streaming:
+        shards = find_shards(args.data, train_split, args.source_lang, args.target_lang)
+        logging.info('Streaming the training data from {:d} shards'.format(len(shards)))
+        train_dataset = StreamingSeq2SeqDataset(shards, src_dict, tgt_dict, args.max_tokens, args.batch_size,
+                                                args.buffer_size, shuffle=True, seed=42)
+    else:
+        train_dataset = load_data(split=train_split)
     valid_dataset = load_data(split='valid')
+    valid_batches = load_valid_batches(args, valid_dataset)
 
     # Build model and optimization criterion
     model = models.build_model(args, src_dict, tgt_dict)
     logging.info('Built a model with {:d} parameters'.format(sum(p.numel() for p in model.parameters())))
-    criterion = nn.CrossEntropyLoss(ignore_index=src_dict.pad_idx, reduction='sum')
+    if args.loss_chunk_size is not None:
+        criterion = ChunkedCrossEntropyCriterion(model.decoder.output_layer, tgt_dict.pad_idx, args.loss_chunk_size)
+    else:
+        criterion = nn.CrossEntropyLoss(ignore_index=src_dict.pad_idx, reduction='sum')
     if args.cuda:
         model = model.cuda()
         criterion = criterion.cuda()
@@ -100,15 +146,29 @@ def main(args):
     state_dict = utils.load_checkpoint(args, model, optimizer)  # lr_scheduler
     last_epoch = state_dict['last_epoch'] if state_dict is not None else -1
 
-    # Track validation performance for early stopping
+    # Record the peak memory of every batch and split batches that are expected to exceed --max-memory
+    monitor = None
+    if args.log_memory or args.max_memory is not None:
+        monitor = memory.MemoryMonitor(memory.training_cost, args.cuda, args.max_memory)
+
+    # Track validation performance for early stopping (lower is better, so BLEU is negated)
     bad_epochs = 0
     best_validate = float('inf')
 
     for epoch in range(last_epoch + 1, args.max_epoch):
-        train_loader = \
-            torch.utils.data.DataLoader(train_dataset, num_workers=1, collate_fn=train_dataset.collater,
-                                        batch_sampler=BatchSampler(train_dataset, args.max_tokens, args.batch_size, 1,
-                                                                   0, shuffle=True, seed=42))
+        if args.streaming:
+            # Batches are collated by the dataset, and their number is not known in advance
+            train_dataset.set_epoch(epoch)
+            train_loader = \
+                torch.utils.data.DataLoader(train_dataset, batch_size=None, num_workers=args.num_workers,
+                                            worker_init_fn=runtime.data_worker_init_fn())
+        else:
+            train_loader = \
+                torch.utils.data.DataLoader(train_dataset, num_workers=args.num_workers,
+                                            collate_fn=train_dataset.collater,
+                                            worker_init_fn=runtime.data_worker_init_fn(),
+                                            batch_sampler=BatchSampler(train_dataset, args.max_tokens, args.batch_size,
+                                                                       1, 0, shuffle=True, seed=42))
         model.train()
         stats = OrderedDict()
         stats['loss'] = 0
@@ -117,18 +177,26 @@ def main(args):
         stats['batch_size'] = 0
         stats['grad_norm'] = 0
         stats['clip'] = 0
-        # Display progress
-        progress_bar = tqdm(train_loader, desc='| Epoch {:03d}'.format(epoch), leave=False, disable=False)
+        # Display progress; each step of the progress bar is one parameter update over args.update_freq batches
+        num_updates = int(math.ceil(len(train_loader) / args.update_freq)) if not args.streaming else None
+        progress_bar = tqdm(utils.grouped_iterator(train_loader, args.update_freq), total=num_updates,
+                            desc='| Epoch {:03d}'.format(epoch), leave=False, disable=False)
 
         # Iterate over the training set
-        for i, sample in enumerate(progress_bar):
+        for i, samples in enumerate(progress_bar):
             if args.cuda:
-                sample = utils.move_to_cuda(sample)
-            if len(sample) == 0:
+                samples = utils.move_to_cuda(samples)
+            samples = [sample for sample in samples if len(sample) > 0]
+            if len(samples) == 0:
                 continue
+            if monitor is not None:
+                # Parts of split batches are accumulated like any other batch, so the update does not change
+                samples = [part for sample in samples for part in monitor.split(sample, tgt_dict.pad_idx)]
             model.train()
-            
-            # print(sample['src_tokens'].device, sample['src_lengths'].device, sample['tgt_inputs'].device)
+
+            # Normalize the summed loss by the number of sentences across all accumulated batches
+            num_sentences = sum(len(sample['src_lengths']) for sample in samples)
+            total_loss = 0.
             '''
             ___QUESTION-1-DESCRIBE-F-START___
             Describe what the following lines of code do.
@@ -138,54 +206,103 @@ def main(args):
             Gradient clipping is then conducted to prevent the gradients from getting too large.
             Then we perform one-step update and then reset the gradients to 0.
             '''
-            output, _ = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
-            loss = \
-                criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1)) / len(sample['src_lengths'])
-            loss.backward()
+            for j, sample in enumerate(samples):
+                # Under DistributedDataParallel, gradients only need to be synchronized after the last micro-batch
+                is_last = j == len(samples) - 1
+                with model.no_sync() if not is_last and hasattr(model, 'no_sync') else contextlib.nullcontext():
+                    with monitor.step(sample) if monitor is not None else contextlib.nullcontext():
+                        with utils.autocast(args.precision, args.cuda):
+                            loss = compute_loss(model, criterion, sample) / num_sentences
+                        loss.backward()
+                total_loss += loss.item()
             grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_norm)
             optimizer.step()
             optimizer.zero_grad()
             '''___QUESTION-1-DESCRIBE-F-END___'''
 
             # Update statistics for progress bar
-            total_loss, num_tokens, batch_size = loss.item(), sample['num_tokens'], len(sample['src_tokens'])
-            stats['loss'] += total_loss * len(sample['src_lengths']) / sample['num_tokens']
+            num_tokens = sum(sample['num_tokens'] for sample in samples)
+            stats['loss'] += total_loss * num_sentences / num_tokens
             stats['lr'] += optimizer.param_groups[0]['lr']
-            stats['num_tokens'] += num_tokens / len(sample['src_tokens'])
-            stats['batch_size'] += batch_size
+            stats['num_tokens'] += num_tokens / num_sentences
+            stats['batch_size'] += num_sentences
             stats['grad_norm'] += grad_norm
             stats['clip'] += 1 if grad_norm > args.clip_norm else 0
             progress_bar.set_postfix({key: '{:.4g}'.format(value / (i + 1)) for key, value in stats.items()},
                                      refresh=True)
 
         logging.info('Epoch {:03d}: {}'.format(epoch, ' | '.join(key + ' {:.4g}'.format(
-            value / len(progress_bar)) for key, value in stats.items())))
+            value / max(progress_bar.n, 1)) for key, value in stats.items())))
+        if monitor is not None:
+            logging.info('Epoch {:03d}: memory {}'.format(epoch, monitor.summary()))
+            monitor.reset()
 
         # Calculate validation loss
-        valid_perplexity = validate(args, model, criterion, valid_dataset, epoch)
+        valid_perplexity = validate(args, model, criterion, valid_batches, epoch)
+        valid_score = valid_perplexity if args.best_checkpoint_metric == 'loss' else float('inf')
+        if args.validate_bleu_every is not None and (epoch + 1) % args.validate_bleu_every == 0:
+            valid_bleu = validate_bleu(args, model, tgt_dict, valid_batches, epoch)
+            if args.best_checkpoint_metric == 'bleu':
+                valid_score = -valid_bleu
         model.train()
 
         # Save checkpoints
         if epoch % args.save_interval == 0:
-            utils.save_checkpoint(args, model, optimizer, epoch, valid_perplexity)  # lr_scheduler
+            utils.save_checkpoint(args, model, optimizer, epoch, valid_score)  # lr_scheduler
 
-        # Check whether to terminate training
-        if valid_perplexity < best_validate:
-            best_validate = valid_perplexity
+        # Check whether to terminate training (epochs without a BLEU evaluation do not count towards patience)
+        if epoch_callback is not None and epoch_callback(epoch, valid_perplexity):
+            logging.info('Stopped by the epoch callback after epoch {:03d}'.format(epoch))
+            break
+        if valid_score < best_validate:
+            best_validate = valid_score
             bad_epochs = 0
-        else:
+        elif valid_score < float('inf'):
             bad_epochs += 1
         if bad_epochs >= args.patience:
             logging.info('No validation set improvements observed for {:d} epochs. Early stop!'.format(args.patience))
             break
 
+    if monitor is not None:
+        monitor.close()
+
+
+def load_valid_batches(args, valid_dataset):
+    """ Collates the validation batches once, so that they can be reused at the end of every epoch. """
+    if args.valid_max_tokens is not None:
+        batch_sampler = BatchSampler(valid_dataset, args.valid_max_tokens, None, 1, 0, shuffle=False, seed=42)
+    else:
+        batch_sampler = BatchSampler(valid_dataset, args.max_tokens, args.batch_size, 1, 0, shuffle=False, seed=42)
+    batches = list(batch_sampler)
 
-def validate(args, model, criterion, valid_dataset, epoch):
+    # Optionally restrict validation to a fixed random subset of sentences (for cheaper early stopping signals)
+    if args.valid_subset_size is not None and args.valid_subset_size < len(valid_dataset):
+        subset = set(np.random.RandomState(42).choice(
+            len(valid_dataset), args.valid_subset_size, replace=False).tolist())
+        batches = [[idx for idx in batch if idx in subset] for batch in batches]
+
+    valid_batches = [valid_dataset.collater([valid_dataset[idx] for idx in batch])
+                     for batch in batches if len(batch) > 0]
+    if args.cuda:
+        valid_batches = utils.move_to_cuda(valid_batches)
+    logging.info('Cached {:d} validation batches with {:d} sentences'.format(
+        len(valid_batches), sum(len(sample['src_lengths']) for sample in valid_batches)))
+    return valid_batches
+
+
+def compute_loss(model, criterion, sample, need_attn=True):
+    """ Returns the summed cross-entropy of a batch. A chunked criterion is given the decoder features instead of the
+    logits, so that it can compute the output projection itself. """
+    if isinstance(criterion, ChunkedCrossEntropyCriterion):
+        features, _ = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'], need_attn=False,
+                            features_only=True)
+        return criterion(features, sample['tgt_tokens'])
+    output, _ = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'], need_attn=need_attn)
+    return criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1))
+
+
+def validate(args, model, criterion, valid_batches, epoch):
     """ Validates model performance on a held-out development set. """
-    valid_loader = \
-        torch.utils.data.DataLoader(valid_dataset, num_workers=1, collate_fn=valid_dataset.collater,
-                                    batch_sampler=BatchSampler(valid_dataset, args.max_tokens, args.batch_size, 1, 0,
-                                                               shuffle=False, seed=42))
     model.eval()
     stats = OrderedDict()
     stats['valid_loss'] = 0
@@ -193,15 +310,10 @@ def validate(args, model, criterion, valid_dataset, epoch):
     stats['batch_size'] = 0
 
     # Iterate over the validation set
-    for i, sample in enumerate(valid_loader):
-        if args.cuda:
-            sample = utils.move_to_cuda(sample)
-        if len(sample) == 0:
-            continue
-        with torch.no_grad():
-            # Compute loss
-            output, attn_scores = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
-            loss = criterion(output.view(-1, output.size(-1)), sample['tgt_tokens'].view(-1))
+    for i, sample in enumerate(valid_batches):
+        with torch.inference_mode(), utils.autocast(args.precision, args.cuda):
+            # Compute loss; attention weights are not needed here and are not materialized
+            loss = compute_loss(model, criterion, sample, need_attn=False)
         # Update tracked statistics
         stats['valid_loss'] += loss.item()
         stats['num_tokens'] += sample['num_tokens']
@@ -219,6 +331,29 @@ def validate(args, model, criterion, valid_dataset, epoch):
     return perplexity
 
 
+def validate_bleu(args, model, tgt_dict, valid_batches, epoch):
+    """ Translates the cached validation batches with greedy decoding and computes corpus BLEU over token ids. If a
+    time budget is given, generation stops once it is exceeded and only the translated batches are scored. """
+    model.eval()
+    generator = SequenceGenerator(model, tgt_dict, max_len=args.validate_bleu_max_len)
+    hypotheses, references = [], []
+    start_time = time.perf_counter()
+
+    for sample in valid_batches:
+        with utils.autocast(args.precision, args.cuda):
+            hypotheses.extend(generator.generate(sample['src_tokens'], sample['src_lengths']))
+        for tgt_tokens in sample['tgt_tokens']:
+            references.append(tgt_tokens[tgt_tokens.ne(tgt_dict.pad_idx) & tgt_tokens.ne(tgt_dict.eos_idx)])
+        if args.validate_bleu_time_budget is not None and \
+                time.perf_counter() - start_time > args.validate_bleu_time_budget:
+            break
+
+    score = bleu.corpus_bleu(hypotheses, references)
+    logging.info('Epoch {:03d}: valid_{} | sentences {:d} | time {:.3g}s'.format(
+        epoch, bleu.format_score(score), len(hypotheses), time.perf_counter() - start_time))
+    return 100 * score.score
+
+
 if __name__ == '__main__':
     args = get_args()
     args.device_id = 0
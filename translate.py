@@ -1,30 +1,59 @@
 import os
+import itertools
 import logging
 import argparse
-import numpy as np
-from tqdm import tqdm
+import collections
+import contextlib
+import functools
+from collections import deque
 
 import torch
 from torch.serialization import default_restore_location
 
-from seq2seq import models, utils
+from seq2seq import memory, models, runtime, utils
 from seq2seq.data.dictionary import Dictionary
-from seq2seq.data.dataset import Seq2SeqDataset, BatchSampler
+from seq2seq.data.dataset import Seq2SeqDataset, GenerationBatchSampler
+from seq2seq.generator import SequenceGenerator
 
 
 def get_args():
     """ Defines generation-specific hyper-parameters. """
     parser = argparse.ArgumentParser('Sequence to Sequence Model')
-    parser.add_argument('--cuda', default=False, help='Use a GPU')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of generation (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    memory.add_memory_args(parser)
     parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
 
     # Add data arguments
-    parser.add_argument('--data', default='data-bin', help='path to data directory')
+    parser.add_argument('--data', default=None,
+                        help='path to data directory (default: the data directory of the checkpoint)')
     parser.add_argument('--checkpoint-path', default='checkpoints/checkpoint_best.pt', help='path to the model file')
     parser.add_argument('--batch-size', default=None, type=int, help='maximum number of sentences in a batch')
+    parser.add_argument('--max-tokens', default=None, type=int,
+                        help='maximum number of source and expected output tokens in a batch (default: 4096 if '
+                             'neither --batch-size nor --max-tokens is given)')
     parser.add_argument('--output', default='model_translations.txt', type=str,
                         help='path to the output file destination')
+    parser.add_argument('--input', default=None, type=str,
+                        help='translate a raw text file line by line instead of the preprocessed test split')
+    parser.add_argument('--window-size', default=10000, type=int,
+                        help='number of input lines sorted by length and translated together in --input mode')
+    parser.add_argument('--num-workers', default=1, type=int,
+                        help='number of translation processes in --input mode, each pinned to a slice of the cores')
+    parser.add_argument('--cache-size', default=0, type=int,
+                        help='keep up to N translations of repeated source sentences in memory (--input mode)')
+    parser.add_argument('--cache-path', default=None, type=str,
+                        help='SQLite file that persists cached translations across runs (--input mode)')
     parser.add_argument('--max-len', default=25, type=int, help='maximum length of generated sequence')
+    parser.add_argument('--script-step', action='store_true',
+                        help='decode with a TorchScript-compiled single-step inference module')
+    parser.add_argument('--save-step-module', default=None, type=str,
+                        help='path to save the TorchScript-compiled inference module to (e.g. for serving)')
+    parser.add_argument('--bleu-reference', default=None, type=str,
+                        help='path to a raw reference file to compute corpus BLEU of the translations against')
+    parser.add_argument('--bleu-lowercase', action='store_true', help='compute case-insensitive BLEU (like -lc)')
 
     return parser.parse_args()
 
@@ -34,16 +63,17 @@ def main(args):
     # Load arguments from checkpoint
     torch.manual_seed(args.seed)
     state_dict = torch.load(args.checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
-    if_cuda = args.cuda
-    args = argparse.Namespace(**{**vars(args), **vars(state_dict['args'])})
-    args.cuda = if_cuda
+    args = utils.merge_checkpoint_args(args, state_dict['args'])
+    if args.batch_size is None and args.max_tokens is None:
+        args.max_tokens = 4096
     utils.init_logging(args)
+    runtime.configure(args)
 
-    # Load dictionaries
-    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
-    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
-    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
-    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+    # Translate raw text in a streaming fashion
+    if args.input is not None:
+        return translate_file(args, state_dict)
+
+    src_dict, tgt_dict, model = load_model(args, state_dict)
 
     # Load dataset
     test_dataset = Seq2SeqDataset(
@@ -52,76 +82,194 @@ def main(args):
         src_dict=src_dict, tgt_dict=tgt_dict)
 
     test_loader = torch.utils.data.DataLoader(test_dataset, num_workers=1, collate_fn=test_dataset.collater,
-                                              batch_sampler=BatchSampler(test_dataset, 9999999,
-                                                                         args.batch_size, 1, 0, shuffle=False,
-                                                                         seed=args.seed))
-    # Build model and criterion
-    model = models.build_model(args, src_dict, tgt_dict)
-    if args.cuda:
-        model = model.cuda()
-    model.eval()
-    model.load_state_dict(state_dict['model'])
-    logging.info('Loaded a model from checkpoint {:s}'.format(args.checkpoint_path))
+                                              worker_init_fn=runtime.data_worker_init_fn(),
+                                              batch_sampler=GenerationBatchSampler(test_dataset.src_sizes,
+                                                                                   args.max_tokens, args.batch_size,
+                                                                                   args.max_len))
+
+    # Optionally export the compiled decoder step for serving
+    if args.save_step_module is not None:
+        model.build_step_module(script=True).save(args.save_step_module)
+        logging.info('Saved a TorchScript inference module to {:s}'.format(args.save_step_module))
+    generator = build_generator(args, model, tgt_dict)
+    from tqdm import tqdm
     progress_bar = tqdm(test_loader, desc='| Generation', leave=False)
 
-    
-    #print(args.cuda)
-    # Iterate over the test set
-    all_hyps = {}
+    # Record the peak memory of every batch and split batches that are expected to exceed --max-memory
+    monitor = None
+    if args.log_memory or args.max_memory is not None:
+        monitor = memory.MemoryMonitor(functools.partial(memory.generation_cost, max_len=args.max_len),
+                                       args.cuda, args.max_memory)
+
+    # Iterate over the test set; translations are put back into their original position
+    all_hyps = [None] * len(test_dataset)
     for i, sample in enumerate(progress_bar):
-        
-        if args.cuda == 'True':
+        if args.cuda:
             sample = utils.move_to_cuda(sample)
-           # print('66666')
-        #print(args.cuda,type(args.cuda))	
-        #print(sample['src_tokens'].device)
-        with torch.no_grad():
-            # Compute the encoder output
-            encoder_out = model.encoder(sample['src_tokens'], sample['src_lengths'])
-            go_slice = \
-                torch.ones(sample['src_tokens'].shape[0], 1).fill_(tgt_dict.eos_idx).type_as(sample['src_tokens'])
-            prev_words = go_slice
-            next_words = None
-
-        for _ in range(args.max_len):
-            with torch.no_grad():
-                # Compute the decoder output by repeatedly feeding it the decoded sentence prefix
-                decoder_out, _ = model.decoder(prev_words, encoder_out)
-            # Suppress <UNK>s
-            _, next_candidates = torch.topk(decoder_out, 2, dim=-1)
-            best_candidates = next_candidates[:, :, 0]
-            backoff_candidates = next_candidates[:, :, 1]
-            next_words = torch.where(best_candidates == tgt_dict.unk_idx, backoff_candidates, best_candidates)
-            prev_words = torch.cat([go_slice, next_words], dim=1)
-
-        # Segment into sentences
-        decoded_batch = next_words.numpy()
-        output_sentences = [decoded_batch[row, :] for row in range(decoded_batch.shape[0])]
-        assert(len(output_sentences) == len(sample['id'].data))
-
-        # Remove padding
-        temp = list()
-        for sent in output_sentences:
-            first_eos = np.where(sent == tgt_dict.eos_idx)[0]
-            if len(first_eos) > 0:
-                temp.append(sent[:first_eos[0]])
-            else:
-                temp.append([])
-        output_sentences = temp
-
-        # Convert arrays of indices into strings of words
-        output_sentences = [tgt_dict.string(sent) for sent in output_sentences]
-
-        # Save translations
-        assert(len(output_sentences) == len(sample['id'].data))
-        for ii, sent in enumerate(output_sentences):
-            all_hyps[int(sample['id'].data[ii])] = sent
+
+        for part in monitor.split(sample, tgt_dict.pad_idx) if monitor is not None else [sample]:
+            # Convert arrays of indices into strings of words
+            with monitor.step(part) if monitor is not None else contextlib.nullcontext():
+                with utils.autocast(args.precision, args.cuda):
+                    hypos = generator.generate(part['src_tokens'], part['src_lengths'])
+            output_sentences = [tgt_dict.string(hypo) for hypo in hypos]
+
+            # Save translations
+            assert(len(output_sentences) == len(part['id'].data))
+            for sent_id, sent in zip(part['id'].tolist(), output_sentences):
+                all_hyps[sent_id] = sent
+
+    if monitor is not None:
+        logging.info('Generation memory: {}'.format(monitor.summary()))
+        monitor.close()
 
     # Write to file
     if args.output is not None:
         with open(args.output, 'w') as out_file:
-            for sent_id in range(len(all_hyps.keys())):
-                out_file.write(all_hyps[sent_id] + '\n')
+            out_file.writelines(sent + '\n' for sent in all_hyps)
+
+    # Score translations against the raw reference
+    if args.bleu_reference is not None:
+        from seq2seq import bleu
+        with open(args.bleu_reference) as ref_file:
+            references = [line.rstrip('\n') for line in ref_file]
+        logging.info(bleu.format_score(bleu.corpus_bleu(all_hyps, references, lowercase=args.bleu_lowercase)))
+
+
+def load_model(args, state_dict):
+    """ Loads the dictionaries and builds the model from a checkpoint (args must already include the model args). """
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+
+    model = models.build_model(args, src_dict, tgt_dict)
+    if args.cuda:
+        model = model.cuda()
+    model.eval()
+    model.load_state_dict(state_dict['model'])
+    logging.info('Loaded a model from checkpoint {:s}'.format(args.checkpoint_path))
+    return src_dict, tgt_dict, model
+
+
+def build_generator(args, model, tgt_dict):
+    step_module = model.build_step_module(script=True) if args.script_step else None
+    return SequenceGenerator(model, tgt_dict, max_len=args.max_len, step_module=step_module)
+
+
+def build_cache(args):
+    """ Creates a translation cache for the checkpoint and decoding settings, unless caching is disabled. """
+    if args.cache_size <= 0 and args.cache_path is None:
+        return None
+    from seq2seq.cache import TranslationCache, checkpoint_hash
+    settings = {'max_len': args.max_len, 'precision': args.precision}
+    return TranslationCache(checkpoint_hash(args.checkpoint_path), settings, args.cache_size, args.cache_path)
+
+
+def translate_lines(args, src_dict, tgt_dict, generator, lines, cache=None):
+    """ Translates a window of raw source lines, in the original order. With a cache, only distinct sentences that
+    have not been translated before are passed to the model. """
+    from preprocess import word_tokenize
+    src_sentences = [src_dict.binarize(line, word_tokenize).long() for line in lines]
+    if cache is not None:
+        return cache.translate(src_sentences, lambda novel_sentences: translate_sentences(
+            args, src_dict, tgt_dict, generator, novel_sentences))
+    return translate_sentences(args, src_dict, tgt_dict, generator, src_sentences)
+
+
+def translate_sentences(args, src_dict, tgt_dict, generator, src_sentences):
+    """ Translates binarized source sentences. Sentences are sorted by length, so that batches contain sentences of
+    similar length, and the translations are returned in the original order. """
+    batch_sampler = GenerationBatchSampler([len(src_tokens) for src_tokens in src_sentences], args.max_tokens,
+                                           args.batch_size, args.max_len)
+    translations = [None] * len(src_sentences)
+
+    for batch in batch_sampler:
+        src_lengths = torch.LongTensor([len(src_sentences[i]) for i in batch])
+        src_tokens = torch.full((len(batch), int(src_lengths[0])), src_dict.pad_idx, dtype=torch.long)
+        for row, i in enumerate(batch):
+            src_tokens[row, :src_lengths[row]] = src_sentences[i]
+        if args.cuda:
+            src_tokens, src_lengths = utils.move_to_cuda(src_tokens), utils.move_to_cuda(src_lengths)
+        with utils.autocast(args.precision, args.cuda):
+            hypos = generator.generate(src_tokens, src_lengths)
+        for i, hypo in zip(batch, hypos):
+            translations[i] = tgt_dict.string(hypo)
+    return translations
+
+
+# Per-process translation state of --input workers
+_worker = {}
+
+
+def init_worker(args, state_dict, core_slices):
+    """ Pins a worker process to its slice of the cores and loads the model once. """
+    runtime.pin(core_slices.get(), args.num_threads)
+    logging.info('Worker {:d} runtime: {}'.format(os.getpid(), runtime.describe()))
+    src_dict, tgt_dict, model = load_model(args, state_dict)
+    _worker.update(args=args, src_dict=src_dict, tgt_dict=tgt_dict, generator=build_generator(args, model, tgt_dict),
+                   cache=build_cache(args))
+
+
+def translate_window(lines):
+    """ Translates a window of lines in a worker; also returns the worker's cache statistics so far. """
+    translations = translate_lines(_worker['args'], _worker['src_dict'], _worker['tgt_dict'], _worker['generator'],
+                                   lines, _worker['cache'])
+    cache_stats = dict(_worker['cache'].stats) if _worker['cache'] is not None else None
+    return translations, os.getpid(), cache_stats
+
+
+def translate_file(args, state_dict):
+    """ Streams the raw lines of args.input through the model in windows of args.window_size lines and writes the
+    translations in input order. At most two windows per worker are in flight, so memory use does not grow with the
+    size of the input. """
+    from tqdm import tqdm
+    with open(args.input) as in_file, open(args.output, 'w') as out_file:
+        windows = iter(lambda: [line.rstrip('\n') for line in itertools.islice(in_file, args.window_size)], [])
+        num_lines = 0
+        cache_stats = {}
+
+        if args.num_workers <= 1:
+            src_dict, tgt_dict, model = load_model(args, state_dict)
+            generator = build_generator(args, model, tgt_dict)
+            cache = build_cache(args)
+            for lines in tqdm(windows, desc='| Generation', leave=False):
+                out_file.writelines(translation + '\n' for translation in translate_lines(
+                    args, src_dict, tgt_dict, generator, lines, cache))
+                num_lines += len(lines)
+            if cache is not None:
+                cache_stats[os.getpid()] = cache.stats
+                cache.close()
+        else:
+            # Give every worker a disjoint slice of the cores of this process (see --cpu-affinity)
+            import multiprocessing
+            context = multiprocessing.get_context('spawn')
+            core_slices = context.Queue()
+            for cores in runtime.split_cores(runtime.available_cores(), args.num_workers):
+                core_slices.put(cores)
+
+            with context.Pool(args.num_workers, initializer=init_worker,
+                              initargs=(args, state_dict, core_slices)) as pool:
+                pending = deque()
+                for lines in tqdm(itertools.chain(windows, [None]), desc='| Generation', leave=False):
+                    if lines is not None:
+                        pending.append(pool.apply_async(translate_window, (lines,)))
+                    # Write finished windows in order; block once too many windows are in flight or at the end
+                    while len(pending) > 0 and (pending[0].ready() or len(pending) >= 2 * args.num_workers or
+                                                lines is None):
+                        translations, worker_pid, worker_cache_stats = pending.popleft().get()
+                        out_file.writelines(translation + '\n' for translation in translations)
+                        num_lines += len(translations)
+                        if worker_cache_stats is not None:
+                            cache_stats[worker_pid] = worker_cache_stats
+
+    logging.info('Translated {:d} lines from {:s} to {:s}'.format(num_lines, args.input, args.output))
+    if len(cache_stats) > 0:
+        from seq2seq.cache import format_cache_stats
+        totals = collections.Counter()
+        for stats in cache_stats.values():
+            totals.update(stats)
+        logging.info('Translation cache: {}'.format(format_cache_stats(totals)))
 
 
 if __name__ == '__main__':
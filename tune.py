@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import logging
+import argparse
+import functools
+import numpy as np
+
+import torch
+from torch.serialization import default_restore_location
+
+from seq2seq import models, runtime, utils
+from seq2seq.memory import MemoryMonitor, current_memory, default_memory_limit, generation_cost, release_memory, \
+    training_cost
+from seq2seq.criterion import ChunkedCrossEntropyCriterion
+from seq2seq.data.dictionary import Dictionary
+from seq2seq.data.dataset import Seq2SeqDataset, BatchSampler, GenerationBatchSampler
+from seq2seq.generator import SequenceGenerator
+from seq2seq.models import ARCH_MODEL_REGISTRY, ARCH_CONFIG_REGISTRY
+from train import compute_loss
+
+
+def get_args():
+    """ Defines tuning-specific hyper-parameters. """
+    parser = argparse.ArgumentParser('Sequence to Sequence Model')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='numerical precision of the probes (bf16 uses autocast)')
+    runtime.add_runtime_args(parser)
+    parser.add_argument('--seed', default=42, type=int, help='pseudo random number generator seed')
+
+    # Add data arguments
+    parser.add_argument('--data', default='prepared_data', help='path to data directory')
+    parser.add_argument('--source-lang', default='jp', help='source language')
+    parser.add_argument('--target-lang', default='en', help='target language')
+    parser.add_argument('--train-split', default='train', help='split used for the training probes')
+    parser.add_argument('--generate-split', default='test', help='split used for the generation probes')
+    parser.add_argument('--checkpoint-path', default=None,
+                        help='probe a trained model (default: a randomly initialized model of --arch)')
+
+    # Add model arguments
+    parser.add_argument('--arch', default='lstm', choices=ARCH_MODEL_REGISTRY.keys(), help='model architecture')
+    parser.add_argument('--loss-chunk-size', default=None, type=int,
+                        help='probe training with the chunked output projection and loss (see train.py)')
+    parser.add_argument('--max-len', default=25, type=int, help='maximum length of generated sequences')
+
+    # Add tuning arguments
+    parser.add_argument('--mode', default='both', choices=['train', 'generate', 'both'], help='what to tune for')
+    parser.add_argument('--min-tokens', default=256, type=int, help='smallest token budget probed')
+    parser.add_argument('--max-tokens-limit', default=65536, type=int, help='largest token budget probed')
+    parser.add_argument('--probe-batches', default=8, type=int, help='number of timed batches per token budget')
+    parser.add_argument('--max-memory', default=None, type=float,
+                        help='memory limit in MB (default: 80%% of the memory available when tuning starts)')
+    parser.add_argument('--tolerance', default=0.05, type=float,
+                        help='recommend the smallest budget within this fraction of the best throughput')
+    parser.add_argument('--output', default=None, help='write the length statistics and recommendations as JSON')
+
+    # Parse twice as model arguments are not known the first time
+    args, _ = parser.parse_known_args()
+    model_parser = parser.add_argument_group(argument_default=argparse.SUPPRESS)
+    ARCH_MODEL_REGISTRY[args.arch].add_args(model_parser)
+    args = parser.parse_args()
+    ARCH_CONFIG_REGISTRY[args.arch](args)
+    return args
+
+
+def length_statistics(sizes):
+    """ Summarizes an array of sentence lengths. """
+    sizes = np.asarray(sizes)
+    if len(sizes) == 0:
+        return {'sentences': 0, 'tokens': 0}
+    stats = {'sentences': len(sizes), 'tokens': int(sizes.sum()), 'mean': round(float(sizes.mean()), 2)}
+    for q in (50, 90, 99):
+        stats['p{:d}'.format(q)] = int(np.percentile(sizes, q))
+    stats['max'] = int(sizes.max())
+    return stats
+
+
+def format_statistics(name, stats):
+    return '{:s}: '.format(name) + ' | '.join('{} {}'.format(key, value) for key, value in stats.items())
+
+
+def padding_efficiency(batches, src_sizes, tgt_sizes):
+    """ Returns the fraction of real (non-padding) tokens in a list of batches. """
+    real, padded = 0, 0
+    for batch in batches:
+        src, tgt = src_sizes[batch], tgt_sizes[batch]
+        real += src.sum() + tgt.sum()
+        padded += len(batch) * (src.max() + tgt.max())
+    return float(real / max(padded, 1))
+
+
+def select_probe_batches(batches, sizes, num_batches):
+    """ Selects random batches and the batch with the most padded tokens, which determines the peak memory. """
+    padded = [len(batch) * sizes[batch].max() for batch in batches]
+    largest = int(np.argmax(padded))
+    others = [i for i in np.random.permutation(len(batches)).tolist() if i != largest][:max(num_batches - 1, 0)]
+    return [batches[i] for i in [largest] + others]
+
+
+def probe_train(args, model, criterion, dataset, budget, monitor):
+    """ Times forward and backward passes (without parameter updates) on batches of the given token budget, whose
+    memory is measured by the monitor. Returns the number of target tokens per second, the padding efficiency and the
+    batches of the budget. """
+    batches = [batch for batch in BatchSampler(dataset, budget, None, shuffle=True, seed=args.seed) if len(batch) > 0]
+    efficiency = padding_efficiency(batches, dataset.src_sizes, dataset.tgt_sizes)
+    probes = [dataset.collater([dataset[idx] for idx in batch])
+              for batch in select_probe_batches(batches, dataset.src_sizes + dataset.tgt_sizes, args.probe_batches)]
+    if args.cuda:
+        probes = [utils.move_to_cuda(sample) for sample in probes]
+
+    model.train()
+    num_tokens, elapsed = 0, 0.
+    # The first batch (the largest one) is a warm-up step that is not timed
+    for i, sample in enumerate(probes[:1] + probes):
+        start = time.perf_counter()
+        with monitor.step(sample):
+            with utils.autocast(args.precision, args.cuda):
+                loss = compute_loss(model, criterion, sample)
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+            if args.cuda:
+                torch.cuda.synchronize()
+        if i > 0:
+            elapsed += time.perf_counter() - start
+            num_tokens += sample['num_tokens']
+    return num_tokens / max(elapsed, 1e-9), efficiency, batches
+
+
+def probe_generate(args, generator, dataset, budget, monitor):
+    """ Times greedy decoding on batches of the given token budget, whose memory is measured by the monitor. Returns
+    the number of sentences per second, the padding efficiency of the source batches and the batches of the budget. """
+    batches = GenerationBatchSampler(dataset.src_sizes, budget, None, args.max_len).batches
+    efficiency = padding_efficiency([np.asarray(batch) for batch in batches], dataset.src_sizes,
+                                    np.zeros_like(dataset.src_sizes))
+    probes = [dataset.collater([dataset[idx] for idx in batch])
+              for batch in select_probe_batches(batches, dataset.src_sizes, args.probe_batches)]
+    if args.cuda:
+        probes = [utils.move_to_cuda(sample) for sample in probes]
+
+    generator.model.eval()
+    num_sentences, elapsed = 0, 0.
+    for i, sample in enumerate(probes[:1] + probes):
+        start = time.perf_counter()
+        with monitor.step(sample), torch.inference_mode(), utils.autocast(args.precision, args.cuda):
+            generator.generate(sample['src_tokens'], sample['src_lengths'])
+            if args.cuda:
+                torch.cuda.synchronize()
+        if i > 0:
+            elapsed += time.perf_counter() - start
+            num_sentences += len(sample['src_tokens'])
+    return num_sentences / max(elapsed, 1e-9), efficiency, batches
+
+
+def sweep(args, name, probe_fn, unit, cost_fn):
+    """ Probes doubling token budgets until the memory limit would be exceeded, throughput has not improved for two
+    budgets, or the whole split fits into a single batch. The peak memory of a budget is the baseline memory plus the
+    largest growth of one of its steps over the memory at the start of the step, which unlike the peak RSS of the
+    process does not depend on the budgets before it; free heap memory is released before every budget. Peak memory
+    is assumed to grow linearly with the budget to skip budgets that are likely to exceed the limit. Returns the probe
+    results and the recommended probe: the smallest budget within --tolerance of the best throughput, as smaller
+    batches need less memory and give more updates per epoch. """
+    baseline = current_memory(args.cuda)
+    results, budget, best, stale = [], args.min_tokens, 0., 0
+    while budget <= args.max_tokens_limit:
+        if len(results) > 0:
+            expected = baseline + (results[-1]['peak_memory'] - baseline) * budget / results[-1]['max_tokens']
+            if expected > args.max_memory:
+                logging.info('{:s}: stopping before max_tokens {:d} (expected memory {:.0f} MB > limit {:.0f} MB)'
+                             .format(name, budget, expected, args.max_memory))
+                break
+        if not args.cuda:
+            release_memory()
+        monitor = MemoryMonitor(cost_fn, cuda=args.cuda)
+        try:
+            throughput, efficiency, batches = probe_fn(budget, monitor)
+        finally:
+            monitor.close()
+        result = {'max_tokens': budget, unit: round(throughput, 1), 'padding_efficiency': round(efficiency, 3),
+                  'batches': len(batches), 'max_sentences': max(len(batch) for batch in batches),
+                  'peak_memory': round(baseline + monitor.peak_growth, 1)}
+        logging.info('{:s}: '.format(name) + ' | '.join('{} {}'.format(key, value) for key, value in result.items()))
+        if result['peak_memory'] > args.max_memory:
+            logging.info('{:s}: max_tokens {:d} exceeds the memory limit of {:.0f} MB'.format(
+                name, budget, args.max_memory))
+            break
+        results.append(result)
+
+        stale = stale + 1 if throughput <= best else 0
+        best = max(best, throughput)
+        if stale == 2 or len(batches) == 1:
+            break
+        budget *= 2
+
+    if len(results) == 0:
+        return results, None
+    best = max(result[unit] for result in results)
+    return results, next(result for result in results if result[unit] >= (1 - args.tolerance) * best)
+
+
+def main(args):
+    """ Reports the length distribution of the data and recommends the --max-tokens budgets with the highest
+    training and generation throughput within the memory limit. """
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    utils.init_logging(args)
+    runtime.configure(args)
+
+    # Load dictionaries and the model
+    state_dict = None
+    if args.checkpoint_path is not None:
+        state_dict = torch.load(args.checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
+        model_args = {key: value for key, value in vars(state_dict['args']).items()
+                      if key == 'arch' or key.startswith(('encoder_', 'decoder_'))}
+        args = argparse.Namespace(**{**vars(args), **model_args})
+        ARCH_CONFIG_REGISTRY[args.arch](args)
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
+    model = models.build_model(args, src_dict, tgt_dict)
+    if state_dict is not None:
+        model.load_state_dict(state_dict['model'])
+    if args.cuda:
+        model = model.cuda()
+    if args.max_memory is None:
+        args.max_memory = default_memory_limit(args.cuda)
+    logging.info('Built a model with {:d} parameters | memory limit {:.0f} MB'.format(
+        sum(p.numel() for p in model.parameters()), args.max_memory))
+
+    def load_data(split):
+        return Seq2SeqDataset(
+            src_file=os.path.join(args.data, '{:s}.{:s}'.format(split, args.source_lang)),
+            tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(split, args.target_lang)),
+            src_dict=src_dict, tgt_dict=tgt_dict)
+
+    report = {}
+    if args.mode in ('train', 'both'):
+        train_dataset = load_data(args.train_split)
+        report['train'] = {'source': length_statistics(train_dataset.src_sizes),
+                           'target': length_statistics(train_dataset.tgt_sizes)}
+        logging.info(format_statistics('Source lengths ({:s})'.format(args.train_split), report['train']['source']))
+        logging.info(format_statistics('Target lengths ({:s})'.format(args.train_split), report['train']['target']))
+
+        if args.loss_chunk_size is not None:
+            criterion = ChunkedCrossEntropyCriterion(model.decoder.output_layer, tgt_dict.pad_idx, args.loss_chunk_size)
+        else:
+            criterion = torch.nn.CrossEntropyLoss(ignore_index=tgt_dict.pad_idx, reduction='sum')
+        report['train']['probes'], report['train']['recommended'] = sweep(
+            args, 'Train', lambda budget, monitor: probe_train(args, model, criterion, train_dataset, budget, monitor),
+            'tokens_per_sec', training_cost)
+
+    if args.mode in ('generate', 'both'):
+        generate_dataset = load_data(args.generate_split)
+        report['generate'] = {'source': length_statistics(generate_dataset.src_sizes)}
+        logging.info(format_statistics('Source lengths ({:s})'.format(args.generate_split),
+                                       report['generate']['source']))
+
+        generator = SequenceGenerator(model, tgt_dict, max_len=args.max_len)
+        report['generate']['probes'], report['generate']['recommended'] = sweep(
+            args, 'Generate',
+            lambda budget, monitor: probe_generate(args, generator, generate_dataset, budget, monitor),
+            'sentences_per_sec', functools.partial(generation_cost, max_len=args.max_len))
+
+    # The recommended batch size is the largest number of sentences in a batch of the budget, so that it never limits
+    # a batch before the token budget does
+    for mode, script in (('train', 'train.py'), ('generate', 'translate.py')):
+        if mode in report:
+            recommended = report[mode]['recommended']
+            if recommended is None:
+                logging.warning('No {:s} budget fits into {:.0f} MB'.format(mode, args.max_memory))
+            else:
+                logging.info('Recommended: {:s} --max-tokens {:d} --batch-size {:d}'.format(
+                    script, recommended['max_tokens'], recommended['max_sentences']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info('Wrote the tuning report to {:s}'.format(args.output))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
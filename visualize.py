@@ -1,10 +1,7 @@
 import os
+import logging
 import argparse
-import pandas as pd
-import matplotlib as mpl
-mpl.use("TkAgg")
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 
 import torch
 from torch.serialization import default_restore_location
@@ -15,104 +12,162 @@ from seq2seq.data.dataset import Seq2SeqDataset, BatchSampler
 
 
 def get_args():
-    """ Defines training-specific hyper-parameters. """
+    """ Defines visualization-specific hyper-parameters. """
     parser = argparse.ArgumentParser('Sequence to Sequence Model')
-    parser.add_argument('--cuda', default=False, help='Use a GPU')
+    parser.add_argument('--cuda', default=False, type=utils.str2bool, help='Use a GPU')
 
     # Add data arguments
-    parser.add_argument('--data', default='prepared_data', help='path to data directory')
-    parser.add_argument('--source-lang', default='jp', help='source language')
-    parser.add_argument('--target-lang', default='en', help='target language')
+    parser.add_argument('--data', default=None,
+                        help='path to data directory (default: the data directory of the checkpoint)')
+    parser.add_argument('--source-lang', default=None, help='source language (default: that of the checkpoint)')
+    parser.add_argument('--target-lang', default=None, help='target language (default: that of the checkpoint)')
+    parser.add_argument('--split', default='test', help='split whose attention weights are exported')
     parser.add_argument('--checkpoint-path', default='checkpoints/checkpoint_best.pt',
                         help='path to the model file')
-    parser.add_argument('--vis-dir', default='visualizations', help='path to the model file')
+    parser.add_argument('--max-tokens', default=None, type=int, help='maximum number of tokens in an export batch')
+    parser.add_argument('--batch-size', default=64, type=int, help='maximum number of sentences in an export batch')
+    parser.add_argument('--vis-dir', default='visualizations', help='path to the directory of rendered heat-maps')
+
+    # Add export and rendering arguments
+    parser.add_argument('--attention-file', default=None,
+                        help='compressed .npz file of exported attention weights (default: VIS_DIR/attention.npz)')
+    parser.add_argument('--export-only', action='store_true', help='export attention weights without rendering')
+    parser.add_argument('--render-only', action='store_true', help='render heat-maps from an existing export')
+    parser.add_argument('--ids', default=None, type=int, nargs='+',
+                        help='sentence ids to render (default: the first --num-render sentences)')
+    parser.add_argument('--num-render', default=10, type=int, help='number of sentences rendered without --ids')
+    parser.add_argument('--num-workers', default=4, type=int, help='number of rendering processes')
+    parser.add_argument('--font', default='AppleGothic', help='font family of heat-map labels')
     return parser.parse_args()
 
 
-def main(args):
-    """ Main function. Visualizes attention weight arrays as nifty heat-maps. """
-    mpl.rc('font', family='AppleGothic')
-
+def export_attention(args, attention_file):
+    """ Runs batched forward passes over a split and saves the unpadded [tgt_len, src_len] attention matrix of every
+    sentence to a compressed .npz file, together with the source and target sentences and an index by sentence id. """
     torch.manual_seed(42)
     state_dict = torch.load(args.checkpoint_path, map_location=lambda s, l: default_restore_location(s, 'cpu'))
-    args = argparse.Namespace(**{**vars(args), **vars(state_dict['args'])})
-    args.cuda = False
+    args = utils.merge_checkpoint_args(args, state_dict['args'])
     utils.init_logging(args)
 
     # Load dictionaries
     src_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.source_lang)))
-    print('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
+    logging.info('Loaded a source dictionary ({:s}) with {:d} words'.format(args.source_lang, len(src_dict)))
     tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{:s}'.format(args.target_lang)))
-    print('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
+    logging.info('Loaded a target dictionary ({:s}) with {:d} words'.format(args.target_lang, len(tgt_dict)))
 
     # Load dataset
-    test_dataset = Seq2SeqDataset(
-        src_file=os.path.join(args.data, 'test.{:s}'.format(args.source_lang)),
-        tgt_file=os.path.join(args.data, 'test.{:s}'.format(args.target_lang)),
+    dataset = Seq2SeqDataset(
+        src_file=os.path.join(args.data, '{:s}.{:s}'.format(args.split, args.source_lang)),
+        tgt_file=os.path.join(args.data, '{:s}.{:s}'.format(args.split, args.target_lang)),
         src_dict=src_dict, tgt_dict=tgt_dict)
+    vis_loader = torch.utils.data.DataLoader(dataset, num_workers=1, collate_fn=dataset.collater,
+                                             batch_sampler=BatchSampler(dataset, args.max_tokens, args.batch_size, 1,
+                                                                        0, shuffle=False, seed=42))
 
-    vis_loader = torch.utils.data.DataLoader(test_dataset, num_workers=1, collate_fn=test_dataset.collater,
-                                             batch_sampler=BatchSampler(test_dataset, None, 1, 1, 0, shuffle=False,
-                                                                        seed=42))
-
-    # Build model and optimization criterion
+    # Build model
     model = models.build_model(args, src_dict, tgt_dict)
     if args.cuda:
         model = model.cuda()
+    model.eval()
     model.load_state_dict(state_dict['model'])
-    print('Loaded a model from checkpoint {:s}'.format(args.checkpoint_path))
-
-    # Store attention weight arrays
-    attn_records = list()
-
-    # Iterate over the visualization set
-    for i, sample in enumerate(vis_loader):
-        
-        # Only visualize the first 10 sentence pairs
-        if i >= 10:
-            break
-        
-        if args.cuda:
-            sample = utils.move_to_cuda(sample)
-        if len(sample) == 0:
-            continue
-
-        # Perform forward pass
-        output, attn_weights = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'])
-        attn_records.append((sample, attn_weights))
-
-    # Generate heat-maps and store them at the designated location
-    if not os.path.exists(args.vis_dir):
-        os.makedirs(args.vis_dir)
-
-    for record_id, record in enumerate(attn_records):
-        # print('aaaaa')
-        # Unpack
-        sample, attn_map = record
-        src_ids = utils.strip_pad(sample['src_tokens'].data, tgt_dict.pad_idx)
-        tgt_ids = utils.strip_pad(sample['tgt_inputs'].data, tgt_dict.pad_idx)
-        # Convert indices into word tokens
-        src_str = src_dict.string(src_ids).split(' ') + ['<EOS>']
-        tgt_str = tgt_dict.string(tgt_ids).split(' ') + ['<EOS>']
-
-        # print('bbbbb')
-        # Generate heat-maps
-        attn_map = attn_map.squeeze(dim=0).transpose(1, 0).detach().numpy()
-
-        attn_df = pd.DataFrame(attn_map,
-                               index=src_str,
-                               columns=tgt_str)
-        # print('ccccc')
-        # print(attn_df)
-        sns.heatmap(attn_df, cmap='Blues', linewidths=0.25, vmin=0.0, vmax=1.0, xticklabels=True, yticklabels=True,
-                    fmt='.3f')
-        # print('dddd')
-        plt.yticks(rotation=0)
-        plot_path = os.path.join(args.vis_dir, 'sentence_{:d}.png'.format(record_id))
-        plt.savefig(plot_path, dpi='figure', pad_inches=1, bbox_inches='tight')
-        plt.clf()
+    logging.info('Loaded a model from checkpoint {:s}'.format(args.checkpoint_path))
+
+    # Iterate over the split; attention matrices are stored by sentence id
+    from tqdm import tqdm
+    records = [None] * len(dataset)
+    with torch.no_grad():
+        for sample in tqdm(vis_loader, desc='| Export', leave=False):
+            if len(sample) == 0:
+                continue
+            if args.cuda:
+                sample = utils.move_to_cuda(sample)
+            _, attn_weights = model(sample['src_tokens'], sample['src_lengths'], sample['tgt_inputs'], need_attn=True)
+            attn_weights = attn_weights.float().cpu().numpy()
+
+            tgt_lengths = sample['tgt_tokens'].ne(tgt_dict.pad_idx).sum(dim=1).tolist()
+            for i, (sent_id, src_len, tgt_len) in enumerate(zip(
+                    sample['id'].tolist(), sample['src_lengths'].tolist(), tgt_lengths)):
+                src_ids = sample['src_tokens'][i, :src_len]
+                tgt_ids = sample['tgt_tokens'][i, :tgt_len]
+                records[sent_id] = (attn_weights[i, :tgt_len, :src_len],
+                                    src_dict.string(src_ids) + ' <EOS>', tgt_dict.string(tgt_ids) + ' <EOS>')
+
+    # Concatenate the flattened matrices; the offsets and shapes index them by sentence id
+    shapes = np.array([record[0].shape for record in records], dtype=np.int64).reshape(-1, 2)
+    sizes = shapes[:, 0] * shapes[:, 1]
+    os.makedirs(os.path.dirname(os.path.abspath(attention_file)), exist_ok=True)
+    np.savez_compressed(
+        attention_file,
+        attention=np.concatenate([record[0].reshape(-1) for record in records]) if len(records) > 0 else np.zeros(0),
+        offsets=np.cumsum(sizes) - sizes,
+        shapes=shapes,
+        src_sentences=np.array([record[1] for record in records]),
+        tgt_sentences=np.array([record[2] for record in records]))
+    logging.info('Exported attention weights of {:d} sentences to {:s}'.format(len(records), attention_file))
+
+
+def load_attention(attention_file, sent_id, export=None):
+    """ Returns the attention matrix and the source and target tokens of a sentence in an exported .npz file. """
+    export = np.load(attention_file) if export is None else export
+    (tgt_len, src_len), offset = export['shapes'][sent_id], export['offsets'][sent_id]
+    attn_map = export['attention'][offset:offset + tgt_len * src_len].reshape(tgt_len, src_len)
+    return attn_map, str(export['src_sentences'][sent_id]).split(' '), str(export['tgt_sentences'][sent_id]).split(' ')
+
+
+# Per-process state of rendering workers
+_renderer = {}
+
+
+def init_renderer(vis_dir, font):
+    """ Sets up headless plotting once per rendering process. """
+    import matplotlib as mpl
+    mpl.use('Agg')
+    mpl.rc('font', family=font)
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    _renderer.update(vis_dir=vis_dir, plt=plt, pd=pd, sns=sns)
+
+
+def render_attention(sentence):
+    """ Renders the attention heat-map of a single sentence, given as its id, attention matrix and source and target
+    tokens (see load_attention). """
+    plt, pd, sns = _renderer['plt'], _renderer['pd'], _renderer['sns']
+    sent_id, attn_map, src_str, tgt_str = sentence
+    attn_df = pd.DataFrame(attn_map.T, index=src_str, columns=tgt_str)
+    sns.heatmap(attn_df, cmap='Blues', linewidths=0.25, vmin=0.0, vmax=1.0, xticklabels=True, yticklabels=True,
+                fmt='.3f')
+    plt.yticks(rotation=0)
+    plot_path = os.path.join(_renderer['vis_dir'], 'sentence_{:d}.png'.format(sent_id))
+    plt.savefig(plot_path, dpi='figure', pad_inches=1, bbox_inches='tight')
+    plt.clf()
+    return plot_path
 
 
+def main(args):
+    """ Main function. Exports attention weight arrays and visualizes them as nifty heat-maps. """
+    attention_file = args.attention_file or os.path.join(args.vis_dir, 'attention.npz')
+    if not args.render_only:
+        export_attention(args, attention_file)
+    if args.export_only:
+        return
+
+    # Render the selected sentences in parallel; the export is only decompressed here, and the rendering processes
+    # receive the attention matrices and tokens of the sentences they render
+    with np.load(attention_file) as npz:
+        export = {key: npz[key] for key in npz.files}
+    ids = args.ids if args.ids is not None else list(range(min(args.num_render, len(export['shapes']))))
+    sentences = [(sent_id,) + load_attention(None, sent_id, export) for sent_id in ids]
+    del export
+    os.makedirs(args.vis_dir, exist_ok=True)
+    import multiprocessing
+    from tqdm import tqdm
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(max(min(args.num_workers, len(ids)), 1), initializer=init_renderer,
+                      initargs=(args.vis_dir, args.font)) as pool:
+        for _ in tqdm(pool.imap_unordered(render_attention, sentences), total=len(ids), desc='| Render', leave=False):
+            pass
+
     print('Done! Visualized attention maps have been saved to the \'{:s}\' directory!'.format(args.vis_dir))
 
 